@@ -46,6 +46,7 @@ INSTALLED_APPS = [
     'products',
     'mailing',
     'cart',
+    'orders',
 ]
 
 MIDDLEWARE = [
@@ -132,6 +133,10 @@ STATICFILES_DIRS = [
     os.path.join(BASE_DIR, 'static'),
 ]
 
+# Медиафайлы (фото товаров, вложения рассылок)
+MEDIA_URL = 'media/'
+MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -176,6 +181,11 @@ LOGGING = {
             'level': 'DEBUG',
             'propagate': True,
         },
+        'products': {  # Логгер для приложения products
+            'handlers': ['file'],
+            'level': 'DEBUG',
+            'propagate': True,
+        },
         'bot': {  # Логгер для бота
             'handlers': ['file'],
             'level': 'DEBUG',
@@ -13,7 +13,10 @@ class Cart(models.Model):
     class Meta:
         verbose_name = 'Корзина'
         verbose_name_plural = 'Корзин'
-        unique_together = ('user', 'product')  # один и тот же продукт может быть добавлен в корзину единожды
+        # один и тот же продукт может быть добавлен в корзину единожды. Уникальный индекс (user_id, product_id)
+        # обслуживает и корзину в боте (WHERE user_id = ... ORDER BY id): строк на пользователя мало,
+        # сортировка по id дешевле отдельного индекса на каждую запись в корзину
+        unique_together = ('user', 'product')
 
     def __str__(self):
         return f'Корзина пользователя: {self.user.name}, Продукт: {self.product.name}, Количество: {self.quantity}'
@@ -1,29 +1,100 @@
 import logging
-import os
+import mimetypes
 
-from aiogram import Bot
-from asgiref.sync import async_to_sync
 from django.contrib import admin
 from django.contrib import messages
-from django.core.files.storage import default_storage
+from django.core.exceptions import ValidationError
+from django.forms.models import BaseInlineFormSet
+from django.db.models.functions import Now
 from django.shortcuts import redirect
 from django.urls import path
 from django.urls import reverse
 from django.utils.html import format_html
-from dotenv import load_dotenv
 
-from users.models import User
-from .models import Mailing
+from .models import Mailing, MailingAttachment
+from .signals import publish_mailing_event
 
 logger = logging.getLogger('mailing')  # Получаем логгер для приложения mailing
-load_dotenv()
+
+# Поля, которые редактируются в админке; остальные пишут воркер и планировщик бота
+CONTENT_FIELDS = ('text', 'media_file', 'media_type', 'media_file_id', 'send_at')
+
+
+# Тип медиа по расширению файла, если он не указан; так же его определяет воркер бота (bot/mailing.py)
+def guess_media_type(name):
+    mime, _ = mimetypes.guess_type(name)
+    if mime == 'image/gif':
+        return 'animation'
+    kind = mime.split('/')[0] if mime else None
+    return {'image': 'photo', 'video': 'video', 'audio': 'audio'}.get(kind, 'document')
+
+
+# Состав альбома по правилам send_media_group: фото и видео вперемешку, только документы или только аудио.
+# Первый элемент альбома - медиафайл рассылки; анимации в альбом не входят
+class MailingAttachmentFormSet(BaseInlineFormSet):
+    def clean(self):
+        super().clean()
+        if any(self.errors):
+            return
+        media_types = []
+        if self.instance.media_file:
+            media_types.append(self.instance.media_type or guess_media_type(self.instance.media_file.name))
+        for form in self.forms:
+            if not form.cleaned_data or form.cleaned_data.get('DELETE') or not form.cleaned_data.get('file'):
+                continue
+            media_types.append(form.cleaned_data.get('media_type') or guess_media_type(form.cleaned_data['file'].name))
+        if len(media_types) < 2:
+            return
+
+        kinds = set(media_types)
+        if 'animation' in kinds:
+            raise ValidationError("GIF-анимации нельзя отправить альбомом: оставьте анимацию единственным файлом.")
+        if not (kinds <= {'photo', 'video'} or kinds == {'document'} or kinds == {'audio'}):
+            raise ValidationError("В альбоме можно совместить только фото и видео; "
+                                  "документы и аудио отправляются альбомом только с файлами своего типа.")
+
+
+# Остальные файлы альбома; вместе с медиафайлом рассылки - не больше 10 (ограничение Telegram)
+class MailingAttachmentInline(admin.TabularInline):
+    model = MailingAttachment
+    formset = MailingAttachmentFormSet
+    extra = 0
+    max_num = 9
+    fields = ('file', 'media_type', 'position', 'file_id')
+    readonly_fields = ('file_id',)
+
+    # obj - рассылка; файлы рассылки в очереди не меняются
+    def has_change_permission(self, request, obj=None):
+        return not (obj is not None and obj.queued_at) and super().has_change_permission(request, obj)
+
+    def has_add_permission(self, request, obj=None):
+        return not (obj is not None and obj.queued_at) and super().has_add_permission(request, obj)
+
+    def has_delete_permission(self, request, obj=None):
+        return not (obj is not None and obj.queued_at) and super().has_delete_permission(request, obj)
 
 
 @admin.register(Mailing)
 class MailingAdmin(admin.ModelAdmin):
-    list_display = ('send_at', 'sent', 'text', 'media_file', 'send_button')  # Отображение полей в админке
+    list_display = ('send_at', 'sent', 'text', 'media_file', 'progress', 'send_button')  # Отображение полей в админке
     list_filter = ('sent', 'send_at')  # Фильтры по статусу отправки и дате, времени
-    readonly_fields = ('sent',)
+    readonly_fields = ('sent', 'media_file_id', 'queued_at', 'sent_count', 'failed_count', 'finished_at')
+    exclude = ('lease_owner', 'lease_until', 'last_recipient_id')
+    inlines = (MailingAttachmentInline,)
+
+    # Рассылку в очереди ведет воркер бота: форма только для просмотра, иначе сохранение формы,
+    # открытой до постановки в очередь, вернуло бы старые счетчики и контрольную точку
+    def has_change_permission(self, request, obj=None):
+        if obj is not None and obj.queued_at:
+            return False
+        return super().has_change_permission(request, obj)
+
+    # Сохраняются только поля содержимого; поля воркера и планировщика админка не перезаписывает
+    def save_model(self, request, obj, form, change):
+        if change:
+            obj.save(update_fields=CONTENT_FIELDS)
+        else:
+            super().save_model(request, obj, form, change)
 
     # Отображение превью текста
     def text_preview(self, obj):
@@ -31,15 +102,24 @@ class MailingAdmin(admin.ModelAdmin):
 
     text_preview.short_description = 'Текст сообщения'
 
+    # Ход доставки по счетчикам воркера
+    def progress(self, obj):
+        if not obj.queued_at:
+            return ""
+        return f"доставлено {obj.sent_count}, ошибок {obj.failed_count}"
+
+    progress.short_description = 'Доставка'
+
     # HTML-кнопка в админке
     def send_button(self, obj):
-        if not obj.sent:
-            return format_html(
-                '<button class="button" onclick="location.href=\'{}\'">Отправить</button>',
-                f'/admin/mailing/mailing/{obj.pk}/send/'
-            )
-        else:
+        if obj.sent:
             return format_html("Отправлено")
+        if obj.queued_at:
+            return format_html("В очереди")
+        return format_html(
+            '<button class="button" onclick="location.href=\'{}\'">Отправить</button>',
+            f'/admin/mailing/mailing/{obj.pk}/send/'
+        )
 
     send_button.short_description = 'Отправить'
     send_button.allow_tags = True
@@ -52,44 +132,26 @@ class MailingAdmin(admin.ModelAdmin):
         ]
         return custom_urls + urls
 
-    # Логика отправки сообщения
+    # Кнопка ставит рассылку в очередь сразу, не дожидаясь send_at (по send_at ее ставит планировщик бота);
+    # отправляет воркер бота, запрос админки не ждет доставки.
+    # Условный UPDATE не дает поставить рассылку в очередь дважды при повторном нажатии
     def send_mailing(self, request, object_id):
         mailing = self.get_object(request, object_id)
-        if not mailing.sent:
-            try:
-                self.send_message_to_all_users(mailing)
-                mailing.sent = True
-                mailing.save()
-                self.message_user(request, "Рассылка успешно отправлена.", level=messages.SUCCESS)
-                logger.info(f"Рассылка {mailing.pk} успешно отправлена.")
-            except Exception as e:
-                self.message_user(request, f"Ошибка при отправке рассылки: {e}", level=messages.ERROR)
-                logger.error(f"Ошибка при отправке рассылки {mailing.pk}: {e}", exc_info=True)
-        else:
+        if mailing is None:
+            return redirect(reverse('admin:mailing_mailing_changelist'))
+        if not mailing.text and not mailing.media_file and not mailing.attachments.exists():
+            self.message_user(request, "В рассылке нет ни текста, ни медиафайлов.", level=messages.ERROR)
+            return redirect(reverse('admin:mailing_mailing_changelist'))
+
+        queued = Mailing.objects.filter(pk=mailing.pk, sent=False, queued_at__isnull=True).update(queued_at=Now())
+        if queued:
+            publish_mailing_event(mailing.pk)
+            self.message_user(request, "Рассылка поставлена в очередь на отправку.", level=messages.SUCCESS)
+            logger.info(f"Рассылка {mailing.pk} поставлена в очередь.")
+        elif mailing.sent:
             self.message_user(request, "Рассылка уже была отправлена.", level=messages.WARNING)
             logger.warning(f"Попытка повторной отправки рассылки {mailing.pk}.")
+        else:
+            self.message_user(request, "Рассылка уже в очереди.", level=messages.WARNING)
 
         return redirect(reverse('admin:mailing_mailing_changelist'))
-
-    # Отправка сообщения каждому активному пользователю
-    def send_message_to_all_users(self, mailing):
-        bot = Bot(token=os.getenv("BOT_TOKEN"))
-        users = User.objects.filter(is_active=True)
-        for user in users:
-            try:
-                if mailing.media_file:
-                    try:
-                        with default_storage.open(mailing.media_file.name, 'rb') as file:
-                            async_to_sync(bot.send_photo)(user.telegram_id, file.read(),
-                                                          caption=mailing.text if mailing.text else None)
-                            logger.info(f"Отправлено фото пользователю {user.telegram_id} для рассылки {mailing.pk}")
-                    except Exception as e:
-                        logger.error(f"Ошибка при отправке фото пользователю {user.telegram_id}: {e}", exc_info=True)
-                elif mailing.text:
-                    async_to_sync(bot.send_message)(user.telegram_id, mailing.text)
-                    logger.info(f"Отправлено сообщение пользователю {user.telegram_id} для рассылки {mailing.pk}")
-                else:
-                    logger.warning(
-                        f"Нет текста или медиафайла для отправки пользователю {user.telegram_id} для рассылки {mailing.pk}")
-            except Exception as e:
-                logger.error(f"Не удалось отправить сообщение пользователю {user.telegram_id}: {e}", exc_info=True)
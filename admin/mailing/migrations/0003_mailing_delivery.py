@@ -0,0 +1,48 @@
+# Generated by Django 5.2.3 on 2026-10-18 15:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0002_alter_mailing_options'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mailing',
+            name='queued_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Поставлена в очередь'),
+        ),
+        migrations.AddField(
+            model_name='mailing',
+            name='lease_owner',
+            field=models.CharField(blank=True, max_length=64, null=True, verbose_name='Воркер'),
+        ),
+        migrations.AddField(
+            model_name='mailing',
+            name='lease_until',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Захвачена до'),
+        ),
+        migrations.AddField(
+            model_name='mailing',
+            name='last_recipient_id',
+            field=models.BigIntegerField(default=0, verbose_name='Последний обработанный получатель'),
+        ),
+        migrations.AddField(
+            model_name='mailing',
+            name='sent_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Доставлено'),
+        ),
+        migrations.AddField(
+            model_name='mailing',
+            name='failed_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Не доставлено'),
+        ),
+        migrations.AddField(
+            model_name='mailing',
+            name='finished_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Завершена'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.2.3 on 2026-10-18 16:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0003_mailing_delivery'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mailing',
+            name='media_type',
+            field=models.CharField(blank=True, choices=[('photo', 'Фото'), ('video', 'Видео'), ('animation', 'GIF-анимация'), ('audio', 'Аудио'), ('document', 'Документ')], max_length=16, null=True, verbose_name='Тип медиа'),
+        ),
+        migrations.AddField(
+            model_name='mailing',
+            name='media_file_id',
+            field=models.CharField(blank=True, max_length=255, null=True, verbose_name='file_id медиафайла'),
+        ),
+        migrations.CreateModel(
+            name='MailingAttachment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file', models.FileField(upload_to='mailing/', verbose_name='Файл')),
+                ('media_type', models.CharField(blank=True, choices=[('photo', 'Фото'), ('video', 'Видео'), ('animation', 'GIF-анимация'), ('audio', 'Аудио'), ('document', 'Документ')], max_length=16, null=True, verbose_name='Тип медиа')),
+                ('file_id', models.CharField(blank=True, max_length=255, null=True, verbose_name='file_id')),
+                ('position', models.PositiveSmallIntegerField(default=0, verbose_name='Порядок')),
+                ('mailing', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='attachments', to='mailing.mailing', verbose_name='Рассылка')),
+            ],
+            options={
+                'verbose_name': 'файл альбома',
+                'verbose_name_plural': 'Файлы альбома',
+                'ordering': ('position', 'id'),
+            },
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.2.3 on 2026-10-18 17:00
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY не блокирует запись в таблицу, но не может выполняться в транзакции
+    atomic = False
+
+    dependencies = [
+        ('mailing', '0004_mailing_media_file_id_mailingattachment'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='mailing',
+            index=models.Index(fields=['sent', 'send_at'], name='mailing_sent_send_at_idx'),
+        ),
+    ]
@@ -1,15 +1,60 @@
 from django.db import models
 
+# Тип медиа определяет метод Bot API; пустой - по расширению файла
+MEDIA_TYPE_CHOICES = [
+    ('photo', 'Фото'),
+    ('video', 'Видео'),
+    ('animation', 'GIF-анимация'),
+    ('audio', 'Аудио'),
+    ('document', 'Документ'),
+]
+
 
 class Mailing(models.Model):
     text = models.TextField(blank=True, null=True, verbose_name='Текст сообщения')
     media_file = models.FileField(upload_to='mailing/', blank=True, null=True, verbose_name='Медиафайл')
     send_at = models.DateTimeField(verbose_name='Дата и время отправки')
     sent = models.BooleanField(default=False, verbose_name='Отправлено')
+    media_type = models.CharField(max_length=16, choices=MEDIA_TYPE_CHOICES, blank=True, null=True,
+                                  verbose_name='Тип медиа')
+    # file_id медиафайла в Telegram: файл загружается один раз, всем получателям уходит этот id.
+    # Сбрасывается при замене файла
+    media_file_id = models.CharField(max_length=255, blank=True, null=True, verbose_name='file_id медиафайла')
+    # Доставка: кнопка в админке ставит рассылку в очередь, отправляет воркер бота (bot/mailing.py).
+    # Воркер захватывает рассылку на время lease_until и после каждой пачки получателей
+    # сохраняет контрольную точку, с которой доставка продолжится после сбоя
+    queued_at = models.DateTimeField(blank=True, null=True, verbose_name='Поставлена в очередь')
+    lease_owner = models.CharField(max_length=64, blank=True, null=True, verbose_name='Воркер')
+    lease_until = models.DateTimeField(blank=True, null=True, verbose_name='Захвачена до')
+    last_recipient_id = models.BigIntegerField(default=0, verbose_name='Последний обработанный получатель')
+    sent_count = models.PositiveIntegerField(default=0, verbose_name='Доставлено')
+    failed_count = models.PositiveIntegerField(default=0, verbose_name='Не доставлено')
+    finished_at = models.DateTimeField(blank=True, null=True, verbose_name='Завершена')
 
     class Meta:
         verbose_name = 'рассылку'
         verbose_name_plural = 'Рассылки'
+        # Планировщик бота: WHERE sent = false AND send_at <= now() ORDER BY send_at и min(send_at)
+        indexes = [models.Index(fields=['sent', 'send_at'], name='mailing_sent_send_at_idx')]
 
     def __str__(self):
         return f"Рассылка на {self.send_at}"
+
+
+# Дополнительные файлы альбома: вместе с медиафайлом рассылки уходят одной группой (send_media_group)
+class MailingAttachment(models.Model):
+    mailing = models.ForeignKey(Mailing, on_delete=models.CASCADE, related_name='attachments',
+                                verbose_name='Рассылка')
+    file = models.FileField(upload_to='mailing/', verbose_name='Файл')
+    media_type = models.CharField(max_length=16, choices=MEDIA_TYPE_CHOICES, blank=True, null=True,
+                                  verbose_name='Тип медиа')
+    file_id = models.CharField(max_length=255, blank=True, null=True, verbose_name='file_id')
+    position = models.PositiveSmallIntegerField(default=0, verbose_name='Порядок')
+
+    class Meta:
+        verbose_name = 'файл альбома'
+        verbose_name_plural = 'Файлы альбома'
+        ordering = ('position', 'id')
+
+    def __str__(self):
+        return self.file.name
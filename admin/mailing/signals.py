@@ -0,0 +1,49 @@
+import json
+import logging
+
+from django.db import connection
+from django.db.models.signals import post_save, pre_save
+from django.dispatch import receiver
+
+from .models import Mailing, MailingAttachment
+
+logger = logging.getLogger('mailing')
+
+# Канал Postgres LISTEN/NOTIFY, на который подписаны воркер и планировщик рассылок бота
+MAILING_CHANNEL = 'mailing_changed'
+
+
+# Будит воркер и планировщик рассылок. NOTIFY транзакционен: бот получит его только после коммита;
+# потерянное уведомление не страшно - бот и так периодически проверяет очередь
+def publish_mailing_event(pk: int) -> None:
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_notify(%s, %s)", [MAILING_CHANNEL, json.dumps({'id': pk})])
+    except Exception as e:
+        logger.error(f"Ошибка уведомления о рассылке {pk}: {e}")
+
+
+# Замена файла или его типа делает сохраненный file_id недействительным
+@receiver(pre_save, sender=Mailing)
+def reset_media_file_id(sender, instance, **kwargs):
+    if instance.pk is None or not instance.media_file_id:
+        return
+    old = Mailing.objects.filter(pk=instance.pk).values_list('media_file', 'media_type').first()
+    if old is None or (old[0] or None, old[1]) != (instance.media_file.name or None, instance.media_type):
+        instance.media_file_id = None
+
+
+@receiver(pre_save, sender=MailingAttachment)
+def reset_attachment_file_id(sender, instance, **kwargs):
+    if instance.pk is None or not instance.file_id:
+        return
+    old = MailingAttachment.objects.filter(pk=instance.pk).values_list('file', 'media_type').first()
+    if old != (instance.file.name, instance.media_type):
+        instance.file_id = None
+
+
+# Новая рассылка или измененное время отправки: планировщик пересчитывает, до какого момента спать
+@receiver(post_save, sender=Mailing)
+def mailing_saved(sender, instance, **kwargs):
+    if not instance.sent:
+        publish_mailing_event(instance.pk)
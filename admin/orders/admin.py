@@ -0,0 +1,21 @@
+from django.contrib import admin
+
+from .models import Order, OrderLine
+
+
+class OrderLineInline(admin.TabularInline):
+    model = OrderLine
+    extra = 0
+    readonly_fields = ('product', 'name', 'price', 'quantity')
+    can_delete = False
+
+
+# Заказы создает бот при оформлении, админка только показывает их и позволяет менять статус
+@admin.register(Order)
+class OrderAdmin(admin.ModelAdmin):
+    list_display = ('id', 'user', 'status', 'total', 'currency', 'created_at', 'paid_at')
+    list_filter = ('status', 'created_at')
+    search_fields = ('invoice_payload', 'telegram_payment_charge_id', 'phone', 'user__user_id')
+    readonly_fields = ('user', 'invoice_payload', 'total', 'currency', 'telegram_payment_charge_id',
+                       'provider_payment_charge_id', 'created_at', 'paid_at')
+    inlines = (OrderLineInline,)
@@ -0,0 +1,55 @@
+# Generated by Django 5.2.3 on 2026-10-18 15:00
+
+import django.db.models.deletion
+import django.db.models.functions.datetime
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('products', '0005_product_sku'),
+        ('users', '0005_fsmstate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Order',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('invoice_payload', models.CharField(max_length=128, unique=True, verbose_name='Payload счета')),
+                ('status', models.CharField(choices=[('pending', 'Ожидает оплаты'), ('paid', 'Оплачен'), ('cancelled', 'Отменен')], default='pending', max_length=16, verbose_name='Статус')),
+                ('total', models.DecimalField(decimal_places=2, max_digits=12, verbose_name='Сумма')),
+                ('currency', models.CharField(default='RUB', max_length=3, verbose_name='Валюта')),
+                ('name', models.CharField(max_length=255, verbose_name='Имя')),
+                ('address', models.TextField(verbose_name='Адрес доставки')),
+                ('phone', models.CharField(max_length=64, verbose_name='Телефон')),
+                ('telegram_payment_charge_id', models.CharField(blank=True, max_length=255, null=True, unique=True, verbose_name='ID платежа Telegram')),
+                ('provider_payment_charge_id', models.CharField(blank=True, max_length=255, null=True, verbose_name='ID платежа провайдера')),
+                ('created_at', models.DateTimeField(db_default=django.db.models.functions.datetime.Now(), verbose_name='Создан')),
+                ('paid_at', models.DateTimeField(blank=True, null=True, verbose_name='Оплачен')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='orders', to='users.user', verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'заказ',
+                'verbose_name_plural': 'Заказы',
+            },
+        ),
+        migrations.CreateModel(
+            name='OrderLine',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, verbose_name='Название товара')),
+                ('price', models.DecimalField(decimal_places=2, max_digits=10, verbose_name='Цена')),
+                ('quantity', models.PositiveIntegerField(verbose_name='Количество')),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lines', to='orders.order', verbose_name='Заказ')),
+                ('product', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='products.product', verbose_name='Товар')),
+            ],
+            options={
+                'verbose_name': 'позиция заказа',
+                'verbose_name_plural': 'Позиции заказа',
+            },
+        ),
+    ]
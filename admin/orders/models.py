@@ -0,0 +1,56 @@
+from django.db import models
+from django.db.models.functions import Now
+
+from products.models import Product
+from users.models import User
+
+
+class Order(models.Model):
+    STATUS_PENDING = 'pending'
+    STATUS_PAID = 'paid'
+    STATUS_CANCELLED = 'cancelled'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Ожидает оплаты'),
+        (STATUS_PAID, 'Оплачен'),
+        (STATUS_CANCELLED, 'Отменен'),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.PROTECT, related_name='orders', verbose_name='Пользователь')
+    # payload счета Telegram: по нему заказ находится при pre_checkout_query и successful_payment
+    invoice_payload = models.CharField(max_length=128, unique=True, verbose_name='Payload счета')
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_PENDING, verbose_name='Статус')
+    total = models.DecimalField(max_digits=12, decimal_places=2, verbose_name='Сумма')
+    currency = models.CharField(max_length=3, default='RUB', verbose_name='Валюта')
+    name = models.CharField(max_length=255, verbose_name='Имя')
+    address = models.TextField(verbose_name='Адрес доставки')
+    phone = models.CharField(max_length=64, verbose_name='Телефон')
+    # Уникальность id платежа не дает обработать повторную доставку successful_payment дважды
+    telegram_payment_charge_id = models.CharField(max_length=255, unique=True, blank=True, null=True,
+                                                  verbose_name='ID платежа Telegram')
+    provider_payment_charge_id = models.CharField(max_length=255, blank=True, null=True,
+                                                  verbose_name='ID платежа провайдера')
+    created_at = models.DateTimeField(db_default=Now(), verbose_name='Создан')
+    paid_at = models.DateTimeField(blank=True, null=True, verbose_name='Оплачен')
+
+    class Meta:
+        verbose_name = 'заказ'
+        verbose_name_plural = 'Заказы'
+
+    def __str__(self):
+        return f'Заказ №{self.pk} ({self.get_status_display()})'
+
+
+# Позиция заказа: название и цена фиксируются на момент оформления
+class OrderLine(models.Model):
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='lines', verbose_name='Заказ')
+    product = models.ForeignKey(Product, on_delete=models.SET_NULL, blank=True, null=True, verbose_name='Товар')
+    name = models.CharField(max_length=255, verbose_name='Название товара')
+    price = models.DecimalField(max_digits=10, decimal_places=2, verbose_name='Цена')
+    quantity = models.PositiveIntegerField(verbose_name='Количество')
+
+    class Meta:
+        verbose_name = 'позиция заказа'
+        verbose_name_plural = 'Позиции заказа'
+
+    def __str__(self):
+        return f'{self.name} x {self.quantity}'
@@ -0,0 +1 @@
+# Create your views here.
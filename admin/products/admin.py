@@ -1,6 +1,10 @@
 from django.contrib import admin
+from django.contrib import messages
 
+from .forms import ProductAdminForm
+from .images import ImageIngestionError, store_image, upload_to_telegram
 from .models import Category, SubCategory, Product
+from .signals import publish_catalog_event
 
 admin.site.site_header = "Администрирование бота"  # Заголовок сайта
 admin.site.site_title = "Администрирование"  # Заголовок в панели управления
@@ -22,6 +26,31 @@ class SubCategoryAdmin(admin.ModelAdmin):
 
 @admin.register(Product)
 class ProductAdmin(admin.ModelAdmin):
-    list_display = ('name', 'category', 'subcategory', 'price')
+    form = ProductAdminForm
+    list_display = ('name', 'sku', 'category', 'subcategory', 'price', 'photo_ready')
     list_filter = ('category', 'subcategory')
-    search_fields = ('name', 'description')
+    search_fields = ('name', 'sku', 'description')
+    readonly_fields = ('photo_file_id',)
+
+    # Фото уже загружено в Telegram и отправляется пользователям без задержки
+    @admin.display(boolean=True, description='Фото в Telegram')
+    def photo_ready(self, obj):
+        return bool(obj.photo_file_id) if obj.photo else None
+
+    # Нормализованное фото сохраняется локально и заранее загружается в Telegram
+    def save_model(self, request, obj, form, change):
+        normalized_photo = getattr(form, 'normalized_photo', None)
+        if normalized_photo:
+            obj.photo = store_image(normalized_photo)
+        super().save_model(request, obj, form, change)
+        if not normalized_photo:
+            return
+
+        try:
+            file_id = upload_to_telegram(normalized_photo, obj.photo.rsplit('/', 1)[-1])
+        except ImageIngestionError as e:
+            self.message_user(request, f"Фото сохранено, но не загружено в Telegram: {e}", level=messages.WARNING)
+            return
+        Product.objects.filter(pk=obj.pk, photo=obj.photo).update(photo_file_id=file_id)
+        obj.photo_file_id = file_id
+        publish_catalog_event('product', 'save', obj.pk)
@@ -0,0 +1,102 @@
+import csv
+import io
+import json
+from decimal import Decimal, InvalidOperation
+from typing import Iterable, Iterator, TextIO
+
+# Колонки файла каталога: одна строка - один товар, категории и подкатегории задаются названиями
+FEED_COLUMNS = ('sku', 'category', 'subcategory', 'name', 'description', 'photo', 'price')
+FEED_FORMATS = ('csv', 'jsonl')
+
+# Ограничения полей моделей каталога
+MAX_LENGTHS = {'sku': 64, 'category': 100, 'subcategory': 100, 'name': 255, 'photo': 255}
+MAX_PRICE = Decimal('99999999.99')
+
+
+class FeedRowError(ValueError):
+    pass
+
+
+# Формат по расширению файла, если он не указан явно
+def detect_format(path: str | None, explicit: str | None) -> str:
+    if explicit:
+        return explicit
+    if path and path.endswith(('.jsonl', '.ndjson')):
+        return 'jsonl'
+    return 'csv'
+
+
+# Строки файла по одной: (номер строки, словарь полей) либо (номер строки, ошибка разбора)
+def read_feed(file: TextIO, feed_format: str) -> Iterator[tuple[int, dict | FeedRowError]]:
+    if feed_format == 'csv':
+        reader = csv.DictReader(file)
+        missing = {'sku', 'name', 'category', 'price'} - set(reader.fieldnames or ())
+        if missing:
+            raise FeedRowError(f"В заголовке CSV нет колонок: {', '.join(sorted(missing))}")
+        for row in reader:
+            yield reader.line_num, row
+        return
+
+    for line_number, line in enumerate(file, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield line_number, FeedRowError(f"некорректный JSON: {e}")
+            continue
+        if not isinstance(row, dict):
+            yield line_number, FeedRowError("строка должна быть JSON-объектом")
+            continue
+        yield line_number, row
+
+
+# Проверка и нормализация строки; значения в порядке FEED_COLUMNS
+def clean_row(row: dict) -> tuple:
+    values = {}
+    for column in FEED_COLUMNS:
+        value = row.get(column)
+        value = str(value).strip() if value is not None else ''
+        values[column] = value or None
+
+    for column in ('sku', 'category', 'name', 'price'):
+        if values[column] is None:
+            raise FeedRowError(f"не заполнено поле {column}")
+    for column, max_length in MAX_LENGTHS.items():
+        if values[column] is not None and len(values[column]) > max_length:
+            raise FeedRowError(f"поле {column} длиннее {max_length} символов")
+    try:
+        price = Decimal(values['price'].replace(',', '.')).quantize(Decimal('0.01'))
+    except (InvalidOperation, ValueError):
+        raise FeedRowError(f"некорректная цена {values['price']!r}")
+    if not Decimal(0) <= price <= MAX_PRICE:
+        raise FeedRowError(f"цена вне допустимого диапазона: {price}")
+    values['price'] = str(price)
+    return tuple(values[column] for column in FEED_COLUMNS)
+
+
+# Файлоподобный поток строк CSV для COPY ... FROM STDIN: строки формируются по мере чтения,
+# поэтому память не зависит от размера файла
+class CopyStream(io.TextIOBase):
+    def __init__(self, rows: Iterable[tuple]):
+        self._rows = iter(rows)
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer, lineterminator='\n')
+        self._pending = ''
+
+    def readable(self):
+        return True
+
+    def read(self, size: int = -1) -> str:
+        while size < 0 or len(self._pending) < size:
+            row = next(self._rows, None)
+            if row is None:
+                break
+            self._writer.writerow(row)
+            self._pending += self._buffer.getvalue()
+            self._buffer.seek(0)
+            self._buffer.truncate()
+        if size < 0:
+            size = len(self._pending)
+        chunk, self._pending = self._pending[:size], self._pending[size:]
+        return chunk
@@ -0,0 +1,28 @@
+from django import forms
+
+from .images import ImageIngestionError, load_image_bytes, normalize_image
+from .models import Product
+
+
+class ProductAdminForm(forms.ModelForm):
+    photo_upload = forms.ImageField(required=False, label='Загрузить фото',
+                                    help_text='Файл или URL в поле "Фото" будет приведен к формату для Telegram')
+
+    class Meta:
+        model = Product
+        fields = '__all__'
+
+    # Скачивание и нормализация фото при сохранении; ошибки показываются в форме админки
+    def clean(self):
+        cleaned_data = super().clean()
+        self.normalized_photo = None
+        upload = cleaned_data.get('photo_upload')
+        photo = cleaned_data.get('photo')
+        try:
+            if upload:
+                self.normalized_photo = normalize_image(upload.read())
+            elif photo and 'photo' in self.changed_data:
+                self.normalized_photo = normalize_image(load_image_bytes(photo))
+        except ImageIngestionError as e:
+            self.add_error('photo_upload' if upload else 'photo', str(e))
+        return cleaned_data
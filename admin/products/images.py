@@ -0,0 +1,94 @@
+import hashlib
+import io
+import logging
+import os
+from urllib.request import Request, urlopen
+
+from aiogram import Bot
+from aiogram.types import BufferedInputFile
+from asgiref.sync import async_to_sync
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+logger = logging.getLogger('products')
+
+MAX_SOURCE_SIZE = 20 * 1024 * 1024  # Максимальный размер исходного файла, байт
+MAX_SIDE = 1280  # Максимальная сторона изображения после нормализации, px
+MAX_ASPECT_RATIO = 20  # Telegram не принимает фото с соотношением сторон больше 20
+JPEG_QUALITY = 85
+DOWNLOAD_TIMEOUT = 15
+UPLOAD_DIR = 'products'
+
+
+class ImageIngestionError(Exception):
+    pass
+
+
+# Загружает исходное изображение по URL или из хранилища медиафайлов
+def load_image_bytes(source: str) -> bytes:
+    try:
+        if source.startswith(('http://', 'https://')):
+            request = Request(source, headers={'User-Agent': 'Bot_shop image ingestion'})
+            with urlopen(request, timeout=DOWNLOAD_TIMEOUT) as response:
+                data = response.read(MAX_SOURCE_SIZE + 1)
+        else:
+            with default_storage.open(source, 'rb') as file:
+                data = file.read(MAX_SOURCE_SIZE + 1)
+    except Exception as e:
+        raise ImageIngestionError(f"Не удалось получить изображение {source}: {e}") from e
+    if len(data) > MAX_SOURCE_SIZE:
+        raise ImageIngestionError(f"Изображение больше {MAX_SOURCE_SIZE // (1024 * 1024)} МБ")
+    return data
+
+
+# Приводит изображение к формату для Telegram: JPEG, RGB, сторона не больше MAX_SIDE
+def normalize_image(data: bytes) -> bytes:
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image = ImageOps.exif_transpose(image)
+            if image.mode in ('RGBA', 'LA', 'P'):
+                image = image.convert('RGBA')
+                background = Image.new('RGB', image.size, (255, 255, 255))
+                background.paste(image, mask=image.getchannel('A'))
+                image = background
+            elif image.mode != 'RGB':
+                image = image.convert('RGB')
+            width, height = image.size
+            if max(width, height) / max(min(width, height), 1) > MAX_ASPECT_RATIO:
+                raise ImageIngestionError(f"Недопустимое соотношение сторон изображения: {width}x{height}")
+            image.thumbnail((MAX_SIDE, MAX_SIDE), Image.Resampling.LANCZOS)
+            output = io.BytesIO()
+            image.save(output, format='JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+            return output.getvalue()
+    except (UnidentifiedImageError, OSError, Image.DecompressionBombError) as e:
+        raise ImageIngestionError(f"Файл не является корректным изображением: {e}") from e
+
+
+# Сохраняет нормализованное изображение в медиафайлы; имя по хэшу содержимого исключает дубли
+def store_image(data: bytes) -> str:
+    name = f"{UPLOAD_DIR}/{hashlib.sha256(data).hexdigest()[:32]}.jpg"
+    if not default_storage.exists(name):
+        name = default_storage.save(name, ContentFile(data))
+    return name
+
+
+async def _upload_photo(data: bytes, filename: str) -> str:
+    bot = Bot(token=os.getenv("BOT_TOKEN"))
+    try:
+        message = await bot.send_photo(chat_id=os.getenv("PHOTO_UPLOAD_CHAT_ID"),
+                                       photo=BufferedInputFile(data, filename=filename),
+                                       disable_notification=True)
+        return message.photo[-1].file_id
+    finally:
+        await bot.session.close()
+
+
+# Загружает фото в служебный чат Telegram и возвращает file_id для последующих отправок
+def upload_to_telegram(data: bytes, filename: str) -> str:
+    if not os.getenv("PHOTO_UPLOAD_CHAT_ID"):
+        raise ImageIngestionError("Не задан PHOTO_UPLOAD_CHAT_ID для предварительной загрузки фото")
+    try:
+        return async_to_sync(_upload_photo)(data, filename)
+    except Exception as e:
+        raise ImageIngestionError(f"Не удалось загрузить фото в Telegram: {e}") from e
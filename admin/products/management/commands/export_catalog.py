@@ -0,0 +1,61 @@
+import json
+import sys
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from products.catalog_feed import FEED_COLUMNS, FEED_FORMATS, detect_format
+from products.models import Category, Product, SubCategory
+
+# Товары в формате файла импорта, по возрастанию id
+EXPORT_QUERY = f"""
+    SELECT p.sku, c.name AS category, sc.name AS subcategory, p.name, p.description, p.photo, p.price
+    FROM {Product._meta.db_table} p
+    JOIN {Category._meta.db_table} c ON c.id = p.category_id
+    LEFT JOIN {SubCategory._meta.db_table} sc ON sc.id = p.subcategory_id
+    ORDER BY p.id
+"""
+
+
+class Command(BaseCommand):
+    help = 'Выгрузка каталога в CSV (через COPY) или JSONL в формате import_catalog'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default='-', help='Файл для выгрузки или "-" для stdout')
+        parser.add_argument('--format', choices=FEED_FORMATS, help='Формат файла (по умолчанию - по расширению)')
+        parser.add_argument('--batch-size', type=int, default=2000, help='Строк за одно чтение курсора (JSONL)')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        feed_format = detect_format(path, options['format'])
+        output = sys.stdout if path == '-' else open(path, 'w', encoding='utf-8', newline='')
+        try:
+            # Одна транзакция - согласованный снимок каталога на время выгрузки
+            with transaction.atomic():
+                if feed_format == 'csv':
+                    rows = self.export_csv(output)
+                else:
+                    rows = self.export_jsonl(output, options['batch_size'])
+        finally:
+            if output is not sys.stdout:
+                output.close()
+        self.stderr.write(f"Выгружено товаров: {rows}")
+
+    # COPY ... TO STDOUT: строки идут из Postgres прямо в файл
+    def export_csv(self, output) -> int:
+        with connection.cursor() as cursor:
+            cursor.copy_expert(f"COPY ({EXPORT_QUERY}) TO STDOUT WITH (FORMAT csv, HEADER true)", output)
+            return cursor.rowcount
+
+    # Серверный курсор: в памяти только текущая пачка строк
+    def export_jsonl(self, output, batch_size: int) -> int:
+        rows = 0
+        with connection.chunked_cursor() as cursor:
+            cursor.itersize = batch_size
+            cursor.execute(EXPORT_QUERY)
+            for row in cursor:
+                record = dict(zip(FEED_COLUMNS, row))
+                record['price'] = str(record['price'])
+                output.write(json.dumps(record, ensure_ascii=False) + '\n')
+                rows += 1
+        return rows
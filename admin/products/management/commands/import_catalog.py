@@ -0,0 +1,202 @@
+import itertools
+import logging
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from cart.models import Cart
+from orders.models import OrderLine
+from products.catalog_feed import FEED_COLUMNS, FEED_FORMATS, CopyStream, FeedRowError, clean_row, detect_format, \
+    read_feed
+from products.models import Category, Product, SubCategory
+from products.signals import publish_catalog_event
+
+logger = logging.getLogger('products')
+
+STAGING_TABLE = 'catalog_import'
+
+CREATE_STAGING = f"""
+    CREATE TEMPORARY TABLE {STAGING_TABLE} (
+        line serial,
+        sku text, category text, subcategory text, name text, description text, photo text, price numeric(10, 2)
+    ) ON COMMIT DROP
+"""
+
+# Повторяющиеся названия категорий в БД не ломают импорт: используется категория с меньшим id
+CATEGORY_IDS = f"(SELECT name, min(id) AS id FROM {Category._meta.db_table} GROUP BY name)"
+SUBCATEGORY_IDS = (f"(SELECT category_id, name, min(id) AS id FROM {SubCategory._meta.db_table} "
+                   f"GROUP BY category_id, name)")
+
+INSERT_CATEGORIES = f"""
+    INSERT INTO {Category._meta.db_table} (name)
+    SELECT DISTINCT s.category FROM {STAGING_TABLE} s
+    WHERE NOT EXISTS (SELECT 1 FROM {Category._meta.db_table} c WHERE c.name = s.category)
+"""
+
+INSERT_SUBCATEGORIES = f"""
+    INSERT INTO {SubCategory._meta.db_table} (category_id, name)
+    SELECT DISTINCT c.id, s.subcategory
+    FROM {STAGING_TABLE} s JOIN {CATEGORY_IDS} c ON c.name = s.category
+    WHERE s.subcategory IS NOT NULL AND NOT EXISTS (
+        SELECT 1 FROM {SubCategory._meta.db_table} sc WHERE sc.category_id = c.id AND sc.name = s.subcategory
+    )
+"""
+
+# Один оператор на все товары. При повторе артикула в файле побеждает последняя строка;
+# неизмененные товары не переписываются, смена фото сбрасывает file_id
+UPSERT_PRODUCTS = f"""
+    WITH upserted AS (
+        INSERT INTO {Product._meta.db_table} (sku, category_id, subcategory_id, name, description, photo, price)
+        SELECT DISTINCT ON (s.sku) s.sku, c.id, sc.id, s.name, s.description, s.photo, s.price
+        FROM {STAGING_TABLE} s
+        JOIN {CATEGORY_IDS} c ON c.name = s.category
+        LEFT JOIN {SUBCATEGORY_IDS} sc ON sc.category_id = c.id AND sc.name = s.subcategory
+        ORDER BY s.sku, s.line DESC
+        ON CONFLICT (sku) DO UPDATE SET
+            category_id = excluded.category_id,
+            subcategory_id = excluded.subcategory_id,
+            name = excluded.name,
+            description = excluded.description,
+            photo = excluded.photo,
+            price = excluded.price,
+            photo_file_id = CASE WHEN {Product._meta.db_table}.photo IS DISTINCT FROM excluded.photo
+                                 THEN NULL ELSE {Product._meta.db_table}.photo_file_id END
+        WHERE ({Product._meta.db_table}.category_id, {Product._meta.db_table}.subcategory_id,
+               {Product._meta.db_table}.name, {Product._meta.db_table}.description,
+               {Product._meta.db_table}.photo, {Product._meta.db_table}.price)
+              IS DISTINCT FROM
+              (excluded.category_id, excluded.subcategory_id, excluded.name, excluded.description,
+               excluded.photo, excluded.price)
+        RETURNING xmax = 0 AS inserted
+    )
+    SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted) FROM upserted
+"""
+
+# Товары с артикулом, которых нет в файле. Товары без артикула заведены вручную и не трогаются.
+# on_delete моделей Django выполняется только в Python, поэтому в том же операторе удаляются строки корзин
+# с этими товарами, а позиции заказов отвязываются (как CASCADE и SET_NULL в моделях), иначе внешние ключи
+# сорвали бы коммит всего импорта. Результат: (товаров удалено, строк корзин удалено, позиций заказов отвязано)
+DELETE_MISSING = f"""
+    WITH missing AS (
+        SELECT p.id FROM {Product._meta.db_table} p
+        WHERE p.sku IS NOT NULL AND NOT EXISTS (SELECT 1 FROM {STAGING_TABLE} s WHERE s.sku = p.sku)
+    ), cart_lines AS (
+        DELETE FROM {Cart._meta.db_table} WHERE product_id IN (SELECT id FROM missing) RETURNING 1
+    ), order_lines AS (
+        UPDATE {OrderLine._meta.db_table} SET product_id = NULL WHERE product_id IN (SELECT id FROM missing) RETURNING 1
+    ), deleted AS (
+        DELETE FROM {Product._meta.db_table} WHERE id IN (SELECT id FROM missing) RETURNING 1
+    )
+    SELECT (SELECT count(*) FROM deleted), (SELECT count(*) FROM cart_lines), (SELECT count(*) FROM order_lines)
+"""
+
+
+class Command(BaseCommand):
+    help = ('Массовый импорт каталога из CSV или JSONL: COPY во временную таблицу и пакетное обновление '
+            'категорий, подкатегорий и товаров в одной транзакции')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Файл каталога или "-" для чтения из stdin')
+        parser.add_argument('--format', choices=FEED_FORMATS, help='Формат файла (по умолчанию - по расширению)')
+        parser.add_argument('--prune', action='store_true',
+                            help='Удалить товары с артикулом, которых нет в файле')
+        parser.add_argument('--max-errors', type=int, default=100,
+                            help='Прервать импорт, если ошибочных строк больше (по умолчанию 100, -1 - без лимита)')
+        parser.add_argument('--errors-file', help='Куда записать ошибочные строки (по умолчанию - stderr)')
+        parser.add_argument('--progress-every', type=int, default=10_000, help='Печатать прогресс каждые N строк')
+        parser.add_argument('--dry-run', action='store_true', help='Проверить файл и откатить изменения')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        feed_format = detect_format(path, options['format'])
+        self.max_errors = options['max_errors']
+        self.progress_every = options['progress_every']
+        self.errors = 0
+        self.rows = 0
+        errors_file = open(options['errors_file'], 'w', encoding='utf-8') if options['errors_file'] else None
+        self.errors_out = errors_file or sys.stderr
+        file = sys.stdin if path == '-' else open(path, encoding='utf-8-sig', newline='')
+        try:
+            with transaction.atomic():
+                stats = self.load(file, feed_format, options['prune'])
+                if options['dry_run']:
+                    transaction.set_rollback(True)
+                else:
+                    # Одно событие вместо события на каждый товар; бот получит его после коммита
+                    publish_catalog_event('catalog', 'reload')
+        except FeedRowError as e:
+            raise CommandError(str(e))
+        finally:
+            if file is not sys.stdin:
+                file.close()
+            if errors_file is not None:
+                errors_file.close()
+
+        summary = (f"Импорт каталога{' (пробный, изменения отменены)' if options['dry_run'] else ''}: "
+                   f"строк {self.rows}, ошибок {self.errors}, новых категорий {stats['categories']}, "
+                   f"новых подкатегорий {stats['subcategories']}, товаров добавлено {stats['inserted']}, "
+                   f"обновлено {stats['updated']}, удалено {stats['deleted']}")
+        if stats['cart_lines'] or stats['order_lines']:
+            summary += (f" (из корзин убрано строк {stats['cart_lines']}, "
+                        f"отвязано позиций заказов {stats['order_lines']})")
+        logger.info(summary)
+        self.stdout.write(self.style.SUCCESS(summary))
+
+    # Проверенные строки для COPY; ошибочные пропускаются и выводятся с номером строки
+    def clean_rows(self, file, feed_format: str):
+        try:
+            rows = read_feed(file, feed_format)
+            first = next(rows, None)
+        except FeedRowError as e:
+            self.abort_reason = str(e)
+            raise
+        if first is None:
+            return
+        for line_number, row in itertools.chain([first], rows):
+            self.rows += 1
+            if self.progress_every and self.rows % self.progress_every == 0:
+                self.stdout.write(f"Прочитано строк: {self.rows}, ошибок: {self.errors}")
+            try:
+                if isinstance(row, FeedRowError):
+                    raise row
+                yield clean_row(row)
+            except FeedRowError as e:
+                self.errors += 1
+                self.errors_out.write(f"Строка {line_number}: {e}\n")
+                if 0 <= self.max_errors < self.errors:
+                    self.abort_reason = f"Превышен лимит ошибочных строк ({self.max_errors}), импорт отменен"
+                    raise FeedRowError(self.abort_reason)
+
+    def load(self, file, feed_format: str, prune: bool) -> dict:
+        with connection.cursor() as cursor:
+            cursor.execute(CREATE_STAGING)
+            self.abort_reason = None
+            try:
+                cursor.copy_expert(
+                    f"COPY {STAGING_TABLE} ({', '.join(FEED_COLUMNS)}) FROM STDIN WITH (FORMAT csv)",
+                    CopyStream(self.clean_rows(file, feed_format)),
+                )
+            except FeedRowError:
+                raise
+            except Exception as e:
+                # Ошибка чтения файла прерывает COPY; драйвер может вернуть ее как ошибку запроса
+                if self.abort_reason:
+                    raise FeedRowError(self.abort_reason) from e
+                raise
+            self.stdout.write(f"Загружено во временную таблицу: {self.rows - self.errors} строк")
+            cursor.execute(f"CREATE INDEX ON {STAGING_TABLE} (sku)")
+            cursor.execute(f"ANALYZE {STAGING_TABLE}")
+
+            cursor.execute(INSERT_CATEGORIES)
+            categories = cursor.rowcount
+            cursor.execute(INSERT_SUBCATEGORIES)
+            subcategories = cursor.rowcount
+            cursor.execute(UPSERT_PRODUCTS)
+            inserted, updated = cursor.fetchone()
+            deleted = cart_lines = order_lines = 0
+            if prune:
+                cursor.execute(DELETE_MISSING)
+                deleted, cart_lines, order_lines = cursor.fetchone()
+        return {'categories': categories, 'subcategories': subcategories, 'inserted': inserted,
+                'updated': updated, 'deleted': deleted, 'cart_lines': cart_lines, 'order_lines': order_lines}
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.3 on 2026-10-18 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0002_alter_category_options_alter_product_options_and_more'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='product',
+            name='photo',
+            field=models.CharField(blank=True, max_length=255, null=True, verbose_name='Фото'),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='photo_file_id',
+            field=models.CharField(blank=True, editable=False, max_length=255, null=True, verbose_name='Telegram file_id фото'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.3 on 2026-10-18 12:00
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY не блокирует запись в таблицу, но не может выполняться в транзакции
+    atomic = False
+
+    dependencies = [
+        ('products', '0003_alter_product_photo_product_photo_file_id'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='subcategory',
+            index=models.Index(fields=['category', 'id'], name='subcategory_category_id_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='product',
+            index=models.Index(fields=['subcategory', 'id'], name='product_subcategory_id_idx'),
+        ),
+    ]
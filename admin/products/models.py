@@ -1,3 +1,4 @@
+from django.contrib.postgres.indexes import GinIndex
 from django.db import models
 
 
@@ -24,6 +25,8 @@ class SubCategory(models.Model):
     class Meta:
         verbose_name = 'подкатегорию'
         verbose_name_plural = 'Подкатегории'
+        # Страницы подкатегорий в боте: WHERE category_id = ... AND id > ... ORDER BY id
+        indexes = [models.Index(fields=['category', 'id'], name='subcategory_category_id_idx')]
 
     def __str__(self):
         return self.name
@@ -37,14 +40,26 @@ class Product(models.Model):
                                     verbose_name='Подкатегория',
                                     blank=True,
                                     null=True)
+    # Артикул поставщика: ключ товара при массовом импорте каталога
+    sku = models.CharField(max_length=64, unique=True, blank=True, null=True, verbose_name='Артикул')
     name = models.CharField(max_length=255, verbose_name='Название товара')
     description = models.TextField(blank=True, null=True, verbose_name='Описание')
     photo = models.CharField(max_length=255, blank=True, null=True, verbose_name='Фото')
+    # file_id фото на серверах Telegram, заполняется ботом после первой отправки
+    photo_file_id = models.CharField(max_length=255, blank=True, null=True, editable=False,
+                                     verbose_name='Telegram file_id фото')
     price = models.DecimalField(max_digits=10, decimal_places=2, verbose_name='Цена')
 
     class Meta:
         verbose_name = 'товар'
         verbose_name_plural = 'Товары'
+        # Страницы товаров в боте: WHERE subcategory_id = ... AND id > ... ORDER BY id
+        # Поиск в боте: name/description ILIKE '%слово%' идет по триграммным индексам (расширение pg_trgm)
+        indexes = [
+            models.Index(fields=['subcategory', 'id'], name='product_subcategory_id_idx'),
+            GinIndex(fields=['name'], name='product_name_trgm_idx', opclasses=['gin_trgm_ops']),
+            GinIndex(fields=['description'], name='product_description_trgm_idx', opclasses=['gin_trgm_ops']),
+        ]
 
     def __str__(self):
         return self.name
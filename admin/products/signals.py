@@ -0,0 +1,54 @@
+import json
+import logging
+
+from django.db import connection
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .models import Category, Product, SubCategory
+
+logger = logging.getLogger('products')
+
+# Канал Postgres LISTEN/NOTIFY, на который подписаны процессы бота
+CATALOG_CHANNEL = 'catalog_changed'
+
+MODEL_NAMES = {
+    Category: 'category',
+    SubCategory: 'subcategory',
+    Product: 'product',
+}
+
+
+# Публикует событие изменения каталога. NOTIFY транзакционен: бот получит его только после коммита
+def publish_catalog_event(model: str, action: str, pk: int | None = None) -> None:
+    payload = json.dumps({'model': model, 'action': action, 'id': pk})
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_notify(%s, %s)", [CATALOG_CHANNEL, payload])
+        logger.debug(f"Опубликовано событие каталога: {payload}")
+    except Exception as e:
+        logger.error(f"Ошибка публикации события каталога {payload}: {e}")
+
+
+# Смена фото делает сохраненный file_id недействительным
+@receiver(pre_save, sender=Product)
+def reset_photo_file_id(sender, instance, **kwargs):
+    if instance.pk is None or not instance.photo_file_id:
+        return
+    old_photo = Product.objects.filter(pk=instance.pk).values_list('photo', flat=True).first()
+    if old_photo != instance.photo:
+        instance.photo_file_id = None
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_save, sender=SubCategory)
+@receiver(post_save, sender=Product)
+def catalog_saved(sender, instance, **kwargs):
+    publish_catalog_event(MODEL_NAMES[sender], 'save', instance.pk)
+
+
+@receiver(post_delete, sender=Category)
+@receiver(post_delete, sender=SubCategory)
+@receiver(post_delete, sender=Product)
+def catalog_deleted(sender, instance, **kwargs):
+    publish_catalog_event(MODEL_NAMES[sender], 'delete', instance.pk)
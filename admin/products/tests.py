@@ -1 +1,277 @@
-# Create your tests here.
+import ast
+import importlib
+import io
+import re
+import sys
+import tempfile
+from decimal import Decimal
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+
+from cart.models import Cart
+from mailing.models import Mailing, MailingAttachment
+from orders.models import Order, OrderLine
+from products.models import Category, Product, SubCategory
+from users.models import FSMState, RateLimitBucket, User
+
+# Размер синтетического каталога: на маленьких таблицах планировщик законно выбирает Seq Scan,
+# а такого объема хватает, чтобы составной индекс был заметно дешевле первичного ключа
+CATEGORIES = 20
+SUBCATEGORIES = 2_000
+PRODUCTS = 40_000
+USERS = 5_000
+CART_LINES_PER_USER = 4
+
+# Модели Django, которые вручную повторены в bot/models.py
+MIRRORED_MODELS = (Category, SubCategory, Product, User, Cart, FSMState, RateLimitBucket, Order, OrderLine,
+                   Mailing, MailingAttachment)
+
+# Модели SQLAlchemy бота лежат рядом с админкой
+BOT_DIR = Path(settings.BASE_DIR).parent / 'bot'
+
+
+# Все узлы плана EXPLAIN (FORMAT JSON)
+def plan_nodes(plan: dict):
+    yield plan
+    for child in plan.get('Plans', ()):
+        yield from plan_nodes(child)
+
+
+# Модули бота (bot/models.py, bot/queries.py) импортируются из каталога бота
+def import_bot_module(name: str):
+    if str(BOT_DIR) not in sys.path:
+        sys.path.append(str(BOT_DIR))
+    return importlib.import_module(name)
+
+
+# Горячие запросы бота проверяются по планам: запрос должен идти по своему индексу.
+# Страницы каталога и поиск строятся теми же функциями bot/queries.py, что и в боте
+class BotQueryPlanTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {Category._meta.db_table} (id, name) "
+                f"SELECT i, 'Категория ' || i FROM generate_series(1, {CATEGORIES}) i"
+            )
+            cursor.execute(
+                f"INSERT INTO {SubCategory._meta.db_table} (id, category_id, name) "
+                f"SELECT i, i % {CATEGORIES} + 1, 'Подкатегория ' || i FROM generate_series(1, {SUBCATEGORIES}) i"
+            )
+            cursor.execute(
+                f"INSERT INTO {Product._meta.db_table} (id, category_id, subcategory_id, name, price) "
+                f"SELECT i, (i % {SUBCATEGORIES} + 1) % {CATEGORIES} + 1, i % {SUBCATEGORIES} + 1, "
+                f"'Товар ' || i, 100 + i % 1000 FROM generate_series(1, {PRODUCTS}) i"
+            )
+            cursor.execute(
+                f"INSERT INTO {User._meta.db_table} (id, user_id, is_active) "
+                f"SELECT i, 1000000 + i, true FROM generate_series(1, {USERS}) i"
+            )
+            cursor.execute(
+                f"INSERT INTO {Cart._meta.db_table} (user_id, product_id, quantity, price) "
+                f"SELECT u, (u * 7 + k * 13) % {PRODUCTS} + 1, 1, 100 "
+                f"FROM generate_series(1, {USERS}) u, generate_series(0, {CART_LINES_PER_USER - 1}) k"
+            )
+            for model in (Category, SubCategory, Product, User, Cart):
+                cursor.execute(f"ANALYZE {model._meta.db_table}")
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.queries = import_bot_module('queries')
+        cls.dialect = importlib.import_module('sqlalchemy.dialects.postgresql.psycopg2').dialect()
+
+    def explain(self, sql: str, params=()) -> list[dict]:
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+            result = cursor.fetchone()[0]
+        return list(plan_nodes(result[0]['Plan']))
+
+    # Выражение SQLAlchemy -> (SQL с параметрами psycopg, параметры)
+    def compile(self, stmt) -> tuple[str, dict]:
+        compiled = stmt.compile(dialect=self.dialect)
+        return str(compiled), compiled.params
+
+    # Имя индекса таблицы ровно по этим колонкам (для уникальных ограничений и первичных ключей)
+    def index_on(self, table: str, *columns: str) -> str:
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                SELECT i.relname
+                FROM pg_index x
+                JOIN pg_class i ON i.oid = x.indexrelid
+                WHERE x.indrelid = %s::regclass
+                  AND ARRAY(SELECT a.attname::text
+                            FROM unnest(x.indkey::int2[]) WITH ORDINALITY k(attnum, position)
+                            JOIN pg_attribute a ON a.attrelid = x.indrelid AND a.attnum = k.attnum
+                            ORDER BY k.position) = %s::text[]
+            """, [table, list(columns)])
+            row = cursor.fetchone()
+        self.assertIsNotNone(row, f"нет индекса {table} ({', '.join(columns)})")
+        return row[0]
+
+    # План читает каждую таблицу по ожидаемому индексу: {таблица: имя индекса}
+    def assertUsesIndexes(self, sql: str, params, indexes: dict[str, str]):
+        nodes = self.explain(sql, params)
+        used = {node['Index Name'] for node in nodes if 'Index Name' in node}
+        for table, index in indexes.items():
+            scans = [node['Node Type'] for node in nodes if node.get('Relation Name') == table]
+            self.assertNotIn('Seq Scan', scans, f"Seq Scan по {table}: {nodes}")
+            self.assertIn(index, used, f"{table} читается не по {index}: {nodes}")
+
+    def test_products_page_by_subcategory(self):
+        sql, params = self.compile(self.queries.catalog_page_query('products', 42, 1000, None, 3))
+        self.assertUsesIndexes(sql, params, {Product._meta.db_table: 'product_subcategory_id_idx'})
+
+    def test_products_page_backwards(self):
+        sql, params = self.compile(self.queries.catalog_page_query('products', 42, None, 30_000, 3))
+        self.assertUsesIndexes(sql, params, {Product._meta.db_table: 'product_subcategory_id_idx'})
+
+    def test_products_count_by_subcategory(self):
+        sql, params = self.compile(self.queries.catalog_count_query('products', 42))
+        self.assertUsesIndexes(sql, params, {Product._meta.db_table: 'product_subcategory_id_idx'})
+
+    def test_subcategories_page_by_category(self):
+        sql, params = self.compile(self.queries.catalog_page_query('subcategories', 7, 100, None, 5))
+        self.assertUsesIndexes(sql, params, {SubCategory._meta.db_table: 'subcategory_category_id_idx'})
+
+    def test_user_by_telegram_id(self):
+        user = User._meta.db_table
+        sql, params = self.compile(self.queries.user_internal_id(1_000_123))
+        self.assertUsesIndexes(f"SELECT {sql}", params, {user: self.index_on(user, 'user_id')})
+
+    def test_product_by_id(self):
+        product = Product._meta.db_table
+        self.assertUsesIndexes(self.bot_sql('FETCH_PRODUCT'), (123,), {product: self.index_on(product, 'id')})
+
+    def test_cart_by_user(self):
+        cart, user, product = Cart._meta.db_table, User._meta.db_table, Product._meta.db_table
+        indexes = {cart: self.index_on(cart, 'user_id', 'product_id'), user: self.index_on(user, 'user_id'),
+                   product: self.index_on(product, 'id')}
+        self.assertUsesIndexes(self.bot_sql('FETCH_CART'), (1_000_123,), indexes)
+        sql, params = self.compile(self.queries.cart_query(1_000_123))
+        self.assertUsesIndexes(sql, params, indexes)
+
+    # Поиск в БД (каталог не поместился в снимок): оба ILIKE идут по триграммным индексам, без Seq Scan
+    def test_search_by_trigram_indexes(self):
+        sql, params = self.compile(self.queries.search_query(['12345'], 0, 5))
+        nodes = self.explain(sql, params)
+        used = {node['Index Name'] for node in nodes if 'Index Name' in node}
+        self.assertNotIn('Seq Scan', [node['Node Type'] for node in nodes], nodes)
+        self.assertLessEqual({'product_name_trgm_idx', 'product_description_trgm_idx'}, used, nodes)
+        sql, params = self.compile(self.queries.search_count_query(['12345']))
+        self.assertUsesIndexes(sql, params, {Product._meta.db_table: 'product_name_trgm_idx'})
+
+    # SQL горячих запросов из bot/fastpath.py с параметрами asyncpg ($1) в формате psycopg (%s).
+    # Модуль не импортируется: его соседи (cart.py) совпадают по имени с приложениями Django.
+    @staticmethod
+    def bot_sql(name: str) -> str:
+        tree = ast.parse((BOT_DIR / 'fastpath.py').read_text(encoding='utf-8'))
+        for node in tree.body:
+            if isinstance(node, ast.Assign) and any(getattr(target, 'id', None) == name for target in node.targets):
+                return re.sub(r'\$\d+', '%s', ast.literal_eval(node.value))
+        raise LookupError(name)
+
+
+# Модели SQLAlchemy в bot/models.py повторяют модели Django вручную - проверяем, что они не разошлись
+class BotModelsDriftTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.metadata = import_bot_module('models_base').Base.metadata
+        import_bot_module('models')
+
+    def test_tables_match(self):
+        for model in MIRRORED_MODELS:
+            with self.subTest(model=model.__name__):
+                table = self.metadata.tables[model._meta.db_table]
+                fields = {field.column: field for field in model._meta.concrete_fields}
+                self.assertEqual(set(table.columns.keys()), set(fields))
+                for name, column in table.columns.items():
+                    field = fields[name]
+                    self.assertEqual(column.nullable, field.null, f"nullable {model.__name__}.{name}")
+                    length = getattr(column.type, 'length', None)
+                    if length is not None:
+                        self.assertEqual(length, field.max_length, f"max_length {model.__name__}.{name}")
+
+    def test_indexes_match(self):
+        for model in MIRRORED_MODELS:
+            with self.subTest(model=model.__name__):
+                table = self.metadata.tables[model._meta.db_table]
+                django_indexes = {
+                    index.name: tuple(model._meta.get_field(name).column for name in index.fields)
+                    for index in model._meta.indexes
+                }
+                # ix_* - индексы SQLAlchemy из index=True, в Django им соответствуют первичные ключи
+                bot_indexes = {
+                    index.name: tuple(column.name for column in index.columns)
+                    for index in table.indexes if not index.name.startswith('ix_')
+                }
+                self.assertEqual(bot_indexes, django_indexes)
+
+
+# import_catalog через call_command. Команда сама открывает транзакцию и создает временную таблицу
+# ON COMMIT DROP, поэтому тесты идут в TransactionTestCase: каждый вызов - отдельная транзакция
+class ImportCatalogCommandTests(TransactionTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def import_feed(self, lines: list[str], *args) -> str:
+        path = Path(self.tmp.name) / 'catalog.csv'
+        path.write_text('\n'.join(['sku,category,subcategory,name,description,photo,price', *lines]) + '\n',
+                        encoding='utf-8')
+        out = io.StringIO()
+        call_command('import_catalog', str(path), *args, '--errors-file', str(Path(self.tmp.name) / 'errors.txt'),
+                     stdout=out)
+        return out.getvalue()
+
+    def test_creates_and_updates_catalog(self):
+        self.import_feed(['A1,Молочное,Сыры,Сыр,,,100', 'A2,Молочное,,Молоко,,,79.9'])
+        cheese = Product.objects.get(sku='A1')
+        self.assertEqual(cheese.subcategory.name, 'Сыры')
+        self.assertEqual(cheese.category.name, 'Молочное')
+        self.assertIsNone(Product.objects.get(sku='A2').subcategory)
+
+        output = self.import_feed(['A1,Молочное,Сыры,Сыр,,,120', 'A2,Молочное,,Молоко,,,79.9'])
+        self.assertIn('товаров добавлено 0, обновлено 1', output)
+        self.assertEqual(Product.objects.get(sku='A1').price, Decimal('120'))
+        self.assertEqual(Category.objects.count(), 1)
+
+    def test_dry_run_rolls_back(self):
+        output = self.import_feed(['A1,Молочное,,Сыр,,,100'], '--dry-run')
+        self.assertIn('пробный', output)
+        self.assertFalse(Product.objects.exists())
+        self.assertFalse(Category.objects.exists())
+
+    def test_bad_rows_are_skipped_until_max_errors(self):
+        self.import_feed(['A1,Молочное,,Сыр,,,100', 'A2,Молочное,,Молоко,,,дорого'])
+        self.assertEqual(list(Product.objects.values_list('sku', flat=True)), ['A1'])
+
+        with self.assertRaises(CommandError):
+            self.import_feed(['A3,Молочное,,Кефир,,,50', 'A4,,,Без категории,,,10', 'A5,Молочное,,Йогурт,,,-1'],
+                             '--max-errors', '1')
+        self.assertFalse(Product.objects.filter(sku='A3').exists())
+
+    def test_prune_removes_products_in_carts_and_orders(self):
+        self.import_feed(['A1,Молочное,,Сыр,,,100', 'A2,Молочное,,Молоко,,,80', 'A3,Молочное,,Кефир,,,50'])
+        manual = Product.objects.create(category=Category.objects.get(), name='Без артикула', price=10)
+        user = User.objects.create(user_id=1001)
+        cheese, milk = Product.objects.get(sku='A1'), Product.objects.get(sku='A2')
+        Cart.objects.create(user=user, product=cheese, quantity=2, price=cheese.price)
+        order = Order.objects.create(user=user, invoice_payload='order-1', total=80, name='Иван',
+                                     address='Москва', phone='+7000')
+        line = OrderLine.objects.create(order=order, product=milk, name=milk.name, price=milk.price, quantity=1)
+
+        output = self.import_feed(['A3,Молочное,,Кефир,,,50'], '--prune')
+
+        self.assertIn('удалено 2', output)
+        self.assertEqual(set(Product.objects.values_list('pk', flat=True)),
+                         {manual.pk, Product.objects.get(sku='A3').pk})
+        self.assertFalse(Cart.objects.exists())
+        line.refresh_from_db()
+        self.assertIsNone(line.product_id)
+        self.assertEqual(line.name, 'Молоко')
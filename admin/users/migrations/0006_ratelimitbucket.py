@@ -0,0 +1,25 @@
+# Generated by Django 5.2.3 on 2026-10-18 19:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0005_fsmstate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RateLimitBucket',
+            fields=[
+                ('name', models.CharField(max_length=64, primary_key=True, serialize=False, verbose_name='Лимит')),
+                ('tokens', models.FloatField(verbose_name='Токены')),
+                ('updated_at', models.DateTimeField(verbose_name='Обновлено')),
+            ],
+            options={
+                'verbose_name': 'лимит отправки',
+                'verbose_name_plural': 'Лимиты отправки',
+            },
+        ),
+    ]
@@ -29,3 +29,35 @@ class User(models.Model):
     def delete(self, *args, **kwargs):
         logger.warning(f"Удален пользователь: {self}")
         super().delete(*args, **kwargs)
+
+
+# Состояние FSM бота (aiogram): ключ - бот, чат, пользователь и поток, данные - JSON.
+# Таблицу ведет бот; просроченные записи он удаляет сам
+class FSMState(models.Model):
+    key = models.CharField(max_length=255, primary_key=True, verbose_name='Ключ')
+    state = models.CharField(max_length=255, blank=True, null=True, verbose_name='Состояние')
+    data = models.JSONField(default=dict, verbose_name='Данные')
+    expires_at = models.DateTimeField(db_index=True, verbose_name='Истекает')
+    updated_at = models.DateTimeField(verbose_name='Обновлено')
+
+    class Meta:
+        verbose_name = 'состояние диалога'
+        verbose_name_plural = 'Состояния диалогов'
+
+    def __str__(self):
+        return f"{self.key}: {self.state}"
+
+
+# Общие лимиты исходящих запросов бота (bot/rate_limit.py): остаток токенов ведра на момент updated_at.
+# Одну строку делят все процессы и реплики бота; отрицательный остаток - очередь запросов, взявших токен в долг
+class RateLimitBucket(models.Model):
+    name = models.CharField(max_length=64, primary_key=True, verbose_name='Лимит')
+    tokens = models.FloatField(verbose_name='Токены')
+    updated_at = models.DateTimeField(verbose_name='Обновлено')
+
+    class Meta:
+        verbose_name = 'лимит отправки'
+        verbose_name_plural = 'Лимиты отправки'
+
+    def __str__(self):
+        return f"{self.name}: {self.tokens:.1f}"
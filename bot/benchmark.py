@@ -0,0 +1,74 @@
+"""Сравнение горячих запросов через ORM и через asyncpg (DB_BACKEND=orm / asyncpg).
+
+Запуск на тестовой базе (скрипт добавляет и удаляет товар в корзине пользователя):
+    python benchmark.py --user-id <Telegram ID> --product-id <id товара> --iterations 1000
+"""
+import argparse
+import asyncio
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import database  # noqa: E402
+from fastpath import AsyncpgBackend  # noqa: E402
+
+
+# Средние задержка и процессорное время на вызов, мкс
+async def measure(name: str, call, iterations: int) -> dict:
+    for _ in range(min(iterations, 20)):  # прогрев пулов и кэшей prepared statements
+        await call()
+    wall, cpu = time.perf_counter(), time.process_time()
+    for _ in range(iterations):
+        await call()
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    return {'query': name, 'latency_us': wall / iterations * 1e6, 'cpu_us': cpu / iterations * 1e6}
+
+
+async def run_backend(args) -> list[dict]:
+    results = []
+    async with database.async_session_maker() as session:
+        async def upsert_user():
+            database._seen_users.clear()  # без кэша, каждый вызов идет в БД
+            await database.add_user_if_not_exists(session, args.user_id, "benchmark", "Bench", "Mark")
+
+        results.append(await measure("fetch_product", lambda: database.fetch_product(session, args.product_id),
+                                     args.iterations))
+        results.append(await measure("add_to_cart", lambda: database.add_to_cart(session, args.user_id,
+                                                                                 args.product_id, 1),
+                                     args.iterations))
+        results.append(await measure("fetch_cart", lambda: database.fetch_cart(session, args.user_id),
+                                     args.iterations))
+        results.append(await measure("upsert_user", upsert_user, args.iterations))
+        await database.remove_from_cart(session, args.user_id, args.product_id)
+    return results
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--user-id", type=int, required=True)
+    parser.add_argument("--product-id", type=int, required=True)
+    parser.add_argument("--iterations", type=int, default=1000)
+    args = parser.parse_args()
+
+    # Снимок каталога и движок корзин отключены: сравниваются именно запросы к БД
+    database.catalog_cache.max_items = 0
+    database.cart_engine = None
+
+    database.fastpath = None
+    orm = await run_backend(args)
+    database.fastpath = AsyncpgBackend(database.DATABASE_URL)
+    raw = await run_backend(args)
+    await database.fastpath.close()
+    await database.async_engine.dispose()
+
+    print(f"{'запрос':<15}{'ORM, мкс':>12}{'asyncpg, мкс':>15}{'CPU ORM':>10}{'CPU asyncpg':>13}{'ускорение':>11}")
+    for orm_row, raw_row in zip(orm, raw):
+        print(f"{orm_row['query']:<15}{orm_row['latency_us']:>12.0f}{raw_row['latency_us']:>15.0f}"
+              f"{orm_row['cpu_us']:>10.0f}{raw_row['cpu_us']:>13.0f}"
+              f"{orm_row['latency_us'] / raw_row['latency_us']:>10.1f}x")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1,22 +1,277 @@
 import asyncio
+import json
 import logging
 import os
+import sys
+from contextlib import asynccontextmanager
 
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.fsm.storage.base import BaseStorage
+from aiogram.fsm.storage.memory import MemoryStorage
+
+import metrics
+from rate_limit import RateLimiter, RateLimitMiddleware, SharedTokenBucket
+from sharding import ProcessShards, TaskShards, feed_updates, poll_updates
 
 
 load_dotenv()
 
-bot = Bot(token=os.getenv("BOT_TOKEN"))
-dp = Dispatcher()
+# Адрес Bot API; для локальной проверки вебхука можно указать fake_telegram.py
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+bot = Bot(token=os.getenv("BOT_TOKEN"),
+          session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None)
 
+# Лимиты исходящих сообщений (сообщений в секунду): общий на бота, на личный чат, на группу
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", 30))
+rate_limiter = RateLimiter(
+    global_rate=TELEGRAM_GLOBAL_RATE,
+    chat_rate=float(os.getenv("TELEGRAM_CHAT_RATE", 1)),
+    group_rate=float(os.getenv("TELEGRAM_GROUP_RATE", 20 / 60)),
+)
+bot.session.middleware(RateLimitMiddleware(rate_limiter))
+metrics.register("telegram_rate_limit", rate_limiter.stats)
 
-async def main():
+METRICS_LOG_INTERVAL = float(os.getenv("METRICS_LOG_INTERVAL", 60))  # 0 - не писать метрики в лог
+# Хранилище состояний FSM: postgres - таблица users_fsmstate с LRU в памяти; redis - FSM_REDIS_URL;
+# memory - только память процесса, состояния теряются при перезапуске
+FSM_STORAGE = os.getenv("FSM_STORAGE", "postgres")
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", 86400))
+# Состояния FSM общие для нескольких экземпляров бота (реплики вебхука, несколько процессов с SHARD_MODE=tasks):
+# кэш в памяти сверяется с таблицей при каждом чтении, изменения пишутся сразу
+FSM_SHARED = os.getenv("FSM_SHARED", "false").lower() in ("1", "true", "yes")
+
+# Режим получения апдейтов: polling, webhook или local - апдейты из файла JSON Lines (LOCAL_UPDATES_FILE)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+LOCAL_UPDATES_FILE = os.getenv("LOCAL_UPDATES_FILE", "-")
+# Шарды обработки: апдейты одного пользователя идут строго по порядку в своем шарде.
+# tasks - шарды-задачи в одном процессе; processes - отдельные процессы (по SHARD_WORKER_TASKS задач в каждом)
+SHARD_MODE = os.getenv("SHARD_MODE", "tasks")
+SHARDS = int(os.getenv("SHARDS", 16))
+SHARD_QUEUE_SIZE = int(os.getenv("SHARD_QUEUE_SIZE", 100))
+SHARD_WORKER_TASKS = int(os.getenv("SHARD_WORKER_TASKS", 8))
+# Общий лимит Telegram на все процессы бота - ведро токенов в Postgres (users_ratelimitbucket).
+# В SHARD_MODE=processes включен по умолчанию; нужен и для нескольких реплик вебхука
+# или отдельного процесса рассылок (python mailing.py)
+TELEGRAM_RATE_SHARED = os.getenv("TELEGRAM_RATE_SHARED", str(SHARD_MODE == "processes")).lower() in \
+    ("1", "true", "yes")
+# Воркер рассылок в этом процессе (можно вынести в отдельный процесс: python mailing.py)
+MAILING_WORKER = os.getenv("MAILING_WORKER", "true").lower() in ("1", "true", "yes")
+# Планировщик: ставит рассылки в очередь по send_at; реплики не мешают друг другу
+MAILING_SCHEDULER = os.getenv("MAILING_SCHEDULER", "true").lower() in ("1", "true", "yes")
+MAILING_CONCURRENCY = int(os.getenv("MAILING_CONCURRENCY", 20))
+MAILING_BATCH_SIZE = int(os.getenv("MAILING_BATCH_SIZE", 200))  # получателей между контрольными точками
+# Служебный чат, куда медиафайлы рассылок загружаются один раз для получения file_id
+MAILING_UPLOAD_CHAT_ID = os.getenv("MAILING_UPLOAD_CHAT_ID") or os.getenv("PHOTO_UPLOAD_CHAT_ID")
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "")  # публичный адрес, по которому Telegram достучится до бота
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8080))
+# Сбросить накопившиеся за время простоя апдейты при старте (polling и webhook). По умолчанию выключено:
+# среди них могут быть оплаты (pre_checkout_query, successful_payment), которые нельзя терять
+DROP_PENDING_UPDATES = os.getenv("DROP_PENDING_UPDATES", "false").lower() in ("1", "true", "yes")
+
+logger = logging.getLogger(__name__)
+
+
+# Общий лимит Telegram для процесса, который делит его с shares - 1 другими процессами бота.
+# С TELEGRAM_RATE_SHARED все берут токены из одного ведра в Postgres, и занятый процесс использует
+# простаивающий лимит остальных; без него (и пока база недоступна) процессу достается 1/shares лимита
+def share_rate_limit(shares: int = 1) -> None:
+    if not TELEGRAM_RATE_SHARED:
+        rate_limiter.set_global_rate(TELEGRAM_GLOBAL_RATE / shares)
+        return
+    from database import async_engine
+    rate_limiter.set_global_bucket(SharedTokenBucket(async_engine, f"telegram:{bot.id}", TELEGRAM_GLOBAL_RATE,
+                                                     fallback_rate=TELEGRAM_GLOBAL_RATE / shares))
+
+
+# Периодически пишет в лог метрики пула соединений и кэшей
+async def log_metrics(interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        logger.info(f"Метрики: {json.dumps(metrics.collect(), ensure_ascii=False)}")
+
+
+def create_fsm_storage() -> BaseStorage:
+    if FSM_STORAGE == "memory":
+        return MemoryStorage()
+    from fsm_storage import dump_data, load_data
+    if FSM_STORAGE == "redis":
+        from aiogram.fsm.storage.redis import RedisStorage  # нужен пакет redis
+        return RedisStorage.from_url(os.getenv("FSM_REDIS_URL", "redis://localhost:6379/0"),
+                                     state_ttl=FSM_STATE_TTL, data_ttl=FSM_STATE_TTL,
+                                     json_dumps=dump_data, json_loads=load_data)
+    if FSM_STORAGE != "postgres":
+        raise ValueError(f"Неизвестное хранилище FSM: {FSM_STORAGE}")
+
+    from database import primary_session_maker
+    from fsm_storage import PostgresStateBackend, TieredStorage
+    storage = TieredStorage(
+        PostgresStateBackend(primary_session_maker),
+        ttl=FSM_STATE_TTL,
+        max_entries=int(os.getenv("FSM_MEMORY_MAX_ENTRIES", 10_000)),
+        flush_interval=float(os.getenv("FSM_FLUSH_INTERVAL", 1)),
+        shared=FSM_SHARED,
+    )
+    if BOT_MODE == "webhook" and not FSM_SHARED:
+        logger.warning("FSM_SHARED выключен: при нескольких репликах вебхука состояния FSM расходятся между ними")
+    metrics.register("fsm_storage", storage.stats)
+    return storage
+
+
+# Подписка на изменения каталога из админки
+def start_catalog_listener() -> asyncio.Task:
+    from database import DATABASE_URL, catalog_cache, refresh_catalog_item
+    from notifications import PgListener
+
+    listener = PgListener(DATABASE_URL)
+    listener.subscribe("catalog_changed", refresh_catalog_item)
+    # После (пере)подключения сбрасываем снимок: события за время разрыва могли потеряться
+    listener.on_connect(catalog_cache.invalidate)
+    return asyncio.create_task(listener.run())
+
+
+# Воркер и планировщик рассылок и подписка на уведомления админки об изменениях рассылок
+async def start_mailing_worker():
+    from database import DATABASE_URL, async_session_maker, primary_session_maker
+    from handlers import MEDIA_ROOT
+    from mailing import MAILING_CHANNEL, MailingEngine, MailingScheduler
+    from notifications import PgListener
+
+    engine = MailingEngine(bot, primary_session_maker, async_session_maker, media_root=MEDIA_ROOT,
+                           upload_chat_id=MAILING_UPLOAD_CHAT_ID, concurrency=MAILING_CONCURRENCY,
+                           batch_size=MAILING_BATCH_SIZE)
+    metrics.register("mailing", engine.stats)
+    services = [engine]
+    if MAILING_SCHEDULER:
+        scheduler = MailingScheduler(primary_session_maker, engine)
+        metrics.register("mailing_scheduler", scheduler.stats)
+        services.append(scheduler)
+
+    def wakeup() -> None:
+        for service in services:
+            service.wakeup()
+
+    async def handle_notification(event: dict) -> None:
+        wakeup()
+
+    listener = PgListener(DATABASE_URL)
+    listener.subscribe(MAILING_CHANNEL, handle_notification)
+    # Уведомления за время разрыва могли потеряться - проверяем рассылки сразу после подключения
+    listener.on_connect(wakeup)
+    for service in services:
+        await service.start()
+    return services, asyncio.create_task(listener.run())
+
+
+async def stop_mailing_worker(mailing) -> None:
+    if mailing is None:
+        return
+    services, listener_task = mailing
+    listener_task.cancel()
+    for service in services:
+        await service.close()
+
+
+# Диспетчер со всеми ресурсами процесса: хранилище FSM, движок корзин, подписка на каталог, метрики
+@asynccontextmanager
+async def dispatcher_runtime():
+    from database import async_session_maker, cart_engine, fastpath, is_sticky_to_primary
+    from fsm_storage import TieredStorage
     from handlers import router
+    from middlewares import DbSessionMiddleware
+    storage = create_fsm_storage()
+    dp = Dispatcher(storage=storage)
+    dp.update.outer_middleware(DbSessionMiddleware(async_session_maker, is_primary=is_sticky_to_primary))
     dp.include_router(router)
-    await bot.send_message(490243009, "Здарова!")
-    await dp.start_polling(bot, skip_updates=True)
+    if cart_engine is not None:
+        await cart_engine.start()
+    if isinstance(storage, TieredStorage):
+        await storage.start()
+    tasks = [start_catalog_listener()]
+    if METRICS_LOG_INTERVAL:
+        tasks.append(asyncio.create_task(log_metrics(METRICS_LOG_INTERVAL)))
+    try:
+        yield dp
+    finally:
+        for task in tasks:
+            task.cancel()
+        await storage.close()
+        if cart_engine is not None:
+            await cart_engine.close()
+        if fastpath is not None:
+            await fastpath.close()
+
+
+# Типы апдейтов, на которые есть обработчики
+def used_update_types() -> list[str]:
+    from handlers import router
+    return router.resolve_used_update_types()
+
+
+# Получение апдейтов в выбранном режиме и раздача их по шардам
+async def receive_updates(shards: TaskShards | ProcessShards) -> None:
+    allowed_updates = used_update_types()
+    if DROP_PENDING_UPDATES and BOT_MODE != "local":
+        logger.warning("DROP_PENDING_UPDATES: накопившиеся в Telegram апдейты будут сброшены")
+    if BOT_MODE == "webhook":
+        from webhook import WebhookServer, run_webhook
+        if not WEBHOOK_BASE_URL:
+            raise ValueError("Для BOT_MODE=webhook нужен WEBHOOK_BASE_URL")
+        if not WEBHOOK_SECRET:
+            logger.warning("WEBHOOK_SECRET не задан: запросы к вебхуку не проверяются")
+        server = WebhookServer(bot, shards, path=WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+        metrics.register("webhook", server.stats)
+        await run_webhook(server, WEBHOOK_BASE_URL, WEBHOOK_HOST, WEBHOOK_PORT, allowed_updates,
+                          drop_pending_updates=DROP_PENDING_UPDATES)
+    elif BOT_MODE == "local":
+        with open(LOCAL_UPDATES_FILE, encoding="utf-8") if LOCAL_UPDATES_FILE != "-" else sys.stdin as updates:
+            fed = await feed_updates(bot, shards, updates)
+        logger.info(f"Локально подано апдейтов: {fed}")
+    else:
+        await bot.delete_webhook(drop_pending_updates=DROP_PENDING_UPDATES)
+        await poll_updates(bot, shards, allowed_updates)
+
+
+async def main():
+    from database import check_connection_budget
+    # Пулы соединений есть в каждом процессе: проверяем, что все вместе укладываются в DB_MAX_CONNECTIONS
+    check_connection_budget()
+    if SHARD_MODE == "processes":
+        # Этот процесс только принимает апдейты; обработка - в процессах-шардах со своими ресурсами.
+        # Рассылки отправляются отсюда: общий лимит делится с шардами
+        share_rate_limit(SHARDS + 1)
+        shards = ProcessShards(SHARDS, queue_size=SHARD_QUEUE_SIZE, worker_tasks=SHARD_WORKER_TASKS)
+        metrics.register("shards", shards.stats)
+        await shards.start()
+        metrics_task = asyncio.create_task(log_metrics(METRICS_LOG_INTERVAL)) if METRICS_LOG_INTERVAL else None
+        mailing = await start_mailing_worker() if MAILING_WORKER else None
+        await bot.send_message(490243009, "Здарова!")
+        try:
+            await receive_updates(shards)
+        finally:
+            if metrics_task is not None:
+                metrics_task.cancel()
+            await stop_mailing_worker(mailing)
+            await shards.close()
+        return
+
+    share_rate_limit()
+    async with dispatcher_runtime() as dp:
+        shards = TaskShards(dp, bot, SHARDS, queue_size=SHARD_QUEUE_SIZE)
+        metrics.register("shards", shards.stats)
+        await shards.start()
+        mailing = await start_mailing_worker() if MAILING_WORKER else None
+        await bot.send_message(490243009, "Здарова!")
+        try:
+            await receive_updates(shards)
+        finally:
+            await stop_mailing_worker(mailing)
+            await shards.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,29 @@
+from dataclasses import dataclass
+from decimal import Decimal
+from typing import NamedTuple
+
+
+# Строка корзины: легкий неизменяемый кортеж вместо ORM-объекта
+class CartLine(NamedTuple):
+    product_id: int
+    name: str
+    price: Decimal
+    quantity: int
+    photo: str | None
+    line_total: Decimal
+
+
+# Корзина пользователя с итоговой суммой
+@dataclass(frozen=True, slots=True)
+class CartView:
+    lines: tuple[CartLine, ...] = ()
+    total: Decimal = Decimal(0)
+
+    def __bool__(self):
+        return bool(self.lines)
+
+
+# Текст позиций корзины с итогом
+def format_cart(cart: CartView) -> str:
+    text = "".join(f"{line.name} x {line.quantity} - {line.line_total} руб.\n" for line in cart.lines)
+    return text + f"\n<b>Итого: {cart.total} руб.</b>"
@@ -0,0 +1,337 @@
+import asyncio
+import json
+import logging
+import os
+import weakref
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from decimal import Decimal
+from typing import Awaitable, Callable, Iterable
+
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from cart import CartLine, CartView
+from catalog import ProductItem
+from models import Cart, User
+
+logger = logging.getLogger(__name__)
+
+# Содержимое корзины: id товара -> (количество, цена на момент добавления)
+CartItems = dict[int, tuple[int, Decimal]]
+ProductLookup = Callable[[Iterable[int]], Awaitable[dict[int, ProductItem]]]
+
+# Режимы надежности:
+# write_through - каждое изменение сразу пишется в БД, из памяти только чтение;
+# write_behind - изменения сбрасываются в БД пакетами раз в flush_interval, при падении теряются;
+# journal - как write_behind, но каждое изменение дописывается в локальный журнал и восстанавливается при старте
+DURABILITY_MODES = ("write_through", "write_behind", "journal")
+
+
+# Хранилище рабочего набора корзин. Реализация по умолчанию - в памяти процесса
+class CartStore(ABC):
+    @abstractmethod
+    async def get(self, user_id: int) -> CartItems | None:
+        ...
+
+    @abstractmethod
+    async def set(self, user_id: int, items: CartItems) -> None:
+        ...
+
+    @abstractmethod
+    async def discard(self, user_id: int) -> None:
+        ...
+
+
+# Корзины в памяти процесса с вытеснением давно не использованных; is_pinned защищает несохраненные
+class InMemoryCartStore(CartStore):
+    def __init__(self, max_users: int = 100_000, is_pinned: Callable[[int], bool] = lambda user_id: False):
+        self.max_users = max_users
+        self.is_pinned = is_pinned
+        self._carts: OrderedDict[int, CartItems] = OrderedDict()
+
+    async def get(self, user_id: int) -> CartItems | None:
+        items = self._carts.get(user_id)
+        if items is not None:
+            self._carts.move_to_end(user_id)
+        return items
+
+    async def set(self, user_id: int, items: CartItems) -> None:
+        self._carts[user_id] = items
+        self._carts.move_to_end(user_id)
+        if len(self._carts) > self.max_users:
+            for candidate in list(self._carts):
+                if len(self._carts) <= self.max_users:
+                    break
+                if candidate != user_id and not self.is_pinned(candidate):
+                    del self._carts[candidate]
+
+    async def discard(self, user_id: int) -> None:
+        self._carts.pop(user_id, None)
+
+    def __len__(self):
+        return len(self._carts)
+
+
+# Журнал изменений корзин (JSON Lines). Записи содержат итоговое состояние позиции,
+# поэтому повторное применение уже сохраненных в БД записей безопасно.
+class CartJournal:
+    def __init__(self, path: str):
+        self.path = path
+        self.flushing_path = f"{path}.flushing"
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8")
+
+    def write(self, user_id: int, product_id: int | None, quantity: int, price: Decimal | None) -> None:
+        record = {"user": user_id, "product": product_id, "quantity": quantity,
+                  "price": str(price) if price is not None else None}
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    # Перед сбросом текущий журнал откладывается; после успешного сброса отложенный удаляется
+    def rotate(self) -> None:
+        if os.path.exists(self.flushing_path):
+            return  # предыдущий сброс не удался - его записи еще нужны
+        self._file.close()
+        if os.path.exists(self.path):
+            os.replace(self.path, self.flushing_path)
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def commit(self) -> None:
+        if os.path.exists(self.flushing_path):
+            os.remove(self.flushing_path)
+
+    # Записи в порядке появления: сначала отложенный журнал, затем текущий
+    def replay(self) -> list[dict]:
+        records = []
+        for path in (self.flushing_path, self.path):
+            if not os.path.exists(path):
+                continue
+            with open(path, encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        logger.warning(f"Пропущена поврежденная запись журнала корзин: {line!r}")
+        return records
+
+    def close(self) -> None:
+        self._file.close()
+
+
+# Корзины с рабочим набором в памяти и отложенной пакетной записью в cart_cart.
+# Рассчитан на то, что апдейты одного пользователя обрабатывает один процесс бота.
+class CartEngine:
+    def __init__(self, session_maker: async_sessionmaker, product_lookup: ProductLookup,
+                 durability: str = "write_behind", flush_interval: float = 2, flush_batch_size: int = 1000,
+                 max_users: int = 100_000, journal_path: str | None = None):
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f"Неизвестный режим надежности корзин: {durability}")
+        if durability == "journal" and not journal_path:
+            raise ValueError("Для режима journal нужен путь к журналу")
+        self.session_maker = session_maker
+        self.product_lookup = product_lookup
+        self.durability = durability
+        self.flush_interval = flush_interval
+        self.flush_batch_size = flush_batch_size
+        self._dirty: dict[int, int] = {}  # пользователь -> номер последнего изменения
+        self._revision = 0
+        # Блокировки по пользователю живут, пока их кто-то удерживает или ждет
+        self._locks: weakref.WeakValueDictionary[int, asyncio.Lock] = weakref.WeakValueDictionary()
+        self._flush_lock = asyncio.Lock()
+        self.store = InMemoryCartStore(max_users, is_pinned=lambda user_id: user_id in self._dirty)
+        self.journal = CartJournal(journal_path) if durability == "journal" else None
+        self._task: asyncio.Task | None = None
+        self.flushes = 0
+        self.flush_errors = 0
+        self.loads = 0
+
+    def _lock(self, user_id: int) -> asyncio.Lock:
+        lock = self._locks.get(user_id)
+        if lock is None:
+            lock = self._locks[user_id] = asyncio.Lock()
+        return lock
+
+    async def _load_from_db(self, user_id: int) -> CartItems:
+        self.loads += 1
+        async with self.session_maker() as session:
+            stmt = (select(Cart.product_id, Cart.quantity, Cart.price)
+                    .join(User, User.id == Cart.user_id)
+                    .where(User.user_id == user_id))
+            rows = (await session.execute(stmt)).all()
+        return {row.product_id: (row.quantity, row.price) for row in rows}
+
+    async def _items(self, user_id: int) -> CartItems:
+        items = await self.store.get(user_id)
+        if items is None:
+            items = await self._load_from_db(user_id)
+            await self.store.set(user_id, items)
+        return items
+
+    # Применяет изменение к копии корзины и фиксирует его согласно режиму надежности.
+    # False - в write_through запись в БД не удалась, корзина в памяти остается прежней
+    async def _mutate(self, user_id: int, changes: dict[int, tuple[int, Decimal] | None],
+                      clear: bool = False) -> bool:
+        items = {} if clear else dict(await self._items(user_id))
+        for product_id, value in changes.items():
+            if value is None:
+                items.pop(product_id, None)
+            else:
+                items[product_id] = value
+        if self.durability == "write_through":
+            try:
+                saved = await self._write_carts({user_id: items})
+            except Exception as e:
+                self.flush_errors += 1
+                logger.error(f"Ошибка записи корзины пользователя {user_id} в БД: {e}")
+                return False
+            if saved:
+                await self.store.set(user_id, items)
+            return bool(saved)
+        if self.journal is not None:
+            if clear:
+                self.journal.write(user_id, None, 0, None)
+            for product_id, value in changes.items():
+                quantity, price = value if value is not None else (0, None)
+                self.journal.write(user_id, product_id, quantity, price)
+        await self.store.set(user_id, items)
+        self._revision += 1
+        self._dirty[user_id] = self._revision
+        return True
+
+    async def add(self, user_id: int, product_id: int, quantity: int) -> bool:
+        async with self._lock(user_id):
+            items = await self._items(user_id)
+            if product_id in items:
+                current, price = items[product_id]
+            else:
+                product = (await self.product_lookup([product_id])).get(product_id)
+                if product is None:
+                    logger.error(f"Товар с ID {product_id} не найден.")
+                    return False
+                current, price = 0, product.price
+            return await self._mutate(user_id, {product_id: (current + quantity, price)})
+
+    async def remove(self, user_id: int, product_id: int) -> bool:
+        async with self._lock(user_id):
+            return await self._mutate(user_id, {product_id: None})
+
+    async def clear(self, user_id: int) -> bool:
+        async with self._lock(user_id):
+            return await self._mutate(user_id, {}, clear=True)
+
+    async def view(self, user_id: int) -> CartView:
+        items = await self._items(user_id)
+        if not items:
+            return CartView()
+        products = await self.product_lookup(items)
+        lines = []
+        for product_id, (quantity, _) in sorted(items.items()):
+            product = products.get(product_id)
+            if product is None:
+                continue  # товар удален из каталога
+            lines.append(CartLine(product_id, product.name, product.price, quantity, product.photo,
+                                  product.price * quantity))
+        return CartView(lines=tuple(lines), total=sum((line.line_total for line in lines), Decimal(0)))
+
+    # Пакетная запись измененных корзин: для каждой корзины ее строки в cart_cart заменяются целиком
+    async def flush(self) -> int:
+        async with self._flush_lock:
+            if not self._dirty:
+                return 0
+            dirty = dict(self._dirty)
+            if self.journal is not None:
+                self.journal.rotate()
+            try:
+                for offset in range(0, len(dirty), self.flush_batch_size):
+                    batch = list(dirty)[offset:offset + self.flush_batch_size]
+                    await self._write_batch(batch)
+            except Exception as e:
+                self.flush_errors += 1
+                logger.error(f"Ошибка сброса корзин в БД ({len(dirty)} шт.): {e}")
+                return 0
+            # Корзины, измененные во время записи, остаются помеченными до следующего сброса
+            for user_id, revision in dirty.items():
+                if self._dirty.get(user_id) == revision:
+                    del self._dirty[user_id]
+            if self.journal is not None:
+                self.journal.commit()
+            self.flushes += 1
+            logger.debug(f"Сброшено корзин в БД: {len(dirty)}")
+            return len(dirty)
+
+    async def _write_batch(self, user_ids: list[int]) -> None:
+        await self._write_carts({user_id: dict(await self.store.get(user_id) or {}) for user_id in user_ids})
+
+    # Замена строк cart_cart для переданных корзин одной транзакцией; возвращает сохраненных пользователей
+    async def _write_carts(self, carts: dict[int, CartItems]) -> set[int]:
+        user_ids = list(carts)
+        async with self.session_maker() as session:
+            users = dict((await session.execute(
+                select(User.user_id, User.id).where(User.user_id.in_(user_ids))
+            )).all())
+            missing = set(user_ids) - set(users)
+            if missing:
+                logger.error(f"Корзины пользователей {sorted(missing)} не сохранены: пользователи не найдены")
+            rows = [
+                {'user_id': users[user_id], 'product_id': product_id, 'quantity': quantity, 'price': price}
+                for user_id, items in carts.items() if user_id in users
+                for product_id, (quantity, price) in items.items()
+            ]
+            await session.execute(delete(Cart).where(Cart.user_id.in_(list(users.values()))))
+            if rows:
+                await session.execute(pg_insert(Cart).values(rows))
+            await session.commit()
+        return set(users)
+
+    # Восстановление после падения: изменения из журнала применяются к корзинам из БД и сохраняются
+    async def recover(self) -> None:
+        if self.journal is None:
+            return
+        records = self.journal.replay()
+        if not records:
+            return
+        for record in records:
+            user_id = record["user"]
+            items = await self._items(user_id)
+            if record["product"] is None:
+                items = {}
+            elif record["quantity"] > 0:
+                items = {**items, record["product"]: (record["quantity"], Decimal(record["price"]))}
+            else:
+                items = {key: value for key, value in items.items() if key != record["product"]}
+            await self.store.set(user_id, items)
+            self._revision += 1
+            self._dirty[user_id] = self._revision
+        logger.info(f"Восстановлено из журнала изменений корзин: {len(records)}")
+        await self.flush()
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def start(self) -> None:
+        await self.recover()
+        if self.durability != "write_through":
+            self._task = asyncio.create_task(self._flush_loop())
+
+    # Остановка: последний сброс несохраненных изменений
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+        await self.flush()
+        if self.journal is not None:
+            self.journal.close()
+
+    def stats(self) -> dict:
+        return {
+            'durability': self.durability,
+            'carts_in_memory': len(self.store),
+            'dirty': len(self._dirty),
+            'loads': self.loads,
+            'flushes': self.flushes,
+            'flush_errors': self.flush_errors,
+        }
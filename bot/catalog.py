@@ -0,0 +1,322 @@
+import asyncio
+import logging
+import time
+from bisect import bisect_left
+from dataclasses import dataclass, field, replace
+from decimal import Decimal
+from types import MappingProxyType
+from typing import Awaitable, Callable, Mapping
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True, slots=True)
+class CategoryItem:
+    id: int
+    name: str
+    description: str | None
+
+    def __str__(self):
+        return self.name
+
+
+@dataclass(frozen=True, slots=True)
+class SubCategoryItem:
+    id: int
+    category_id: int
+    name: str
+    description: str | None
+
+    def __str__(self):
+        return self.name
+
+
+@dataclass(frozen=True, slots=True)
+class ProductItem:
+    id: int
+    category_id: int
+    subcategory_id: int | None
+    name: str
+    description: str | None
+    photo: str | None
+    price: Decimal
+    photo_file_id: str | None = None
+
+    def __str__(self):
+        return self.name
+
+
+# Неизменяемый снимок каталога: дерево категория -> подкатегория -> товар с индексами по id
+@dataclass(frozen=True)
+class CatalogSnapshot:
+    version: int
+    categories: tuple[CategoryItem, ...]
+    categories_by_id: Mapping[int, CategoryItem]
+    subcategories_by_id: Mapping[int, SubCategoryItem]
+    subcategories_by_category: Mapping[int, tuple[SubCategoryItem, ...]]
+    products_by_id: Mapping[int, ProductItem]
+    products_by_subcategory: Mapping[int, tuple[ProductItem, ...]]
+    created_at: float = field(default_factory=time.monotonic)
+
+    @classmethod
+    def build(cls, version: int, categories: list[CategoryItem], subcategories: list[SubCategoryItem],
+              products: list[ProductItem]) -> "CatalogSnapshot":
+        categories = sorted(categories, key=lambda item: item.id)
+        subcategories = sorted(subcategories, key=lambda item: item.id)
+        products = sorted(products, key=lambda item: item.id)
+
+        subcategories_by_category: dict[int, list[SubCategoryItem]] = {}
+        for subcategory in subcategories:
+            subcategories_by_category.setdefault(subcategory.category_id, []).append(subcategory)
+
+        products_by_subcategory: dict[int, list[ProductItem]] = {}
+        for product in products:
+            if product.subcategory_id is not None:
+                products_by_subcategory.setdefault(product.subcategory_id, []).append(product)
+
+        return cls(
+            version=version,
+            categories=tuple(categories),
+            categories_by_id=MappingProxyType({item.id: item for item in categories}),
+            subcategories_by_id=MappingProxyType({item.id: item for item in subcategories}),
+            subcategories_by_category=MappingProxyType(
+                {key: tuple(items) for key, items in subcategories_by_category.items()}
+            ),
+            products_by_id=MappingProxyType({item.id: item for item in products}),
+            products_by_subcategory=MappingProxyType(
+                {key: tuple(items) for key, items in products_by_subcategory.items()}
+            ),
+        )
+
+    # Новый снимок с изменениями [(модель, id, запись или None - удалена)]. Копируются только затронутые
+    # словари и кортежи дочерних записей затронутых родителей; остальное берется из текущего снимка
+    def patched(self, version: int, changes: list[tuple[str, int, object]]) -> "CatalogSnapshot":
+        patch = _SnapshotPatch(self)
+        for model, pk, item in changes:
+            if model == 'category':
+                patch.set_category(pk, item)
+            elif model == 'subcategory':
+                patch.set_subcategory(pk, item)
+            elif model == 'product':
+                patch.set_product(pk, item)
+            else:
+                raise ValueError(f"Неизвестная модель каталога: {model}")
+        # Точечное обновление не продлевает TTL снимка (created_at сохраняется)
+        return replace(self, version=version, categories=patch.categories,
+                       **{name: MappingProxyType(mapping) for name, mapping in patch.copies.items()})
+
+    @property
+    def size(self) -> int:
+        return len(self.categories_by_id) + len(self.subcategories_by_id) + len(self.products_by_id)
+
+
+def _without(items: tuple, pk: int) -> tuple:
+    return tuple(item for item in items if item.id != pk)
+
+
+# Вставка с сохранением порядка по id
+def _with(items: tuple, item) -> tuple:
+    items = _without(items, item.id)
+    index = bisect_left(items, item.id, key=lambda existing: existing.id)
+    return items[:index] + (item,) + items[index:]
+
+
+# Изменения поверх снимка: словарь копируется при первом изменении, дочерние кортежи - только у затронутых
+# родителей. Удаление родителя каскадно удаляет дочерние записи, как в БД
+class _SnapshotPatch:
+    def __init__(self, snapshot: CatalogSnapshot):
+        self.snapshot = snapshot
+        self.categories = snapshot.categories
+        self.copies: dict[str, dict] = {}
+
+    def edit(self, name: str) -> dict:
+        if name not in self.copies:
+            self.copies[name] = dict(getattr(self.snapshot, name))
+        return self.copies[name]
+
+    def _current(self, name: str) -> Mapping:
+        return self.copies.get(name, getattr(self.snapshot, name))
+
+    def _unlink(self, groups_name: str, parent_id: int | None, pk: int) -> None:
+        if parent_id is None or parent_id not in self._current(groups_name):
+            return
+        groups = self.edit(groups_name)
+        children = _without(groups[parent_id], pk)
+        if children:
+            groups[parent_id] = children
+        else:
+            del groups[parent_id]
+
+    def _link(self, groups_name: str, parent_id: int | None, item) -> None:
+        if parent_id is None:
+            return
+        groups = self.edit(groups_name)
+        groups[parent_id] = _with(groups.get(parent_id, ()), item)
+
+    def set_category(self, pk: int, item: CategoryItem | None) -> None:
+        self.edit('categories_by_id').pop(pk, None)
+        self.categories = _without(self.categories, pk)
+        if item is not None:
+            self.copies['categories_by_id'][pk] = item
+            self.categories = _with(self.categories, item)
+            return
+        for subcategory in self._current('subcategories_by_category').get(pk, ()):
+            self.set_subcategory(subcategory.id, None)
+        # Товары категории без подкатегории есть только в общем словаре; удаление категории - редкое событие
+        for product in [product for product in self._current('products_by_id').values() if product.category_id == pk]:
+            self.set_product(product.id, None)
+
+    def set_subcategory(self, pk: int, item: SubCategoryItem | None) -> None:
+        old = self._current('subcategories_by_id').get(pk)
+        if old is not None:
+            self.edit('subcategories_by_id').pop(pk)
+            self._unlink('subcategories_by_category', old.category_id, pk)
+        if item is not None:
+            self.edit('subcategories_by_id')[pk] = item
+            self._link('subcategories_by_category', item.category_id, item)
+            return
+        for product in self._current('products_by_subcategory').get(pk, ()):
+            self.set_product(product.id, None)
+
+    def set_product(self, pk: int, item: ProductItem | None) -> None:
+        old = self._current('products_by_id').get(pk)
+        if old is not None:
+            self.edit('products_by_id').pop(pk)
+            self._unlink('products_by_subcategory', old.subcategory_id, pk)
+        if item is not None:
+            self.edit('products_by_id')[pk] = item
+            self._link('products_by_subcategory', item.subcategory_id, item)
+
+
+# Загрузчик возвращает (категории, подкатегории, товары) либо None, если каталог превысил лимит
+CatalogLoader = Callable[[int], Awaitable[tuple[list, list, list] | None]]
+
+
+# Кэш снимка каталога в памяти процесса: TTL, явная инвалидация, ограничение размера.
+# События изменений копятся patch_delay секунд и применяются к снимку одним обновлением;
+# всплеск больше max_pending событий (массовое удаление в админке) сбрасывает снимок целиком
+class CatalogCache:
+    def __init__(self, loader: CatalogLoader, ttl: float = 300, max_items: int = 50_000, patch_delay: float = 0.05,
+                 max_pending: int = 500):
+        self._loader = loader
+        self.ttl = ttl  # 0 - без TTL, только явная инвалидация
+        self.max_items = max_items
+        self.patch_delay = patch_delay  # 0 - применять каждое событие сразу
+        self.max_pending = max_pending
+        self._snapshot: CatalogSnapshot | None = None
+        self._version = 0
+        self._lock = asyncio.Lock()
+        # (модель, id) -> запись или None; порядок - порядок последних событий
+        self._pending: dict[tuple[str, int], object] = {}
+        self._pending_timer: asyncio.TimerHandle | None = None
+        self.hits = 0
+        self.misses = 0
+        self.rebuilds = 0
+        self.oversized = 0
+        self.patches = 0
+        self.patched_items = 0
+        # Версия и время последней попытки, когда каталог не поместился в лимит
+        self._oversized_version = -1
+        self._oversized_at = 0.0
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def _is_recent(self, created_at: float) -> bool:
+        return not self.ttl or time.monotonic() - created_at < self.ttl
+
+    def _is_fresh(self, snapshot: CatalogSnapshot | None) -> bool:
+        if snapshot is None or snapshot.version != self._version:
+            return False
+        return self._is_recent(snapshot.created_at)
+
+    # Возвращает актуальный снимок или None, если каталог слишком велик для кэша
+    async def get(self) -> CatalogSnapshot | None:
+        snapshot = self._snapshot
+        if self._is_fresh(snapshot):
+            self.hits += 1
+            return snapshot
+
+        self.misses += 1
+        if self._oversized_version == self._version and self._is_recent(self._oversized_at):
+            return None
+
+        async with self._lock:
+            # Пока ждали блокировку, снимок мог пересобрать другой запрос
+            if self._is_fresh(self._snapshot):
+                return self._snapshot
+            if self._snapshot is not None and self._snapshot.version == self._version:
+                # Снимок истек по TTL: данные могли измениться, зависимые кэши должны сброситься
+                self._version += 1
+            version = self._version
+            rows = await self._loader(self.max_items)
+            if rows is None:
+                self.oversized += 1
+                self._oversized_version, self._oversized_at = version, time.monotonic()
+                logger.warning(f"Каталог превышает лимит кэша ({self.max_items} записей), чтение идет из БД")
+                return None
+            if version != self._version:
+                # Во время загрузки пришла инвалидация - не кэшируем потенциально устаревшие данные
+                return CatalogSnapshot.build(version, *rows)
+            self._snapshot = CatalogSnapshot.build(version, *rows)
+            self.rebuilds += 1
+            logger.info(f"Собран снимок каталога v{version}: {self._snapshot.size} записей. {self.stats()}")
+            return self._snapshot
+
+    def _cancel_pending(self) -> None:
+        self._pending.clear()
+        if self._pending_timer is not None:
+            self._pending_timer.cancel()
+            self._pending_timer = None
+
+    # Явная инвалидация: следующий запрос пересоберет снимок
+    def invalidate(self) -> None:
+        self._cancel_pending()
+        self._version += 1
+        self._snapshot = None
+        logger.info(f"Снимок каталога инвалидирован, новая версия v{self._version}")
+
+    # Событие изменения каталога: копится до применения вместе с соседними
+    def apply(self, model: str, pk: int, item=None) -> None:
+        self._pending.pop((model, pk), None)
+        self._pending[(model, pk)] = item
+        if len(self._pending) > self.max_pending:
+            logger.info(f"Больше {self.max_pending} изменений каталога подряд, снимок пересобирается целиком")
+            self.invalidate()
+        elif not self.patch_delay:
+            self._apply_pending()
+        elif self._pending_timer is None:
+            self._pending_timer = asyncio.get_running_loop().call_later(self.patch_delay, self._apply_pending)
+
+    def _apply_pending(self) -> None:
+        changes = [(model, pk, item) for (model, pk), item in self._pending.items()]
+        self._cancel_pending()
+        if not changes:
+            return
+        snapshot = self._snapshot
+        self._version += 1
+        if snapshot is None:
+            return
+        try:
+            self._snapshot = snapshot.patched(self._version, changes)
+            self.patches += 1
+            self.patched_items += len(changes)
+            logger.info(f"Снимок каталога обновлен до v{self._version}: изменений {len(changes)}")
+        except Exception as e:
+            self._snapshot = None
+            logger.error(f"Ошибка обновления снимка каталога ({len(changes)} изменений), снимок сброшен: {e}")
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'version': self._version,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / total, 4) if total else 0.0,
+            'rebuilds': self.rebuilds,
+            'oversized': self.oversized,
+            'patches': self.patches,
+            'patched_items': self.patched_items,
+            'items': self._snapshot.size if self._snapshot else 0,
+        }
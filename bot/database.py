@@ -1,22 +1,194 @@
 import logging
 import os
+import itertools
+import secrets
+import time
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
 from typing import Any, Sequence
 
-from sqlalchemy import select, delete
+from sqlalchemy import Delete, Insert, Integer, Update, exc, func, insert, literal, or_, select, delete, \
+    update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine, AsyncSession
-from sqlalchemy.orm import selectinload
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
-from models import Cart, Category, Product, SubCategory, User
+import metrics
+from cart import CartLine, CartView
+from cart_store import CartEngine
+from fastpath import AsyncpgBackend
+from catalog import CatalogCache, CategoryItem, ProductItem, SubCategoryItem
+from models import Cart, Category, Order, OrderLine, Product, SubCategory, User
+from queries import CATEGORY_COLUMNS, PAGE_SOURCES, PRODUCT_COLUMNS, SUBCATEGORY_COLUMNS, cart_query, \
+    catalog_count_query, catalog_page_query, search_count_query, search_query, user_internal_id
+from search import ProductSearch, SearchPageCache, tokenize
 
 
 logger = logging.getLogger(__name__)
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 
-async_engine = create_async_engine(DATABASE_URL)
-async_session_maker = async_sessionmaker(async_engine, class_=AsyncSession)
-
-
+# Бюджет соединений бота с основной базой на все его процессы (max_connections Postgres по умолчанию - 100,
+# остаток - админке и обслуживанию)
+DB_MAX_CONNECTIONS = int(os.getenv("DB_MAX_CONNECTIONS", 80))
+# Процессов с собственными пулами: в SHARD_MODE=processes - шарды и процесс-приемник
+DB_PROCESSES = int(os.getenv("SHARDS", 16)) + 1 if os.getenv("SHARD_MODE", "tasks") == "processes" else 1
+DB_BACKEND = os.getenv("DB_BACKEND", "orm")  # orm - SQLAlchemy, asyncpg - горячие запросы через fastpath.py
+# Доля одного процесса за вычетом соединения LISTEN; с DB_BACKEND=asyncpg половина уходит пулу asyncpg
+_process_connections = max(DB_MAX_CONNECTIONS // DB_PROCESSES - 1, 2)
+_orm_connections = _process_connections - _process_connections // 2 if DB_BACKEND == "asyncpg" \
+    else _process_connections
+
+# Параметры пула соединений. По умолчанию - значения SQLAlchemy (5 + 10), уменьшенные до доли процесса
+_default_pool_size = min(5, max(_orm_connections // 3, 1))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", _default_pool_size))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", min(10, _orm_connections - _default_pool_size)))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))  # ожидание свободного соединения, с
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", -1))  # пересоздание соединений старше N секунд, -1 - никогда
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "false").lower() in ("1", "true", "yes")
+
+
+# Пул с метриками: время ожидания соединения и число таймаутов выдачи
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wait_time = metrics.Histogram()
+        self.checkout_timeouts = 0
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            self.checkout_timeouts += 1
+            raise
+        finally:
+            self.wait_time.observe(time.perf_counter() - started)
+
+    # Пул пересоздается (dispose/recreate) с теми же счетчиками
+    def recreate(self):
+        pool = super().recreate()
+        pool.wait_time, pool.checkout_timeouts = self.wait_time, self.checkout_timeouts
+        return pool
+
+    def stats(self) -> dict:
+        return {
+            'size': self.size(),
+            'checked_out': self.checkedout(),
+            'checked_in': self.checkedin(),
+            'overflow': max(self.overflow(), 0),
+            'max_overflow': self._max_overflow,
+            'checkout_timeouts': self.checkout_timeouts,
+            'wait_time': self.wait_time.snapshot(),
+        }
+
+
+def create_engine_with_pool(url: str):
+    return create_async_engine(
+        url,
+        poolclass=InstrumentedPool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+    )
+
+
+async_engine = create_engine_with_pool(DATABASE_URL)
+metrics.register("db_pool", lambda: async_engine.pool.stats())
+
+# Реплики для чтения (через запятую). Для проверки можно указать основную базу еще раз
+DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+# Сколько секунд после изменения корзины чтения пользователя идут в основную базу
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", 5))
+
+replica_engines = [create_engine_with_pool(url) for url in DATABASE_REPLICA_URLS]
+_replica_cycle = itertools.cycle(replica_engines)
+for number, replica_engine in enumerate(replica_engines):
+    metrics.register(f"db_replica_pool_{number}", replica_engine.pool.stats)
+
+
+# Сессия с маршрутизацией: запись, блокирующие чтения и сессии с info["primary"] - в основную базу,
+# остальные чтения - в одну (на сессию) из реплик
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if (not replica_engines or self.info.get("primary") or self._flushing
+                or isinstance(clause, (Insert, Update, Delete))
+                or getattr(clause, "_for_update_arg", None) is not None):
+            return async_engine.sync_engine
+        replica = self.info.get("replica")
+        if replica is None:
+            replica = self.info["replica"] = next(_replica_cycle)
+        return replica.sync_engine
+
+
+async_session_maker = async_sessionmaker(async_engine, class_=AsyncSession, sync_session_class=RoutingSession)
+# Только основная база: фоновые задачи, которым нужны самые свежие данные
+primary_session_maker = async_sessionmaker(async_engine, class_=AsyncSession)
+
+# Пользователь -> момент, до которого его чтения идут в основную базу
+_primary_until: dict[int, float] = {}
+
+
+# После записи чтения пользователя временно направляются в основную базу (read-your-writes)
+def stick_to_primary(session: AsyncSession | None, user_id: int) -> None:
+    if not replica_engines:
+        return
+    if session is not None:
+        session.info["primary"] = True
+    now = time.monotonic()
+    _primary_until[user_id] = now + READ_YOUR_WRITES_SECONDS
+    if len(_primary_until) > 10_000:
+        for expired in [key for key, until in _primary_until.items() if until < now]:
+            del _primary_until[expired]
+
+
+def is_sticky_to_primary(user_id: int) -> bool:
+    until = _primary_until.get(user_id)
+    return until is not None and until > time.monotonic()
+
+
+# Доступ к данным для горячих запросов: orm - SQLAlchemy, asyncpg - prepared statements напрямую (fastpath.py)
+ASYNCPG_POOL_MAX_SIZE = int(os.getenv("ASYNCPG_POOL_MAX_SIZE", min(DB_POOL_SIZE + DB_MAX_OVERFLOW,
+                                                                   max(_process_connections // 2, 1))))
+fastpath = AsyncpgBackend(
+    DATABASE_URL,
+    min_size=min(int(os.getenv("ASYNCPG_POOL_MIN_SIZE", 2)), ASYNCPG_POOL_MAX_SIZE),
+    max_size=ASYNCPG_POOL_MAX_SIZE,
+) if DB_BACKEND == "asyncpg" else None
+if fastpath is not None:
+    metrics.register("asyncpg_pool", fastpath.stats)
+
+
+# Сколько соединений с основной базой могут открыть все процессы бота: пулы SQLAlchemy и asyncpg
+# и LISTEN каталога в каждом процессе, плюс LISTEN рассылок. Реплики и отдельный mailing.py не учитываются
+def max_connections() -> int:
+    per_process = DB_POOL_SIZE + DB_MAX_OVERFLOW + 1
+    if fastpath is not None:
+        per_process += ASYNCPG_POOL_MAX_SIZE
+    return DB_PROCESSES * per_process + 1
+
+
+# Отказ от запуска, если явно заданные размеры пулов, умноженные на число процессов, не укладываются в бюджет
+def check_connection_budget() -> None:
+    total = max_connections()
+    if total > DB_MAX_CONNECTIONS:
+        raise ValueError(
+            f"Процессы бота ({DB_PROCESSES}) могут открыть до {total} соединений с базой, "
+            f"больше DB_MAX_CONNECTIONS={DB_MAX_CONNECTIONS}: уменьшите DB_POOL_SIZE, DB_MAX_OVERFLOW, "
+            f"ASYNCPG_POOL_MAX_SIZE или SHARDS"
+        )
+    logger.info(f"Соединений с базой на {DB_PROCESSES} процесс(ов): до {total} из {DB_MAX_CONNECTIONS}")
+
+CATALOG_CACHE_TTL = float(os.getenv("CATALOG_CACHE_TTL", 300))  # 0 - без TTL
+CATALOG_CACHE_MAX_ITEMS = int(os.getenv("CATALOG_CACHE_MAX_ITEMS", 50_000))
+CATALOG_COUNT_TTL = float(os.getenv("CATALOG_COUNT_TTL", 60))
+
+
+
+# Сессия для фоновых задач (снимок каталога и т.п.); обработчики получают сессию из DbSessionMiddleware
 async def get_async_db():
     async_session = async_session_maker()
     async with async_session as session:
@@ -27,55 +199,130 @@ async def get_async_db():
 
 
 # Получает пользователя по user_id (Telegram ID)
-async def get_user_tg_id(tg_id: int) -> User | None:
-    async for db in get_async_db():
-        try:
-            stmt = select(User).where(User.user_id == tg_id)
-            result = await db.execute(stmt)
-            user = result.scalar_one_or_none()
-            return user
-        except Exception as e:
-            logger.error(f"Ошибка при получении пользователя с user_id {tg_id}: {e}")
-            return None
-
-
-# Добавляет пользователя в таблицу user, если его там еще нет (или обновляет)
-async def add_user_if_not_exists(user_id: int, username: str, first_name: str, last_name: str) -> User | None:
+async def get_user_tg_id(session: AsyncSession, tg_id: int) -> User | None:
+    try:
+        stmt = select(User).where(User.user_id == tg_id)
+        result = await session.execute(stmt)
+        user = result.scalar_one_or_none()
+        return user
+    except Exception as e:
+        logger.error(f"Ошибка при получении пользователя с user_id {tg_id}: {e}")
+        return None
+
+
+SEEN_USERS_CACHE_SIZE = int(os.getenv("SEEN_USERS_CACHE_SIZE", 10_000))
+
+# Недавно сохраненные пользователи: Telegram ID -> хэш профиля (LRU)
+_seen_users: OrderedDict[int, int] = OrderedDict()
+
+
+# Добавляет пользователя в таблицу user, если его там еще нет (или обновляет).
+# Один INSERT ... ON CONFLICT; повторный /start с неизменным профилем не обращается к БД.
+async def add_user_if_not_exists(session: AsyncSession, user_id: int, username: str, first_name: str,
+                                 last_name: str) -> bool:
+    profile = hash((username, first_name, last_name))
+    if _seen_users.get(user_id) == profile:
+        _seen_users.move_to_end(user_id)
+        return True
+
+    try:
+        if fastpath is not None:
+            row = await fastpath.upsert_user(user_id, username, first_name, last_name)
+        else:
+            stmt = pg_insert(User).values(
+                user_id=user_id,
+                username=username,
+                first_name=first_name,
+                last_name=last_name,
+                is_active=True,
+            )
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[User.user_id],
+                set_={
+                    'username': stmt.excluded.username,
+                    'first_name': stmt.excluded.first_name,
+                    'last_name': stmt.excluded.last_name,
+                },
+                # Строка не переписывается, если профиль не изменился
+                where=or_(User.username.is_distinct_from(stmt.excluded.username),
+                          User.first_name.is_distinct_from(stmt.excluded.first_name),
+                          User.last_name.is_distinct_from(stmt.excluded.last_name)),
+            ).returning(User.id)
+            row = (await session.execute(stmt)).first()
+            await session.commit()
+    except Exception as e:
+        await session.rollback()
+        logger.error(f"Ошибка добавления пользователя (ID: {user_id}): {e}")
+        return False
+
+    if row:
+        logger.info(f"Добавлен или обновлен пользователь (ID: {user_id}, id: {row[0]})")
+    _seen_users[user_id] = profile
+    _seen_users.move_to_end(user_id)
+    while len(_seen_users) > SEEN_USERS_CACHE_SIZE:
+        _seen_users.popitem(last=False)
+    return True
+
+
+# Загружает весь каталог для снимка; None - если записей больше лимита кэша
+async def load_catalog(max_items: int) -> tuple[list, list, list] | None:
     async for db in get_async_db():
-        try:
-            # Пытаемся получить пользователя по user_id
-            user = await get_user_tg_id(user_id)
-
-            if user:
-                logger.info(f"Пользователь (ID: {user_id}) уже существует.")
-                if user.username != username or user.first_name != first_name or user.last_name != last_name:
-                    user.username = username
-                    user.first_name = first_name
-                    user.last_name = last_name
-                    await db.commit()
-                    await db.refresh(user)
-                    logger.info(f"Обновлен существующий пользователь: {user}")
-                return user
-            else:
-                new_user = User(
-                    user_id=user_id,
-                    username=username,
-                    first_name=first_name,
-                    last_name=last_name,
-                )
-                db.add(new_user)
-                await db.commit()
-                await db.refresh(new_user)
-                logger.info(f"Добавлен новый пользователь: {new_user}")
-                return new_user
-        except Exception as e:
-            await db.rollback()
-            logger.error(f"Ошибка добавления пользователя (ID: {user_id}): {e}")
+        categories = (await db.execute(select(*CATEGORY_COLUMNS).limit(max_items + 1))).all()
+        subcategories = (await db.execute(select(*SUBCATEGORY_COLUMNS).limit(max_items + 1))).all()
+        products = (await db.execute(select(*PRODUCT_COLUMNS).limit(max_items + 1))).all()
+        if len(categories) + len(subcategories) + len(products) > max_items:
             return None
+        return ([CategoryItem(*row) for row in categories],
+                [SubCategoryItem(*row) for row in subcategories],
+                [ProductItem(*row) for row in products])
+
+
+catalog_cache = CatalogCache(load_catalog, ttl=CATALOG_CACHE_TTL, max_items=CATALOG_CACHE_MAX_ITEMS)
+metrics.register("catalog_cache", catalog_cache.stats)
+
+
+# Снимок каталога из кэша; при ошибке загрузки работаем напрямую с БД
+async def get_catalog_snapshot():
+    try:
+        return await catalog_cache.get()
+    except Exception as e:
+        logger.error(f"Ошибка загрузки снимка каталога: {e}")
+        return None
+
+
+# Точечно обновляет снимок каталога по событию из админки (products/signals.py)
+async def refresh_catalog_item(event: dict) -> None:
+    model, action, pk = event.get('model'), event.get('action'), event.get('id')
+    if action == 'reload' or pk is None:
+        catalog_cache.invalidate()
+        return
+
+    sources = {
+        'category': (Category, CATEGORY_COLUMNS, CategoryItem),
+        'subcategory': (SubCategory, SUBCATEGORY_COLUMNS, SubCategoryItem),
+        'product': (Product, PRODUCT_COLUMNS, ProductItem),
+    }
+    if model not in sources:
+        logger.warning(f"Неизвестная модель в событии каталога: {event}")
+        catalog_cache.invalidate()
+        return
+
+    item = None
+    if action == 'save':
+        table, columns, item_class = sources[model]
+        # Читаем из основной базы: реплика могла еще не получить изменение
+        async with primary_session_maker() as db:
+            row = (await db.execute(select(*columns).where(table.id == pk))).first()
+            item = item_class(*row) if row else None
+    catalog_cache.apply(model, pk, item)
 
 
 # Получаем список категорий
-async def fetch_categories() -> Sequence[Category] | list[Any]:
+async def fetch_categories() -> Sequence[Category | CategoryItem] | list[Any]:
+    snapshot = await get_catalog_snapshot()
+    if snapshot is not None:
+        return snapshot.categories
+
     async for db in get_async_db():
         try:
             stmt = select(Category)
@@ -89,7 +336,11 @@ async def fetch_categories() -> Sequence[Category] | list[Any]:
 
 
 # Получаем список подкатегорий для заданной категории
-async def fetch_subcategories(category_id: int) -> Sequence[SubCategory] | list[Any]:
+async def fetch_subcategories(category_id: int) -> Sequence[SubCategory | SubCategoryItem] | list[Any]:
+    snapshot = await get_catalog_snapshot()
+    if snapshot is not None:
+        return snapshot.subcategories_by_category.get(category_id, ())
+
     async for db in get_async_db():
         try:
             stmt = select(SubCategory).where(SubCategory.category_id == category_id)
@@ -103,7 +354,11 @@ async def fetch_subcategories(category_id: int) -> Sequence[SubCategory] | list[
 
 
 # Получаем объект подкатегории
-async def fetch_subcategory(subcategory_id: int) -> SubCategory | None:
+async def fetch_subcategory(subcategory_id: int) -> SubCategory | SubCategoryItem | None:
+    snapshot = await get_catalog_snapshot()
+    if snapshot is not None:
+        return snapshot.subcategories_by_id.get(subcategory_id)
+
     async for db in get_async_db():
         try:
             stmt = select(SubCategory).where(SubCategory.id == subcategory_id)
@@ -116,7 +371,11 @@ async def fetch_subcategory(subcategory_id: int) -> SubCategory | None:
 
 
 # Получаем список товаров для заданной подкатегории
-async def fetch_products_by_subcategory(subcategory_id: int) -> Sequence[Product] | list[Any]:
+async def fetch_products_by_subcategory(subcategory_id: int) -> Sequence[Product | ProductItem] | list[Any]:
+    snapshot = await get_catalog_snapshot()
+    if snapshot is not None:
+        return snapshot.products_by_subcategory.get(subcategory_id, ())
+
     async for db in get_async_db():
         try:
             stmt = select(Product).where(Product.subcategory_id == subcategory_id)
@@ -129,123 +388,373 @@ async def fetch_products_by_subcategory(subcategory_id: int) -> Sequence[Product
             return []
 
 
-# Получаем информацию о продукте
-async def fetch_product(product_id: int) -> Product | None:
-    async for db in get_async_db():
-        try:
-            stmt = select(Product).where(Product.id == product_id)
-            result = await db.execute(stmt)
-            product = result.scalar_one_or_none()
-            logger.info(f"Получена информация о продукте: {product}")
-            return product
-        except Exception as e:
-            logger.error(f"Ошибка получения товара: {e}")
-            return None
+# Кэш количества элементов: (уровень, родитель) -> (версия каталога, время, количество)
+_count_cache: dict[tuple[str, int | None], tuple[int, float, int]] = {}
 
 
-# Добавляем товар в корзину пользователя
-async def add_to_cart(user_id: int, product_id: int, quantity: float | int) -> bool:
-    async for db in get_async_db():
-        try:
-            # получение пользователя из базы данных
-            user = await get_user_tg_id(user_id)
+# Элементы уровня каталога из снимка (отсортированы по id)
+def _snapshot_items(snapshot, level: str, parent_id: int | None) -> tuple:
+    if level == 'categories':
+        return snapshot.categories
+    if level == 'subcategories':
+        return snapshot.subcategories_by_category.get(parent_id, ())
+    return snapshot.products_by_subcategory.get(parent_id, ())
 
-            if not user:
-                logger.error(f"Пользователь с ID {user.id} не найден.")
-                return False
 
-            logger.info(f"Найден пользователь: {user} c id {user.id}")
+# Страница каталога keyset-пагинацией по id: после after_id или перед before_id
+async def fetch_catalog_page(level: str, parent_id: int | None = None, after_id: int | None = None,
+                             before_id: int | None = None, limit: int = 5) -> tuple:
+    snapshot = await get_catalog_snapshot()
+    if snapshot is not None:
+        items = _snapshot_items(snapshot, level, parent_id)
+        if before_id is not None:
+            end = bisect_left(items, before_id, key=lambda item: item.id)
+            return items[max(end - limit, 0):end]
+        start = bisect_right(items, after_id, key=lambda item: item.id) if after_id is not None else 0
+        return items[start:start + limit]
 
-            # получение товара из базы данных
-            product = await fetch_product(product_id)
+    item_class = PAGE_SOURCES[level][2]
+    async for db in get_async_db():
+        try:
+            rows = (await db.execute(catalog_page_query(level, parent_id, after_id, before_id, limit))).all()
+            if before_id is not None:
+                rows.reverse()
+            return tuple(item_class(*row) for row in rows)
+        except Exception as e:
+            logger.error(f"Ошибка получения страницы {level} (родитель {parent_id}): {e}")
+            return ()
 
-            if not product:
-                logger.error(f"Товар с ID {product_id} не найден.")
-                return False
 
-            stmt = select(Cart).where(Cart.user_id == user.id, Cart.product_id == product_id)
-            result = await db.execute(stmt)
-            cart_item = result.scalar_one_or_none()
-            logger.info(f"Чекаем есть ли уже корзина с этим товаром у этого пользователя либо None ({cart_item})")
-
-            if cart_item:
-                # Товар уже есть в корзине, обновляем количество
-                cart_item.quantity += quantity
-                logger.info(
-                    f"Обновлено количество товара в корзине (ID: {cart_item.id}), quantity: {cart_item.quantity}"
-                )
-            else:
-                logger.info(
-                    f"Товара нет в корзине, данные для добавления({user.id, product_id, quantity, product.price})"
-                )
-                # Товара нет в корзине, создаем новый элемент
-                new_cart_item = Cart(
-                    user_id=user.id,
-                    product_id=product_id,
-                    quantity=quantity,
-                    price=product.price,
-                )
-                logger.info(f"Подготовлен новый товар для добавления в корзину ({new_cart_item})")
-                db.add(new_cart_item)
-                logger.info(f"Добавлен новый товар в сессию ({new_cart_item})")
-            await db.commit()  # Один commit для всех изменений в этой сессии
-            return True
-        except Exception as e:
-            await db.rollback()
-            logger.error(f"Ошибка добавления товара в корзину: {e}")
-            return False
+# Количество элементов уровня каталога: из снимка либо COUNT(*) с кэшированием по версии каталога
+async def count_catalog_items(level: str, parent_id: int | None = None) -> int:
+    snapshot = await get_catalog_snapshot()
+    if snapshot is not None:
+        return len(_snapshot_items(snapshot, level, parent_id))
 
+    key = (level, parent_id)
+    cached = _count_cache.get(key)
+    if cached and cached[0] == catalog_cache.version and time.monotonic() - cached[1] < CATALOG_COUNT_TTL:
+        return cached[2]
 
-# Получаем корзину пользователя
-async def fetch_cart(user_id: int) -> list[dict]:
     async for db in get_async_db():
         try:
-            user = await get_user_tg_id(user_id)
-            stmt = select(Cart).where(Cart.user_id == user.id).options(selectinload(Cart.product))
-            result = await db.execute(stmt)
-            cart_items = result.scalars().all()
-
-            # Формируем список словарей с информацией о товарах
-            cart_data = []
-            for item in cart_items:
-                cart_data.append({
-                    'id': item.id,
-                    'name': item.product.name,
-                    'price': item.product.price,
-                    'quantity': item.quantity,
-                    'photo': item.product.photo,
-                }
-                )
-            return cart_data
+            count = (await db.execute(catalog_count_query(level, parent_id))).scalar_one()
+            _count_cache[key] = (catalog_cache.version, time.monotonic(), count)
+            return count
         except Exception as e:
-            logger.error(f"Ошибка получения корзины: {e}")
-            return []
-
-
-# Удаляем товар из корзины
-async def remove_from_cart(item_id: int) -> bool:
+            logger.error(f"Ошибка подсчета {level} (родитель {parent_id}): {e}")
+            return 0
+
+
+product_search = ProductSearch(cache_size=int(os.getenv("SEARCH_CACHE_SIZE", 1000)))
+metrics.register("search", product_search.stats)
+# Страницы поиска в БД: живут SEARCH_CACHE_TTL секунд и сбрасываются при изменении каталога
+search_page_cache = SearchPageCache(ttl=float(os.getenv("SEARCH_CACHE_TTL", 60)),
+                                    max_items=int(os.getenv("SEARCH_CACHE_SIZE", 1000)))
+metrics.register("search_pages", search_page_cache.stats)
+
+
+# Поиск товаров по названию и описанию: (страница результатов, всего найдено)
+async def search_products(query: str, offset: int = 0, limit: int = 5) -> tuple[tuple[ProductItem, ...], int]:
+    snapshot = await get_catalog_snapshot()
+    if snapshot is not None:
+        product_ids = product_search.search(snapshot, query)
+        page = product_ids[offset:offset + limit]
+        return tuple(snapshot.products_by_id[product_id] for product_id in page), len(product_ids)
+
+    # Каталог не поместился в снимок - ищем в БД по триграммным индексам
+    tokens = tokenize(query)
+    if not tokens:
+        return (), 0
+    key = (" ".join(tokens), offset, limit)
+    version = catalog_cache.version
+    cached = search_page_cache.get(key, version)
+    if cached is not None:
+        return cached
     async for db in get_async_db():
         try:
-            stmt = delete(Cart).where(Cart.id == item_id)
-            await db.execute(stmt)
-            await db.commit()
-            return True
+            rows = (await db.execute(search_query(tokens, offset, limit))).all()
+            if rows:
+                total = rows[0].total
+            elif offset:
+                # Страница за концом результатов: оконный счетчик пуст, считаем отдельно
+                total = (await db.execute(search_count_query(tokens))).scalar_one()
+            else:
+                total = 0
+            products = tuple(ProductItem(*row[:-1]) for row in rows)
+            search_page_cache.put(key, version, products, total)
+            return products, total
         except Exception as e:
-            await db.rollback()
-            logger.error(f"Ошибка удаления товара из корзины: {e}")
-            return False
+            logger.error(f"Ошибка поиска товаров по запросу {query!r}: {e}")
+            return (), 0
+
+
+# Получаем информацию о продукте
+async def fetch_product(session: AsyncSession, product_id: int) -> ProductItem | None:
+    snapshot = await get_catalog_snapshot()
+    if snapshot is not None:
+        return snapshot.products_by_id.get(product_id)
+
+    try:
+        if fastpath is not None:
+            product = await fastpath.fetch_product(product_id)
+        else:
+            row = (await session.execute(select(*PRODUCT_COLUMNS).where(Product.id == product_id))).first()
+            product = ProductItem(*row) if row else None
+        logger.info(f"Получена информация о продукте: {product}")
+        return product
+    except Exception as e:
+        logger.error(f"Ошибка получения товара: {e}")
+        return None
+
+
+# file_id фото, полученные ботом: id товара -> (фото, для которого получен file_id, file_id).
+# None в file_id - сброшенный недействительный id, который еще может оставаться в снимке каталога.
+_photo_file_ids: dict[int, tuple[str, str | None]] = {}
+
+
+# file_id фото товара, если он актуален для текущего значения photo
+def get_photo_file_id(product: Product | ProductItem) -> str | None:
+    cached = _photo_file_ids.get(product.id)
+    if cached and cached[0] == product.photo:
+        return cached[1]
+    return product.photo_file_id
+
+
+# Запоминаем (или сбрасываем при file_id=None) file_id фото товара в памяти и в БД.
+# В БД пишем, только если фото не сменили в админке за это время.
+async def save_photo_file_id(session: AsyncSession, product_id: int, photo: str, file_id: str | None) -> bool:
+    _photo_file_ids[product_id] = (photo, file_id)
+    try:
+        stmt = (update(Product)
+                .where(Product.id == product_id, Product.photo == photo)
+                .values(photo_file_id=file_id))
+        await session.execute(stmt)
+        await session.commit()
+        return True
+    except Exception as e:
+        await session.rollback()
+        logger.error(f"Ошибка сохранения file_id фото товара {product_id}: {e}")
+        return False
+
+
+# Добавляем товар в корзину пользователя.
+# Один INSERT ... SELECT ... ON CONFLICT: пользователь и цена определяются в самом запросе,
+# а количество увеличивается атомарно, поэтому параллельные нажатия не теряют изменений.
+async def add_to_cart(session: AsyncSession, user_id: int, product_id: int, quantity: int) -> bool:
+    stick_to_primary(session, user_id)
+    if cart_engine is not None:
+        return await cart_engine.add(user_id, product_id, quantity)
+
+    source = (
+        select(User.id, Product.id, literal(quantity, Integer), Product.price)
+        .select_from(User)
+        .join(Product, Product.id == product_id)
+        .where(User.user_id == user_id)
+    )
+    stmt = pg_insert(Cart).from_select(['user_id', 'product_id', 'quantity', 'price'], source)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Cart.user_id, Cart.product_id],
+        set_={'quantity': Cart.quantity + stmt.excluded.quantity},
+    ).returning(Cart.id, Cart.quantity)
+    try:
+        if fastpath is not None:
+            row = await fastpath.add_to_cart(user_id, product_id, quantity)
+        else:
+            row = (await session.execute(stmt)).first()
+            await session.commit()
+    except Exception as e:
+        await session.rollback()
+        logger.error(f"Ошибка добавления товара в корзину: {e}")
+        return False
+
+    if row is None:
+        logger.error(f"Пользователь {user_id} или товар {product_id} не найден.")
+        return False
+    logger.info(f"Товар {product_id} в корзине пользователя {user_id} (ID: {row[0]}), quantity: {row[1]}")
+    return True
+
+
+# Получаем корзину пользователя: один запрос по Telegram ID, суммы считаются в SQL
+async def fetch_cart(session: AsyncSession, user_id: int) -> CartView:
+    if cart_engine is not None:
+        return await cart_engine.view(user_id)
+
+    try:
+        if fastpath is not None:
+            return await fastpath.fetch_cart(user_id)
+        rows = (await session.execute(cart_query(user_id))).all()
+    except Exception as e:
+        logger.error(f"Ошибка получения корзины: {e}")
+        return CartView()
+    if not rows:
+        return CartView()
+    return CartView(lines=tuple(CartLine(*row[:-1]) for row in rows), total=rows[0].total)
+
+
+# Удаляем товар из корзины пользователя
+async def remove_from_cart(session: AsyncSession, user_id: int, product_id: int) -> bool:
+    stick_to_primary(session, user_id)
+    if cart_engine is not None:
+        return await cart_engine.remove(user_id, product_id)
+
+    try:
+        stmt = delete(Cart).where(Cart.user_id == user_internal_id(user_id), Cart.product_id == product_id)
+        await session.execute(stmt)
+        await session.commit()
+        return True
+    except Exception as e:
+        await session.rollback()
+        logger.error(f"Ошибка удаления товара из корзины: {e}")
+        return False
 
 
 # Очищаем корзину пользователя
-async def clear_cart(user_id: int) -> bool:
+async def clear_cart(session: AsyncSession, user_id: int) -> bool:
+    stick_to_primary(session, user_id)
+    if cart_engine is not None:
+        return await cart_engine.clear(user_id)
+
+    try:
+        stmt = delete(Cart).where(Cart.user_id == user_internal_id(user_id))
+        await session.execute(stmt)
+        await session.commit()
+        return True
+    except Exception as e:
+        await session.rollback()
+        logger.error(f"Ошибка очистки корзины: {e}")
+        return False
+
+
+# Создаем заказ по корзине: строки заказа фиксируют названия и цены на момент оформления.
+# Возвращает payload счета Telegram, по которому заказ будет найден при оплате.
+async def create_order(session: AsyncSession, user_id: int, cart: CartView, name: str, address: str,
+                       phone: str) -> str | None:
+    stick_to_primary(session, user_id)
+    payload = f"order_{secrets.token_hex(16)}"
+    try:
+        order_id = (await session.execute(
+            insert(Order)
+            .values(user_id=user_internal_id(user_id), invoice_payload=payload, status=Order.STATUS_PENDING,
+                    total=cart.total, currency="RUB", name=name, address=address, phone=phone)
+            .returning(Order.id)
+        )).scalar_one()
+        await session.execute(insert(OrderLine), [
+            {'order_id': order_id, 'product_id': line.product_id, 'name': line.name, 'price': line.price,
+             'quantity': line.quantity}
+            for line in cart.lines
+        ])
+        await session.commit()
+        logger.info(f"Создан заказ {order_id} пользователя {user_id} на сумму {cart.total}")
+        return payload
+    except Exception as e:
+        await session.rollback()
+        logger.error(f"Ошибка создания заказа пользователя {user_id}: {e}")
+        return None
+
+
+# Заказ по payload счета: один запрос по уникальному индексу, всегда из основной базы
+async def fetch_order_by_payload(session: AsyncSession, payload: str) -> Order | None:
+    session.info["primary"] = True
+    try:
+        return (await session.execute(select(Order).where(Order.invoice_payload == payload))).scalar_one_or_none()
+    except Exception as e:
+        logger.error(f"Ошибка получения заказа {payload}: {e}")
+        return None
+
+
+# Отмечаем заказ оплаченным. Повторная доставка того же платежа ничего не меняет.
+# Возвращает 'paid' при первой обработке, 'duplicate' при повторной доставке того же платежа,
+# 'paid_cancelled' - оплачен отмененный заказ, 'paid_twice' - заказ уже оплачен другим платежом
+# (оба случая требуют возврата денег или восстановления заказа), None если заказ не найден
+async def mark_order_paid(session: AsyncSession, payload: str, telegram_charge_id: str,
+                          provider_charge_id: str | None) -> str | None:
+    stmt = (update(Order)
+            .where(Order.invoice_payload == payload, Order.status == Order.STATUS_PENDING)
+            .values(status=Order.STATUS_PAID, telegram_payment_charge_id=telegram_charge_id,
+                    provider_payment_charge_id=provider_charge_id, paid_at=func.now())
+            .returning(Order.id))
+    try:
+        order_id = (await session.execute(stmt)).scalar_one_or_none()
+        await session.commit()
+    except exc.IntegrityError:
+        # Этот платеж уже привязан к заказу
+        await session.rollback()
+        return 'duplicate'
+    except Exception as e:
+        await session.rollback()
+        logger.error(f"Ошибка отметки оплаты заказа {payload}: {e}")
+        return None
+    if order_id is not None:
+        logger.info(f"Заказ {order_id} оплачен, платеж {telegram_charge_id}")
+        return 'paid'
+
+    order = await fetch_order_by_payload(session, payload)
+    if order is None:
+        logger.error(f"Оплачен неизвестный заказ {payload}, платеж {telegram_charge_id}")
+        return None
+    if order.telegram_payment_charge_id == telegram_charge_id:
+        return 'duplicate'
+    logger.error(f"Заказ {order.id} в статусе {order.status} получил платеж {telegram_charge_id},"
+                 f" уже привязан {order.telegram_payment_charge_id}")
+    if order.status != Order.STATUS_CANCELLED:
+        return 'paid_twice'
+
+    # Платеж сохраняется в отмененном заказе, чтобы его было видно в админке при возврате
+    try:
+        await session.execute(update(Order)
+                              .where(Order.id == order.id, Order.telegram_payment_charge_id.is_(None))
+                              .values(telegram_payment_charge_id=telegram_charge_id,
+                                      provider_payment_charge_id=provider_charge_id))
+        await session.commit()
+    except Exception as e:
+        await session.rollback()
+        logger.error(f"Ошибка сохранения платежа {telegram_charge_id} в отмененном заказе {order.id}: {e}")
+    return 'paid_cancelled'
+
+
+# Отменяем неоплаченный заказ
+async def cancel_order(session: AsyncSession, user_id: int, payload: str) -> bool:
+    stmt = (update(Order)
+            .where(Order.invoice_payload == payload, Order.user_id == user_internal_id(user_id),
+                   Order.status == Order.STATUS_PENDING)
+            .values(status=Order.STATUS_CANCELLED))
+    try:
+        result = await session.execute(stmt)
+        await session.commit()
+        return result.rowcount > 0
+    except Exception as e:
+        await session.rollback()
+        logger.error(f"Ошибка отмены заказа {payload}: {e}")
+        return False
+
+
+# Товары по списку id: из снимка каталога либо одним запросом к БД
+async def fetch_products_by_ids(product_ids) -> dict[int, ProductItem]:
+    product_ids = list(product_ids)
+    snapshot = await get_catalog_snapshot()
+    if snapshot is not None:
+        return {product_id: snapshot.products_by_id[product_id]
+                for product_id in product_ids if product_id in snapshot.products_by_id}
     async for db in get_async_db():
         try:
-            user = await get_user_tg_id(user_id)
-            stmt = delete(Cart).where(Cart.user_id == user.id)
-            await db.execute(stmt)
-            await db.commit()
-            return True
+            rows = (await db.execute(select(*PRODUCT_COLUMNS).where(Product.id.in_(product_ids)))).all()
+            return {row.id: ProductItem(*row) for row in rows}
         except Exception as e:
-            await db.rollback()
-            logger.error(f"Ошибка очистки корзины: {e}")
-            return False
+            logger.error(f"Ошибка получения товаров {product_ids[:10]}: {e}")
+            return {}
+
+
+# Движок корзин: db - каждое действие сразу в БД; memory - рабочий набор в памяти с отложенной записью
+CART_ENGINE = os.getenv("CART_ENGINE", "db")
+
+cart_engine = CartEngine(
+    primary_session_maker,
+    fetch_products_by_ids,
+    durability=os.getenv("CART_DURABILITY", "write_behind"),
+    flush_interval=float(os.getenv("CART_FLUSH_INTERVAL", 2)),
+    max_users=int(os.getenv("CART_MEMORY_MAX_USERS", 100_000)),
+    journal_path=os.getenv("CART_JOURNAL_PATH", "logs/cart.journal"),
+) if CART_ENGINE == "memory" else None
+if cart_engine is not None:
+    metrics.register("cart_engine", cart_engine.stats)
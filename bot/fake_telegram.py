@@ -0,0 +1,172 @@
+"""Локальный заменитель Telegram для проверки режима вебхука.
+
+Поднимает минимальный Bot API (все методы отвечают успехом), дожидается готовности бота
+и отправляет ему апдейты на вебхук, измеряя время подтверждения:
+    python fake_telegram.py --webhook http://127.0.0.1:8080/webhook --secret secret --updates 1000
+и в другом терминале:
+    BOT_MODE=webhook TELEGRAM_API_URL=http://127.0.0.1:8081 WEBHOOK_BASE_URL=http://127.0.0.1:8080 \\
+    WEBHOOK_SECRET=secret python bot.py
+
+Те же апдейты можно записать в файл для локальной подачи без HTTP (BOT_MODE=local):
+    python fake_telegram.py --write-updates updates.jsonl --updates 1000
+    BOT_MODE=local LOCAL_UPDATES_FILE=updates.jsonl TELEGRAM_API_URL=http://127.0.0.1:8081 python bot.py
+
+Проверка воркера рассылок: только Bot API, каждый 10-й получатель заблокировал бота,
+каждая 500-я отправка получает 429; счетчики вызовов печатаются при остановке (Ctrl+C):
+    python fake_telegram.py --blocked-every 10 --flood-every 500
+    TELEGRAM_API_URL=http://127.0.0.1:8081 python mailing.py
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import time
+
+from aiohttp import ClientSession, web
+
+from webhook import SECRET_HEADER
+
+_message_ids = itertools.count(1)
+
+
+# Ответы Bot API: методы отправки возвращают сообщение, остальные - True
+async def bot_api(request: web.Request) -> web.Response:
+    method = request.match_info["method"]
+    request.app["calls"][method] = request.app["calls"].get(method, 0) + 1
+    if method == "getMe":
+        result = {"id": 1, "is_bot": True, "first_name": "Fake bot", "username": "fake_bot"}
+    elif method.startswith(("send", "edit")):
+        data = await request.post() if request.content_type != "application/json" else await request.json()
+        chat_id = int(data.get("chat_id", 0) or 0)
+        args = request.app["args"]
+        if args.blocked_every and chat_id % args.blocked_every == 0:
+            return error_response(403, "Forbidden: bot was blocked by the user")
+        if args.flood_every and request.app["calls"][method] % args.flood_every == 0:
+            return error_response(429, "Too Many Requests: retry after 1", {"retry_after": 1})
+        result = fake_message(method, chat_id)
+        if method == "sendMediaGroup":
+            media = data.get("media", "[]")
+            media = json.loads(media) if isinstance(media, str) else media
+            result = [result] + [fake_message(method, chat_id) for _ in media[1:]]
+    else:
+        result = True
+    return web.json_response({"ok": True, "result": result})
+
+
+# Сообщение-ответ; для методов отправки медиа - с file_id, как у настоящего Bot API
+def fake_message(method: str, chat_id: int) -> dict:
+    message_id = next(_message_ids)
+    message = {"message_id": message_id, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}}
+    media = {"file_id": f"fake-file-{message_id}", "file_unique_id": f"fake-{message_id}"}
+    if method == "sendPhoto" or method == "sendMediaGroup":
+        message["photo"] = [{**media, "width": 1, "height": 1}]
+    elif method in ("sendVideo", "sendAnimation"):
+        message[method[4:].lower()] = {**media, "width": 1, "height": 1, "duration": 1}
+    elif method == "sendAudio":
+        message["audio"] = {**media, "duration": 1}
+    elif method == "sendDocument":
+        message["document"] = media
+    else:
+        message["text"] = ""
+    return message
+
+
+def error_response(code: int, description: str, parameters: dict | None = None) -> web.Response:
+    error = {"ok": False, "error_code": code, "description": description}
+    if parameters:
+        error["parameters"] = parameters
+    return web.json_response(error, status=code)
+
+
+def message_update(update_id: int, user_id: int, text: str) -> dict:
+    user = {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"}
+    return {
+        "update_id": update_id,
+        "message": {"message_id": update_id, "date": int(time.time()), "text": text,
+                    "chat": {"id": user_id, "type": "private"}, "from": user},
+    }
+
+
+# Ждем, пока бот поднимет HTTP-сервер
+async def wait_ready(session: ClientSession, health_url: str, timeout: float = 120) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            async with session.get(health_url) as response:
+                if response.status == 200:
+                    return
+        except OSError:
+            pass
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Бот не ответил на {health_url}")
+        await asyncio.sleep(0.5)
+
+
+async def send_updates(args) -> None:
+    headers = {SECRET_HEADER: args.secret} if args.secret else {}
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies, statuses = [], {}
+
+    async def post(session: ClientSession, update_id: int):
+        update = message_update(update_id, args.first_user_id + update_id % args.users, args.text)
+        async with semaphore:
+            started = time.perf_counter()
+            async with session.post(args.webhook, json=update, headers=headers) as response:
+                latencies.append(time.perf_counter() - started)
+                statuses[response.status] = statuses.get(response.status, 0) + 1
+
+    async with ClientSession() as session:
+        await wait_ready(session, args.webhook.rsplit("/", 1)[0] + "/healthz")
+        started = time.perf_counter()
+        await asyncio.gather(*(post(session, update_id) for update_id in range(1, args.updates + 1)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    print(f"Апдейтов: {args.updates} за {elapsed:.2f} с ({args.updates / elapsed:.0f}/с), ответы: {statuses}")
+    print(f"Подтверждение: p50 {latencies[len(latencies) // 2] * 1000:.1f} мс, "
+          f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:.1f} мс")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--api-port", type=int, default=8081, help="Порт заменителя Bot API")
+    parser.add_argument("--webhook", help="Адрес вебхука бота; без него только Bot API")
+    parser.add_argument("--secret", help="WEBHOOK_SECRET бота")
+    parser.add_argument("--updates", type=int, default=100)
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--first-user-id", type=int, default=1_000_000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--text", default="/start")
+    parser.add_argument("--write-updates", help="Записать апдейты в файл JSON Lines и выйти")
+    parser.add_argument("--blocked-every", type=int, default=0,
+                        help="Отвечать 403 на отправки в чаты с id, кратным N (бот заблокирован)")
+    parser.add_argument("--flood-every", type=int, default=0, help="Отвечать 429 на каждую N-ю отправку метода")
+    args = parser.parse_args()
+
+    if args.write_updates:
+        with open(args.write_updates, "w", encoding="utf-8") as file:
+            for update_id in range(1, args.updates + 1):
+                update = message_update(update_id, args.first_user_id + update_id % args.users, args.text)
+                file.write(json.dumps(update) + "\n")
+        return
+
+    app = web.Application()
+    app["calls"] = {}
+    app["args"] = args
+    app.router.add_post("/bot{token}/{method}", bot_api)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.api_port).start()
+    try:
+        if args.webhook:
+            await send_updates(args)
+            await asyncio.sleep(1)  # бот успевает ответить на последние апдейты
+        else:
+            await asyncio.Event().wait()
+    finally:
+        print(f"Вызовы Bot API: {app['calls']}")
+        await runner.cleanup()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
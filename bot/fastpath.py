@@ -0,0 +1,134 @@
+import asyncio
+import logging
+
+import asyncpg
+from asyncpg.prepared_stmt import PreparedStatement
+
+from cart import CartLine, CartView
+from catalog import ProductItem
+from notifications import asyncpg_dsn
+
+logger = logging.getLogger(__name__)
+
+# Горячие запросы в виде готового SQL. Каждый подготавливается один раз на соединение при его открытии
+# (HotConnection.statements), дальше выполняется только prepared statement.
+FETCH_PRODUCT = """
+    SELECT id, category_id, subcategory_id, name, description, photo, price, photo_file_id
+    FROM products_product
+    WHERE id = $1
+"""
+
+FETCH_CART = """
+    SELECT c.product_id, p.name, p.price, c.quantity, p.photo,
+           p.price * c.quantity AS line_total,
+           sum(p.price * c.quantity) OVER () AS total
+    FROM cart_cart c
+    JOIN products_product p ON p.id = c.product_id
+    JOIN users_user u ON u.id = c.user_id
+    WHERE u.user_id = $1
+    ORDER BY c.id
+"""
+
+UPSERT_CART = """
+    INSERT INTO cart_cart (user_id, product_id, quantity, price)
+    SELECT u.id, p.id, $3, p.price
+    FROM users_user u
+    JOIN products_product p ON p.id = $2
+    WHERE u.user_id = $1
+    ON CONFLICT (user_id, product_id) DO UPDATE SET quantity = cart_cart.quantity + excluded.quantity
+    RETURNING id, quantity
+"""
+
+UPSERT_USER = """
+    INSERT INTO users_user (user_id, username, first_name, last_name, is_active)
+    VALUES ($1, $2, $3, $4, true)
+    ON CONFLICT (user_id) DO UPDATE
+        SET username = excluded.username, first_name = excluded.first_name, last_name = excluded.last_name
+        WHERE users_user.username IS DISTINCT FROM excluded.username
+           OR users_user.first_name IS DISTINCT FROM excluded.first_name
+           OR users_user.last_name IS DISTINCT FROM excluded.last_name
+    RETURNING id
+"""
+
+
+HOT_STATEMENTS = {
+    'fetch_product': FETCH_PRODUCT,
+    'fetch_cart': FETCH_CART,
+    'upsert_cart': UPSERT_CART,
+    'upsert_user': UPSERT_USER,
+}
+
+
+# Соединение пула с подготовленными горячими запросами: имя -> PreparedStatement
+class HotConnection(asyncpg.Connection):
+    statements: dict[str, PreparedStatement]
+
+
+# init пула: подготовка горячих запросов на новом соединении
+async def prepare_hot_statements(connection: HotConnection) -> None:
+    connection.statements = {name: await connection.prepare(sql) for name, sql in HOT_STATEMENTS.items()}
+
+
+# Доступ к данным напрямую через asyncpg, без компиляции запросов и гидратации объектов ORM.
+# Возвращает те же типы, что и ORM-путь в database.py.
+class AsyncpgBackend:
+    def __init__(self, database_url: str, min_size: int = 2, max_size: int = 10, statement_cache_size: int = 100):
+        self._dsn = asyncpg_dsn(database_url)
+        self._min_size = min_size
+        self._max_size = max_size
+        self._statement_cache_size = statement_cache_size
+        self._pool: asyncpg.Pool | None = None
+        self._lock = asyncio.Lock()
+
+    async def pool(self) -> asyncpg.Pool:
+        if self._pool is None:
+            async with self._lock:
+                if self._pool is None:
+                    self._pool = await asyncpg.create_pool(
+                        self._dsn,
+                        min_size=self._min_size,
+                        max_size=self._max_size,
+                        statement_cache_size=self._statement_cache_size,
+                        connection_class=HotConnection,
+                        init=prepare_hot_statements,
+                    )
+        return self._pool
+
+    # Выполнение подготовленного запроса: method - fetch или fetchrow
+    async def _execute(self, name: str, method: str, *args):
+        async with (await self.pool()).acquire() as connection:
+            try:
+                return await getattr(connection.statements[name], method)(*args)
+            except asyncpg.InvalidCachedStatementError:
+                # Схема таблиц изменилась (миграция) - подготавливаем запрос заново
+                connection.statements[name] = await connection.prepare(HOT_STATEMENTS[name])
+                return await getattr(connection.statements[name], method)(*args)
+
+    async def fetch_product(self, product_id: int) -> ProductItem | None:
+        record = await self._execute('fetch_product', 'fetchrow', product_id)
+        return ProductItem(*record) if record else None
+
+    async def fetch_cart(self, user_id: int) -> CartView:
+        records = await self._execute('fetch_cart', 'fetch', user_id)
+        if not records:
+            return CartView()
+        return CartView(lines=tuple(CartLine(*record[:-1]) for record in records), total=records[0]["total"])
+
+    # (id, quantity) строки корзины либо None, если пользователь или товар не найден
+    async def add_to_cart(self, user_id: int, product_id: int, quantity: int) -> asyncpg.Record | None:
+        return await self._execute('upsert_cart', 'fetchrow', user_id, product_id, quantity)
+
+    # id пользователя, если строка добавлена или изменена, иначе None
+    async def upsert_user(self, user_id: int, username: str, first_name: str,
+                          last_name: str) -> asyncpg.Record | None:
+        return await self._execute('upsert_user', 'fetchrow', user_id, username, first_name, last_name)
+
+    async def close(self) -> None:
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+    def stats(self) -> dict:
+        if self._pool is None:
+            return {'started': False}
+        return {'started': True, 'size': self._pool.get_size(), 'idle': self._pool.get_idle_size()}
@@ -0,0 +1,368 @@
+import asyncio
+import json
+import logging
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import datetime, timezone
+from decimal import Decimal
+from typing import Any, Mapping
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from sqlalchemy import DateTime, String, Text, bindparam, delete, select, text
+from sqlalchemy.dialects.postgresql import ARRAY, insert as pg_insert
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from models import FSMState
+
+logger = logging.getLogger(__name__)
+
+# Запись хранилища: (состояние, данные, истекает в - unix time, версия). Версия - updated_at строки
+# в постоянном хранилище или None, если строки нет; по ней запись изменяется только условно.
+# Запись без состояния и данных при сохранении удаляет ключ
+Record = tuple[str | None, dict[str, Any], float, datetime | None]
+EMPTY: Record = (None, {}, 0.0, None)
+
+
+def storage_key(key: StorageKey) -> str:
+    return ":".join(str(part) if part is not None else "" for part in (
+        key.bot_id, key.chat_id, key.user_id, key.thread_id, key.business_connection_id, key.destiny,
+    ))
+
+
+# Данные FSM хранятся как JSON; Decimal (например, total_amount) сохраняется без потери точности
+def _encode(value):
+    if isinstance(value, Decimal):
+        return {"__decimal__": str(value)}
+    raise TypeError(f"Тип {type(value).__name__} не сериализуется в JSON")
+
+
+def _decode(value: dict):
+    if value.keys() == {"__decimal__"}:
+        return Decimal(value["__decimal__"])
+    return value
+
+
+def dump_data(data: Mapping[str, Any]) -> str:
+    return json.dumps(data, default=_encode, ensure_ascii=False)
+
+
+def load_data(raw: str) -> dict[str, Any]:
+    return json.loads(raw, object_hook=_decode)
+
+
+def is_empty(record: Record) -> bool:
+    return record[0] is None and not record[1]
+
+
+# Постоянное хранилище состояний. Записи возвращаются и после истечения срока (с версией),
+# чтобы условная запись видела существующую строку, пока ее не удалил purge_expired
+class StateBackend(ABC):
+    @abstractmethod
+    async def load(self, key: str) -> Record | None:
+        ...
+
+    @abstractmethod
+    async def version(self, key: str) -> datetime | None:
+        ...
+
+    # Условная запись: ключ пишется, только если его версия в хранилище совпадает с версией записи.
+    # Возвращает записанные ключи с новыми версиями; остальные изменил другой процесс
+    @abstractmethod
+    async def save(self, records: dict[str, Record], updated_at: datetime) -> dict[str, datetime | None]:
+        ...
+
+    async def purge_expired(self) -> int:
+        return 0
+
+    async def close(self) -> None:
+        pass
+
+
+# Заменитель постоянного хранилища для тестов и локального запуска: данные проходят через JSON, как в БД
+class MemoryStateBackend(StateBackend):
+    def __init__(self):
+        self._records: dict[str, tuple[str | None, str, float, datetime]] = {}
+
+    async def load(self, key: str) -> Record | None:
+        record = self._records.get(key)
+        if record is None:
+            return None
+        return record[0], load_data(record[1]), record[2], record[3]
+
+    async def version(self, key: str) -> datetime | None:
+        record = self._records.get(key)
+        return record[3] if record is not None else None
+
+    async def save(self, records: dict[str, Record], updated_at: datetime) -> dict[str, datetime | None]:
+        written = {}
+        for key, record in records.items():
+            if await self.version(key) != record[3]:
+                continue
+            if is_empty(record):
+                self._records.pop(key, None)
+                written[key] = None
+            else:
+                self._records[key] = (record[0], dump_data(record[1]), record[2], updated_at)
+                written[key] = updated_at
+        return written
+
+    async def purge_expired(self) -> int:
+        now = time.time()
+        expired = [key for key, record in self._records.items() if record[2] <= now]
+        for key in expired:
+            del self._records[key]
+        return len(expired)
+
+
+# Условное обновление пакета строк: строка меняется, только если ее updated_at не изменился с чтения
+_UPDATE_IF_UNCHANGED = text("""
+    UPDATE users_fsmstate AS s
+    SET state = v.state, data = v.data::jsonb, expires_at = v.expires_at, updated_at = :updated_at
+    FROM unnest(:keys, :states, :data, :expires_at, :expected) AS v(key, state, data, expires_at, expected)
+    WHERE s.key = v.key AND s.updated_at = v.expected
+    RETURNING s.key
+""").bindparams(
+    bindparam("keys", type_=ARRAY(String)),
+    bindparam("states", type_=ARRAY(String)),
+    bindparam("data", type_=ARRAY(Text)),
+    bindparam("expires_at", type_=ARRAY(DateTime(timezone=True))),
+    bindparam("expected", type_=ARRAY(DateTime(timezone=True))),
+    bindparam("updated_at", type_=DateTime(timezone=True)),
+)
+
+_DELETE_IF_UNCHANGED = text("""
+    DELETE FROM users_fsmstate AS s
+    USING unnest(:keys, :expected) AS v(key, expected)
+    WHERE s.key = v.key AND s.updated_at = v.expected
+    RETURNING s.key
+""").bindparams(
+    bindparam("keys", type_=ARRAY(String)),
+    bindparam("expected", type_=ARRAY(DateTime(timezone=True))),
+)
+
+
+# Состояния в таблице users_fsmstate. Пакет изменений - не больше трех запросов на batch_size ключей:
+# INSERT ... ON CONFLICT DO NOTHING для новых строк, условные UPDATE и DELETE для существующих
+class PostgresStateBackend(StateBackend):
+    def __init__(self, session_maker: async_sessionmaker, batch_size: int = 500):
+        self.session_maker = session_maker
+        self.batch_size = batch_size
+
+    async def load(self, key: str) -> Record | None:
+        async with self.session_maker() as session:
+            row = (await session.execute(
+                select(FSMState.state, FSMState.data, FSMState.expires_at, FSMState.updated_at)
+                .where(FSMState.key == key)
+            )).first()
+        if row is None:
+            return None
+        return row.state, load_data(json.dumps(row.data)), row.expires_at.timestamp(), row.updated_at
+
+    async def version(self, key: str) -> datetime | None:
+        async with self.session_maker() as session:
+            return (await session.execute(select(FSMState.updated_at).where(FSMState.key == key))).scalar()
+
+    async def save(self, records: dict[str, Record], updated_at: datetime) -> dict[str, datetime | None]:
+        inserts, updates, deletes = [], [], []
+        written = {}
+        for key, record in records.items():
+            state, data, expires_at, expected = record
+            if is_empty(record):
+                if expected is None:
+                    written[key] = None  # строки нет - удалять нечего
+                else:
+                    deletes.append((key, expected))
+                continue
+            row = (key, state, dump_data(data), datetime.fromtimestamp(expires_at, timezone.utc), expected)
+            (inserts if expected is None else updates).append(row)
+
+        async with self.session_maker() as session:
+            for offset in range(0, len(inserts), self.batch_size):
+                stmt = (pg_insert(FSMState)
+                        .values([{'key': key, 'state': state, 'data': json.loads(data), 'expires_at': expires_at,
+                                  'updated_at': updated_at}
+                                 for key, state, data, expires_at, _ in inserts[offset:offset + self.batch_size]])
+                        .on_conflict_do_nothing(index_elements=[FSMState.key])
+                        .returning(FSMState.key))
+                written.update((key, updated_at) for key in (await session.execute(stmt)).scalars())
+            for offset in range(0, len(updates), self.batch_size):
+                keys, states, data, expires_at, expected = zip(*updates[offset:offset + self.batch_size])
+                result = await session.execute(_UPDATE_IF_UNCHANGED, {
+                    'keys': list(keys), 'states': list(states), 'data': list(data),
+                    'expires_at': list(expires_at), 'expected': list(expected), 'updated_at': updated_at,
+                })
+                written.update((key, updated_at) for key in result.scalars())
+            for offset in range(0, len(deletes), self.batch_size):
+                keys, expected = zip(*deletes[offset:offset + self.batch_size])
+                result = await session.execute(_DELETE_IF_UNCHANGED, {'keys': list(keys), 'expected': list(expected)})
+                written.update((key, None) for key in result.scalars())
+            await session.commit()
+        return written
+
+    async def purge_expired(self) -> int:
+        async with self.session_maker() as session:
+            result = await session.execute(delete(FSMState).where(FSMState.expires_at <= datetime.now(timezone.utc)))
+            await session.commit()
+            return result.rowcount
+
+
+# Хранилище FSM в два уровня: ограниченный LRU в памяти процесса и постоянное хранилище.
+# Изменения пишутся пакетами раз в flush_interval; несохраненные записи не вытесняются из памяти.
+# Каждая запись живет ttl секунд с последнего изменения.
+# Запись в хранилище условная (по версии строки): чужое изменение не затирается - конфликтующая запись
+# отбрасывается и перечитывается. Этого достаточно, когда каждый пользователь закреплен за одним процессом
+# (один процесс или SHARD_MODE=processes). Если апдейты одного пользователя могут попасть в разные процессы
+# (несколько реплик вебхука или экземпляров бота), нужен shared=True: версия проверяется при каждом чтении
+# из памяти, а изменения пишутся сразу, без ожидания flush_interval.
+class TieredStorage(BaseStorage):
+    def __init__(self, backend: StateBackend, ttl: float = 86400, max_entries: int = 10_000,
+                 flush_interval: float = 1, purge_interval: float = 600, shared: bool = False):
+        self.backend = backend
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        self.purge_interval = purge_interval
+        self.shared = shared
+        self._entries: OrderedDict[str, Record] = OrderedDict()
+        self._dirty: dict[str, int] = {}  # ключ -> номер последнего изменения
+        self._revision = 0
+        self._flush_lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.evictions = 0
+        self.flushes = 0
+        self.flush_errors = 0
+        self.conflicts = 0
+
+    async def _load(self, key: str) -> Record:
+        loaded = await self.backend.load(key)
+        # Пока шла загрузка, запись могли изменить - не затираем ее
+        record = self._entries.get(key)
+        if record is None or key not in self._dirty:
+            record = loaded or EMPTY
+            self._put(key, record)
+        return record
+
+    async def _get(self, key: str) -> Record:
+        record = self._entries.get(key)
+        if record is None:
+            self.misses += 1
+            record = await self._load(key)
+        else:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            if self.shared and key not in self._dirty and await self.backend.version(key) != record[3]:
+                self.revalidations += 1
+                record = await self._load(key)
+        if record[2] and record[2] <= time.time():
+            return None, {}, 0.0, record[3]  # истекла: пустая, но с версией существующей строки
+        return record
+
+    def _put(self, key: str, record: Record) -> None:
+        self._entries[key] = record
+        self._entries.move_to_end(key)
+        if len(self._entries) <= self.max_entries:
+            return
+        for candidate in list(self._entries):
+            if len(self._entries) <= self.max_entries:
+                break
+            if candidate != key and candidate not in self._dirty:
+                del self._entries[candidate]
+                self.evictions += 1
+
+    async def _write(self, key: str, state: str | None, data: dict[str, Any], version: datetime | None) -> None:
+        self._put(key, (state, data, time.time() + self.ttl, version))
+        self._revision += 1
+        self._dirty[key] = self._revision
+        if self.shared:
+            await self.flush()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record_key = storage_key(key)
+        _, data, _, version = await self._get(record_key)
+        await self._write(record_key, state.state if isinstance(state, State) else state, data, version)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return (await self._get(storage_key(key)))[0]
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        record_key = storage_key(key)
+        state, _, _, version = await self._get(record_key)
+        await self._write(record_key, state, dict(data), version)
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        return dict((await self._get(storage_key(key)))[1])
+
+    # Пакетная запись измененных ключей; пустые записи удаляются из хранилища
+    async def flush(self) -> int:
+        async with self._flush_lock:
+            if not self._dirty:
+                return 0
+            dirty = dict(self._dirty)
+            records = {key: self._entries[key] for key in dirty}
+            try:
+                written = await self.backend.save(records, datetime.now(timezone.utc))
+            except Exception as e:
+                self.flush_errors += 1
+                logger.error(f"Ошибка записи состояний FSM ({len(records)} шт.): {e}")
+                return 0
+            for key, revision in dirty.items():
+                if key not in written:
+                    # Строку изменил другой процесс: его изменение остается, наше отбрасывается
+                    self.conflicts += 1
+                    logger.warning(f"Состояние FSM {key} изменено другим процессом, локальное изменение отброшено")
+                    if self._dirty.get(key) == revision:
+                        del self._dirty[key]
+                        del self._entries[key]
+                    continue
+                # Новая версия нужна и записи, измененной во время сохранения: ее запись тоже условная
+                state, data, expires_at, _ = self._entries[key]
+                self._entries[key] = (state, data, expires_at, written[key])
+                # Ключи, измененные во время записи, остаются помеченными до следующего сброса
+                if self._dirty.get(key) == revision:
+                    del self._dirty[key]
+            self.flushes += 1
+            return len(written)
+
+    async def _flush_loop(self) -> None:
+        last_purge = time.monotonic()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            if self.purge_interval and time.monotonic() - last_purge >= self.purge_interval:
+                last_purge = time.monotonic()
+                try:
+                    purged = await self.backend.purge_expired()
+                    if purged:
+                        logger.info(f"Удалено просроченных состояний FSM: {purged}")
+                except Exception as e:
+                    logger.error(f"Ошибка удаления просроченных состояний FSM: {e}")
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    # Вызывается диспетчером при остановке: последний сброс несохраненных изменений
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+        await self.backend.close()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'dirty': len(self._dirty),
+            'hit_ratio': round(self.hits / total, 4) if total else 0.0,
+            'revalidations': self.revalidations,
+            'evictions': self.evictions,
+            'flushes': self.flushes,
+            'flush_errors': self.flush_errors,
+            'conflicts': self.conflicts,
+        }
@@ -3,16 +3,22 @@ import os
 
 from aiogram import types, Bot, Router, F
 from aiogram.enums import ParseMode
-from aiogram.filters import CommandStart
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.filters import Command, CommandObject, CommandStart
 from aiogram.fsm.context import FSMContext
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, LabeledPrice, PreCheckoutQuery
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, LabeledPrice, PreCheckoutQuery, \
+    InlineQuery, InlineQueryResultArticle, InputTextMessageContent
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from dotenv import load_dotenv
+from sqlalchemy.ext.asyncio import AsyncSession
 
+from cart import format_cart
 from database import fetch_product, \
-    add_to_cart, fetch_cart, remove_from_cart, clear_cart, add_user_if_not_exists
+    add_to_cart, fetch_cart, remove_from_cart, clear_cart, add_user_if_not_exists, get_photo_file_id, \
+    save_photo_file_id, search_products, create_order, fetch_order_by_payload, mark_order_paid, cancel_order
 from keyboards import create_categories_keyboard, \
-    create_subcategories_keyboard, create_products_keyboard, send_categories_keyboard, create_faq_keyboard
+    create_subcategories_keyboard, create_products_keyboard, send_categories_keyboard, create_faq_keyboard, \
+    create_search_keyboard, parse_page_callback
 from state import QuantityForm, DeliveryForm
 from utils import check_subscription_by_username
 
@@ -24,15 +30,19 @@ logger = logging.getLogger(__name__)
 CHANNEL_USERNAME = os.getenv("CHANNEL_ID")
 PROVIDER_TOKEN = os.getenv("PROVIDER_TOKEN")
 BOSS = os.getenv("BOSS")
+# Чат администратора для уведомлений о платежах, которые требуют ручной обработки
+ADMIN_CHAT_ID = os.getenv("ADMIN_CHAT_ID")
+# Каталог медиафайлов админки: фото товаров после обработки хранятся там
+MEDIA_ROOT = os.getenv("MEDIA_ROOT", "../admin/media")
 
 
 # обработчик команды start
 @router.message(CommandStart())
-async def command_start_handler(message: types.Message, bot: Bot):
+async def command_start_handler(message: types.Message, bot: Bot, session: AsyncSession):
     user_id = message.from_user.id
 
     # Добавляем пользователя в базу данных, если его там еще нет
-    await add_user_if_not_exists(user_id, message.from_user.username, message.from_user.first_name,
+    await add_user_if_not_exists(session, user_id, message.from_user.username, message.from_user.first_name,
                                  message.from_user.last_name
                                  )
 
@@ -69,16 +79,45 @@ async def category_callback(query: CallbackQuery):
 async def subcategory_callback(query: CallbackQuery):
     subcategory_id = int(query.data.split(":")[1])
     keyboard = await create_products_keyboard(subcategory_id)
+    if keyboard is None:  # подкатегорию удалили - показываем категории
+        await send_categories_keyboard(query)
+        return
 
     await query.message.edit_text(text="Выберите товар:", reply_markup=keyboard)
     await query.answer()
 
 
+# Отправка фото товара: по сохраненному file_id, либо загрузкой (URL или файл из медиа) с запоминанием file_id
+async def send_product_photo(session: AsyncSession, message: types.Message, product, caption: str,
+                             reply_markup: InlineKeyboardMarkup):
+    file_id = get_photo_file_id(product)
+    if file_id:
+        try:
+            await message.answer_photo(photo=file_id, caption=caption, parse_mode=ParseMode.HTML,
+                                       reply_markup=reply_markup)
+            return
+        except TelegramBadRequest as e:
+            logger.warning(f"file_id фото товара {product.id} недействителен, загружаем заново: {e}")
+            await save_photo_file_id(session, product.id, product.photo, None)
+
+    if product.photo.startswith(("http://", "https://")):
+        photo = types.URLInputFile(product.photo)
+    else:
+        photo = types.FSInputFile(os.path.join(MEDIA_ROOT, product.photo))
+    sent = await message.answer_photo(
+        photo=photo,
+        caption=caption,
+        parse_mode=ParseMode.HTML,
+        reply_markup=reply_markup
+    )
+    await save_photo_file_id(session, product.id, product.photo, sent.photo[-1].file_id)
+
+
 # Обработчик выбора товара
 @router.callback_query(F.data.startswith("product:"))
-async def product_callback(query: CallbackQuery, state: FSMContext):
+async def product_callback(query: CallbackQuery, state: FSMContext, session: AsyncSession):
     product_id = int(query.data.split(":")[1])
-    product = await fetch_product(product_id)
+    product = await fetch_product(session, product_id)
 
     if product:
 
@@ -106,12 +145,7 @@ async def product_callback(query: CallbackQuery, state: FSMContext):
         # Проверка на наличие фото
         if product.photo:
             try:
-                await query.message.answer_photo(
-                    photo=types.URLInputFile(product.photo),
-                    caption=caption,
-                    parse_mode=ParseMode.HTML,
-                    reply_markup=keyboard.as_markup()
-                )
+                await send_product_photo(session, query.message, product, caption, keyboard.as_markup())
             except Exception as e:
                 logging.error(f"Ошибка вывода фото: {e}")
                 await query.message.answer(
@@ -146,7 +180,7 @@ async def add_to_cart_callback(query: CallbackQuery, state: FSMContext):
 
 # Обработчик ввода количества товара
 @router.message(QuantityForm.quantity)
-async def process_quantity(message: types.Message, state: FSMContext):
+async def process_quantity(message: types.Message, state: FSMContext, session: AsyncSession):
     try:
         quantity = int(message.text)
         if quantity <= 0:
@@ -162,7 +196,7 @@ async def process_quantity(message: types.Message, state: FSMContext):
             await state.clear()
             return
 
-        success = await add_to_cart(message.from_user.id, product_id, quantity)
+        success = await add_to_cart(session, message.from_user.id, product_id, quantity)
         if success:
             await message.answer(
                 f"Добавлено {quantity} шт. в корзину!",
@@ -189,27 +223,21 @@ async def process_quantity(message: types.Message, state: FSMContext):
 
 # Обработчик просмотра корзины
 @router.callback_query(F.data == "view_cart")
-async def view_cart_callback(query: CallbackQuery):
-    cart_items = await fetch_cart(query.from_user.id)
+async def view_cart_callback(query: CallbackQuery, session: AsyncSession):
+    cart = await fetch_cart(session, query.from_user.id)
 
-    if not cart_items:
+    if not cart:
         await query.message.answer("Ваша корзина пуста.")
         await query.answer()
         return
 
-    total_amount = 0
-    cart_text = "<b>Ваша корзина:</b>\n\n"
-    for item in cart_items:
-        cart_text += f"{item['name']} x {item['quantity']} - {item['price'] * item['quantity']} руб.\n"
-        total_amount += item['price'] * item['quantity']
-
-    cart_text += f"\n<b>Итого: {total_amount} руб.</b>"
+    cart_text = "<b>Ваша корзина:</b>\n\n" + format_cart(cart)
 
     # Добавляем кнопки для удаления товаров и перехода к оформлению
     keyboard = InlineKeyboardBuilder()
-    for item in cart_items:
+    for item in cart.lines:
         keyboard.row(
-            InlineKeyboardButton(text=f"Удалить {item['name']}", callback_data=f"remove_from_cart:{item['id']}")
+            InlineKeyboardButton(text=f"Удалить {item.name}", callback_data=f"remove_from_cart:{item.product_id}")
         )
     keyboard.row(InlineKeyboardButton(text="Оформить заказ", callback_data="checkout"))
     keyboard.row(InlineKeyboardButton(text="Назад к категориям", callback_data="back_to_categories"))
@@ -220,12 +248,12 @@ async def view_cart_callback(query: CallbackQuery):
 
 # Обработчик удаления товара из корзины
 @router.callback_query(F.data.startswith("remove_from_cart:"))
-async def remove_from_cart_callback(query: CallbackQuery):
-    item_id = int(query.data.split(":")[1])
-    if await remove_from_cart(item_id):
+async def remove_from_cart_callback(query: CallbackQuery, session: AsyncSession):
+    product_id = int(query.data.split(":")[1])
+    if await remove_from_cart(session, query.from_user.id, product_id):
         await query.message.answer("Товар удален из корзины.")
         # Обновляем отображение корзины
-        await view_cart_callback(query)
+        await view_cart_callback(query, session)
     else:
         await query.answer("Не удалось удалить товар.")
 
@@ -256,24 +284,26 @@ async def process_address(message: types.Message, state: FSMContext):
 
 # Обработчик ввода номера телефона для доставки и подтверждения заказа
 @router.message(DeliveryForm.phone)
-async def process_phone(message: types.Message, state: FSMContext):
+async def process_phone(message: types.Message, state: FSMContext, session: AsyncSession):
     await state.update_data(phone=message.text)
     delivery_data = await state.get_data()
 
     # Получаем данные о корзине пользователя
-    cart_items = await fetch_cart(message.from_user.id)
-    if not cart_items:
+    cart = await fetch_cart(session, message.from_user.id)
+    if not cart:
         await message.answer("Ваша корзина пуста.")
         await state.clear()
         return
 
-    total_amount = 0
-    order_text = "<b>Подтвердите ваш заказ:</b>\n\n"
-    for item in cart_items:
-        order_text += f"{item['name']} x {item['quantity']} - {item['price'] * item['quantity']} руб.\n"
-        total_amount += item['price'] * item['quantity']
+    # Заказ фиксируется сразу: дальше оплата сверяется с ним, а не с корзиной
+    order_payload = await create_order(session, message.from_user.id, cart, delivery_data['name'],
+                                       delivery_data['address'], delivery_data['phone'])
+    if order_payload is None:
+        await message.answer("Не удалось оформить заказ. Попробуйте еще раз.")
+        await state.clear()
+        return
 
-    order_text += f"\n<b>Итого: {total_amount} руб.</b>"
+    order_text = "<b>Подтвердите ваш заказ:</b>\n\n" + format_cart(cart)
     order_text += (f"\n\n<b>Данные доставки:</b>\nИмя: {delivery_data['name']}\n"
                    f"Адрес: {delivery_data['address']}\nТелефон: {delivery_data['phone']}")
 
@@ -283,36 +313,38 @@ async def process_phone(message: types.Message, state: FSMContext):
     keyboard.row(InlineKeyboardButton(text="Отмена", callback_data="cancel_order"))  # Добавляем кнопку отмены
 
     await message.answer(order_text, parse_mode=ParseMode.HTML, reply_markup=keyboard.as_markup())
-    await state.update_data(total_amount=total_amount)  # Сохраняем сумму для оплаты
+    await state.update_data(order_payload=order_payload)  # Сохраняем заказ для оплаты
     await state.set_state(None)  # Сбрасываем состояние
 
 
 # Обработчик нажатия кнопки "Оплатить
 @router.callback_query(F.data == "pay")
-async def pay_callback(query: CallbackQuery, state: FSMContext, bot: Bot):
+async def pay_callback(query: CallbackQuery, state: FSMContext, bot: Bot, session: AsyncSession):
     try:
         if not PROVIDER_TOKEN:
             await query.answer("Ошибка: не настроен токен для платежей.")
             return
 
-        user_data = await state.get_data()
-        total_amount = user_data.get('total_amount', 0)
-
-        if total_amount <= 0:
+        order_payload = (await state.get_data()).get('order_payload')
+        order = await fetch_order_by_payload(session, order_payload) if order_payload else None
+        if order is None or order.status != order.STATUS_PENDING:
+            await query.answer("Заказ не найден или уже оплачен. Оформите заказ заново.")
+            return
+        if order.total <= 0:
             await query.answer("Некорректная сумма заказа.")
             return
 
-        prices = [LabeledPrice(label="Заказ", amount=int(total_amount * 100))]
+        prices = [LabeledPrice(label=f"Заказ №{order.id}", amount=int(order.total * 100))]
 
         await bot.send_invoice(
             chat_id=query.from_user.id,
             title="Оплата заказа",
             description="Оплата вашего заказа в Telegram боте.",
             provider_token=PROVIDER_TOKEN,
-            currency="RUB",
+            currency=order.currency,
             prices=prices,
             start_parameter="example",
-            payload=f"order_id_{query.from_user.id}_{total_amount}",
+            payload=order.invoice_payload,
             need_name=True,
             need_phone_number=True,
             need_shipping_address=False,  # адрес доставки
@@ -325,23 +357,22 @@ async def pay_callback(query: CallbackQuery, state: FSMContext, bot: Bot):
         await query.answer("Произошла ошибка при подготовке оплаты.")
 
 
-# Проверка перед оплатой - здесь можно проверять наличие товара, возможность доставки и другие параметры заказа
+# Проверка перед оплатой: один запрос заказа по уникальному индексу payload.
+# Telegram ждет ответа не дольше 10 секунд
 @router.pre_checkout_query(lambda query: True)  # Обрабатывает все pre_checkout_query
-async def pre_checkout_query_handler(query: PreCheckoutQuery, bot: Bot, state: FSMContext):
-    # Получаем данные, которые мы сохранили ранее (например, total_amount)
-    user_data = await state.get_data()
-    total_amount_from_state = user_data.get('total_amount', 0)
+async def pre_checkout_query_handler(query: PreCheckoutQuery, bot: Bot, session: AsyncSession):
     order_payload = query.invoice_payload  # Получаем payload, который мы отправляли
-
-    # Простая проверка суммы
-    if query.total_amount != int(total_amount_from_state * 100):
-        await bot.answer_pre_checkout_query(pre_checkout_query_id=query.id,
-                                            ok=False,
-                                            error_message="Некорректная сумма заказа. Пожалуйста, попробуйте еще раз."
-                                            )
-        logger.info(f"PreCheckoutQuery: Неверная сумма."
-                    f" Ожидали {int(total_amount_from_state * 100)}, получили {query.total_amount}"
-                    )
+    order = await fetch_order_by_payload(session, order_payload)
+
+    error_message = None
+    if order is None or order.status != order.STATUS_PENDING:
+        error_message = "Заказ не найден или уже оплачен. Пожалуйста, оформите заказ заново."
+    elif query.total_amount != int(order.total * 100) or query.currency != order.currency:
+        error_message = "Некорректная сумма заказа. Пожалуйста, попробуйте еще раз."
+    if error_message:
+        await bot.answer_pre_checkout_query(pre_checkout_query_id=query.id, ok=False, error_message=error_message)
+        logger.info(f"PreCheckoutQuery: платеж отклонен для payload {order_payload}: {error_message}"
+                    f" Получили {query.total_amount} {query.currency}")
         return
 
     # Если все проверки пройдены, подтверждаем платеж
@@ -349,24 +380,55 @@ async def pre_checkout_query_handler(query: PreCheckoutQuery, bot: Bot, state: F
     logging.info(f"PreCheckoutQuery: Платеж подтвержден для payload: {order_payload}")
 
 
-# Обработчик успешной оплаты
+# Обработчик успешной оплаты. Telegram может доставить сообщение повторно - заказ обрабатывается один раз
 @router.message(F.content_type == types.ContentType.SUCCESSFUL_PAYMENT)
-async def successful_payment(message: types.Message, state: FSMContext):
+async def successful_payment(message: types.Message, state: FSMContext, session: AsyncSession):
     payment_info = message.successful_payment
     order_payload = payment_info.invoice_payload
 
+    result = await mark_order_paid(session, order_payload, payment_info.telegram_payment_charge_id,
+                                   payment_info.provider_payment_charge_id)
+    if result == 'duplicate':
+        logger.info(f"Повторное уведомление об оплате {payment_info.telegram_payment_charge_id} пропущено")
+        return
+    if result in ('paid_cancelled', 'paid_twice'):
+        reason = "заказ был отменен" if result == 'paid_cancelled' else "заказ уже был оплачен"
+        await message.answer(f"Оплата получена, но {reason}. Мы вернем деньги или восстановим заказ"
+                             f" и свяжемся с вами.\nID платежа: {payment_info.telegram_payment_charge_id}")
+        if ADMIN_CHAT_ID:
+            await message.bot.send_message(
+                ADMIN_CHAT_ID,
+                f"⚠️ Оплата требует возврата или восстановления заказа: {reason}.\n"
+                f"Заказ: {order_payload}\n"
+                f"Пользователь: {message.from_user.id}\n"
+                f"Сумма: {payment_info.total_amount / 100} {payment_info.currency}\n"
+                f"ID платежа Telegram: {payment_info.telegram_payment_charge_id}\n"
+                f"ID платежа провайдера: {payment_info.provider_payment_charge_id}"
+            )
+        else:
+            logger.error(f"ADMIN_CHAT_ID не задан: платеж {payment_info.telegram_payment_charge_id}"
+                         f" по заказу {order_payload} требует ручной обработки")
+        await state.clear()
+        return
+    if result is None:
+        await message.answer("Оплата получена, но заказ не найден. Мы свяжемся с вами.")
+        return
+
     await message.answer(f"✅ Ваш заказ успешно оплачен!\n"
                          f"ID платежа: {payment_info.telegram_payment_charge_id}\n"
                          f"Сумма: {payment_info.total_amount / 100} {payment_info.currency}\n"
                          f"Заказ: {order_payload}"
                          )
-    await clear_cart(message.from_user.id)  # Очищаем корзину после успешной оплаты
+    await clear_cart(session, message.from_user.id)  # Очищаем корзину после успешной оплаты
     await state.clear()  # Очистка state для этого пользователя
 
 
 # Обработчик отмены заказа
 @router.callback_query(F.data == "cancel_order")
-async def cancel_order_callback(query: CallbackQuery, state: FSMContext):
+async def cancel_order_callback(query: CallbackQuery, state: FSMContext, session: AsyncSession):
+    order_payload = (await state.get_data()).get('order_payload')
+    if order_payload:
+        await cancel_order(session, query.from_user.id, order_payload)
     keyboard = InlineKeyboardBuilder()
     keyboard.row(InlineKeyboardButton(text="Перейти в корзину", callback_data="view_cart"))
     await query.message.answer("Заказ отменен.")
@@ -374,6 +436,59 @@ async def cancel_order_callback(query: CallbackQuery, state: FSMContext):
     await query.answer()
 
 
+# Обработчик команды /search <текст>
+@router.message(Command("search"))
+async def search_handler(message: types.Message, command: CommandObject, state: FSMContext):
+    query = (command.args or "").strip()
+    if not query:
+        await message.answer("Введите запрос после команды, например: /search молоко")
+        return
+
+    keyboard, total = await create_search_keyboard(query)
+    if not total:
+        await message.answer(f"По запросу «{query}» ничего не найдено.")
+        return
+    await state.update_data(search_query=query)  # Запрос нужен для перелистывания страниц
+    await message.answer(f"Найдено товаров: {total}", reply_markup=keyboard)
+
+
+# Обработчик пагинации результатов поиска
+@router.callback_query(F.data.startswith("search:page:"))
+async def search_page_callback(query: CallbackQuery, state: FSMContext):
+    _, page, _ = parse_page_callback(query.data, with_cursor=False)
+    search_query = (await state.get_data()).get("search_query")
+    if not search_query:
+        await query.answer("Поиск устарел, повторите команду /search.")
+        return
+    keyboard, total = await create_search_keyboard(search_query, page)
+    await query.message.edit_text(f"Найдено товаров: {total}", reply_markup=keyboard)
+    await query.answer()
+
+
+# Инлайн-поиск товаров (@бот запрос); offset - номер первого результата следующей страницы
+@router.inline_query()
+async def inline_search_handler(inline_query: InlineQuery):
+    items_per_page = 20
+    offset = int(inline_query.offset or 0)
+    products, total = await search_products(inline_query.query, offset, items_per_page)
+    results = [
+        InlineQueryResultArticle(
+            id=str(product.id),
+            title=product.name,
+            description=f"{product.price} руб.",
+            input_message_content=InputTextMessageContent(
+                message_text=(f"<b>{product.name}</b>\n\n"
+                              f"{product.description or ''}\n\n"
+                              f"Цена: {product.price} руб."),
+                parse_mode=ParseMode.HTML,
+            ),
+        )
+        for product in products
+    ]
+    next_offset = str(offset + items_per_page) if offset + items_per_page < total else ""
+    await inline_query.answer(results, cache_time=60, is_personal=False, next_offset=next_offset)
+
+
 # Обработчик кнопки FAQ
 @router.message(F.text == "/faq")
 async def faq_button(message: types.Message):
@@ -400,38 +515,40 @@ async def faq_callback(query: types.CallbackQuery):
                                    )
 
 
-# Обработчик пагинации категорий
+# Обработчик пагинации категорий: categories:page:<номер>:<курсор>
 @router.callback_query(F.data.startswith("categories:page:"))
 async def categories_page_callback(query: CallbackQuery):
-    page = int(query.data.split(":")[2])
-    await query.message.edit_text("Выберите категорию:", reply_markup=await create_categories_keyboard(page))
+    _, page, cursor = parse_page_callback(query.data)
+    await query.message.edit_text("Выберите категорию:",
+                                  reply_markup=await create_categories_keyboard(page, cursor)
+                                  )
     await query.answer()
 
 
-# Обработчик пагинации подкатегорий
-# Максимум 10 страниц для примера
-@router.callback_query(F.data.startswith("subcategory:") & F.data.endswith((":page:" + str(i) for i in range(1, 10))))
+# Обработчик пагинации подкатегорий: subcategories:<категория>:page:<номер>:<курсор>.
+# Без категории в callback_data (кнопка старого формата) - список категорий
+@router.callback_query(F.data.startswith("subcategories:"))
 async def subcategories_page_callback(query: CallbackQuery):
-    data_parts = query.data.split(":")
-    category_id = int(data_parts[1])
-    page = int(data_parts[3])
+    category_id, page, cursor = parse_page_callback(query.data)
+    if category_id is None:
+        await send_categories_keyboard(query)
+        return
     await query.message.edit_text("Выберите подкатегорию:",
-                                  reply_markup=await create_subcategories_keyboard(category_id, page)
+                                  reply_markup=await create_subcategories_keyboard(category_id, page, cursor)
                                   )
     await query.answer()
 
 
-# Обработчик пагинации товаров
-# Максимум 10 страниц для примера
-@router.callback_query(F.data.startswith("products:") & F.data.endswith((":page:" + str(i) for i in range(1, 10))))
+# Обработчик пагинации товаров: products:<подкатегория>:page:<номер>:<курсор>.
+# Без подкатегории в callback_data (кнопка старого формата) или если ее удалили - список категорий
+@router.callback_query(F.data.startswith("products:"))
 async def products_page_callback(query: CallbackQuery):
-    data_parts = query.data.split(":")
-    subcategory_id = int(data_parts[1])
-    page = int(data_parts[3])
-    await query.message.edit_text("Выберите товар:", reply_markup=await create_products_keyboard(subcategory_id,
-                                                                                                 page
-                                                                                                 )
-                                  )
+    subcategory_id, page, cursor = parse_page_callback(query.data)
+    keyboard = await create_products_keyboard(subcategory_id, page, cursor) if subcategory_id is not None else None
+    if keyboard is None:
+        await send_categories_keyboard(query)
+        return
+    await query.message.edit_text("Выберите товар:", reply_markup=keyboard)
     await query.answer()
 
 
@@ -1,9 +1,60 @@
+import os
+import re
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Hashable
+
 from aiogram import types
 
+import metrics
+
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
-from database import fetch_categories, fetch_subcategories, fetch_products_by_subcategory, fetch_subcategory
+from database import CATALOG_CACHE_TTL, catalog_cache, count_catalog_items, fetch_catalog_page, fetch_subcategory, \
+    search_products
+
+
+# Кэш готовых клавиатур каталога. Сбрасывается целиком при смене версии каталога.
+# Разметка отдается всем пользователям одним объектом - изменять ее после построения нельзя.
+class KeyboardCache:
+    def __init__(self, max_size: int = 2000, ttl: float = 300):
+        self.max_size = max_size
+        self.ttl = ttl  # 0 - без TTL
+        self._items: OrderedDict[Hashable, tuple[float, InlineKeyboardMarkup | None]] = OrderedDict()
+        self._version = catalog_cache.version
+        self.hits = 0
+        self.misses = 0
+
+    async def get_or_build(self, key: Hashable,
+                           build: Callable[[], Awaitable[InlineKeyboardMarkup | None]]) -> InlineKeyboardMarkup | None:
+        if self._version != catalog_cache.version:
+            self._items.clear()
+            self._version = catalog_cache.version
+
+        cached = self._items.get(key)
+        if cached and (not self.ttl or time.monotonic() - cached[0] < self.ttl):
+            self._items.move_to_end(key)
+            self.hits += 1
+            return cached[1]
+
+        self.misses += 1
+        version = self._version
+        markup = await build()
+        # Если каталог изменился во время построения, клавиатуру не кэшируем
+        if version == catalog_cache.version:
+            self._items[key] = (time.monotonic(), markup)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+        return markup
+
+    def stats(self) -> dict:
+        return {'version': self._version, 'size': len(self._items), 'hits': self.hits, 'misses': self.misses}
+
+
+keyboard_cache = KeyboardCache(max_size=int(os.getenv("KEYBOARD_CACHE_SIZE", 2000)), ttl=CATALOG_CACHE_TTL)
+metrics.register("keyboard_cache", keyboard_cache.stats)
 
 
 # Клавиатура категорий
@@ -15,64 +66,110 @@ async def send_categories_keyboard(query: types.CallbackQuery):
     await query.answer()
 
 
+# Курсор страницы в callback_data: "a<id>" - после id, "b<id>" - перед id
+PAGE_CURSOR = re.compile(r"[ab]\d+")
+
+
+def parse_cursor(cursor: str | None) -> tuple[int | None, int | None]:
+    if not cursor or cursor == "a0":
+        return None, None
+    if cursor[0] == "b":
+        return None, int(cursor[1:])
+    return int(cursor[1:]), None
+
+
+# callback_data пагинации: <префикс>[:<родитель>]:page:<номер>:<курсор> -> (родитель, номер, курсор).
+# Кнопки старых сообщений (без курсора, в прежнем формате) открывают первую страницу;
+# родитель None - его в callback_data нет или он не число.
+# with_cursor=False - страницы без курсора (поиск): <префикс>:page:<номер>
+def parse_page_callback(data: str, with_cursor: bool = True) -> tuple[int | None, int, str | None]:
+    parts = data.split(":")
+    parent_id = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else None
+    if not with_cursor:
+        if len(parts) >= 2 and parts[-2] == "page" and parts[-1].isdigit():
+            return parent_id, max(int(parts[-1]), 1), None
+        return parent_id, 1, None
+    if len(parts) >= 3 and parts[-3] == "page" and parts[-2].isdigit() and PAGE_CURSOR.fullmatch(parts[-1]):
+        return parent_id, max(int(parts[-2]), 1), parts[-1]
+    return parent_id, 1, None
+
+
 # кнопки пагинации
-def create_pagination_buttons(current_page: int, total_pages: int, prefix: str) -> list[InlineKeyboardButton]:
+def create_pagination_buttons(current_page: int, total_pages: int, prefix: str,
+                              first_id: int, last_id: int) -> list[InlineKeyboardButton]:
     buttons = []
     if current_page > 1:
-        buttons.append(InlineKeyboardButton(text="⬅️", callback_data=f"{prefix}:page:{current_page - 1}"))
+        buttons.append(InlineKeyboardButton(text="⬅️", callback_data=f"{prefix}:page:{current_page - 1}:b{first_id}"))
     buttons.append(InlineKeyboardButton(text=f"{current_page}/{total_pages}", callback_data="ignore"))
     if current_page < total_pages:
-        buttons.append(InlineKeyboardButton(text="➡️", callback_data=f"{prefix}:page:{current_page + 1}"))
+        buttons.append(InlineKeyboardButton(text="➡️", callback_data=f"{prefix}:page:{current_page + 1}:a{last_id}"))
     return buttons
 
 
+# Страница уровня каталога и общее число страниц; при устаревшем курсоре - первая страница
+async def fetch_page(level: str, parent_id: int | None, page: int, cursor: str | None,
+                     items_per_page: int) -> tuple[tuple, int, int]:
+    after_id, before_id = parse_cursor(cursor)
+    items = await fetch_catalog_page(level, parent_id, after_id, before_id, items_per_page)
+    if not items and (after_id or before_id):
+        page = 1
+        items = await fetch_catalog_page(level, parent_id, limit=items_per_page)
+    total = await count_catalog_items(level, parent_id) if items else 0
+    total_pages = (total + items_per_page - 1) // items_per_page
+    return items, min(page, max(total_pages, 1)), total_pages
+
+
 # Клавиатура категорий с пагинацией
-async def create_categories_keyboard(page: int = 1) -> InlineKeyboardMarkup:
-    categories = await fetch_categories()
+async def create_categories_keyboard(page: int = 1, cursor: str | None = None) -> InlineKeyboardMarkup:
+    return await keyboard_cache.get_or_build(("categories", None, page, cursor),
+                                             lambda: build_categories_keyboard(page, cursor))
+
+
+async def build_categories_keyboard(page: int, cursor: str | None) -> InlineKeyboardMarkup:
+    items_per_page = 5  # Количество категорий на одной странице
+    categories, page, total_pages = await fetch_page("categories", None, page, cursor, items_per_page)
     if not categories:
         return InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="Нет категорий",
                                                                            callback_data="ignore")],
                                                      [InlineKeyboardButton(text="Перейти в корзину",
                                                                            callback_data="view_cart")]])
 
-    items_per_page = 5  # Количество категорий на одной странице
-    start_index = (page - 1) * items_per_page
-    end_index = start_index + items_per_page
-    current_categories = categories[start_index:end_index]
-    total_pages = (len(categories) + items_per_page - 1) // items_per_page
-
     builder = InlineKeyboardBuilder()
-    for category in current_categories:
+    for category in categories:
         builder.row(InlineKeyboardButton(text=category.name, callback_data=f"category:{category.id}"))
     builder.row(InlineKeyboardButton(text="Перейти в корзину", callback_data="view_cart"))
 
     if total_pages > 1:
-        builder.row(*create_pagination_buttons(page, total_pages, "category"))
+        builder.row(*create_pagination_buttons(page, total_pages, "categories",
+                                               categories[0].id, categories[-1].id))
 
     return builder.as_markup()
 
 
 # Клавиатура подкатегорий с пагинацией
-async def create_subcategories_keyboard(category_id: int, page: int = 1) -> InlineKeyboardMarkup:
-    subcategories = await fetch_subcategories(category_id)
+async def create_subcategories_keyboard(category_id: int, page: int = 1,
+                                        cursor: str | None = None) -> InlineKeyboardMarkup:
+    return await keyboard_cache.get_or_build(("subcategories", category_id, page, cursor),
+                                             lambda: build_subcategories_keyboard(category_id, page, cursor))
+
+
+async def build_subcategories_keyboard(category_id: int, page: int, cursor: str | None) -> InlineKeyboardMarkup:
+    items_per_page = 5  # Количество подкатегорий на одной странице
+    subcategories, page, total_pages = await fetch_page("subcategories", category_id, page, cursor,
+                                                        items_per_page)
     if not subcategories:
         return InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="Нет подкатегорий",
                                                                            callback_data="ignore")],
                                                      [InlineKeyboardButton(text="Перейти в корзину",
                                                                            callback_data="view_cart")]])
 
-    items_per_page = 5  # Количество подкатегорий на одной странице
-    start_index = (page - 1) * items_per_page
-    end_index = start_index + items_per_page
-    current_subcategories = subcategories[start_index:end_index]
-    total_pages = (len(subcategories) + items_per_page - 1) // items_per_page
-
     builder = InlineKeyboardBuilder()
-    for subcategory in current_subcategories:
+    for subcategory in subcategories:
         builder.row(InlineKeyboardButton(text=subcategory.name, callback_data=f"subcategory:{subcategory.id}"))
 
     if total_pages > 1:
-        builder.row(*create_pagination_buttons(page, total_pages, f"subcategory:{category_id}"))
+        builder.row(*create_pagination_buttons(page, total_pages, f"subcategories:{category_id}",
+                                               subcategories[0].id, subcategories[-1].id))
 
     builder.row(InlineKeyboardButton(text="Назад к категориям", callback_data=f"back_to_categories"))
     builder.row(InlineKeyboardButton(text="Перейти в корзину", callback_data="view_cart"))
@@ -80,10 +177,19 @@ async def create_subcategories_keyboard(category_id: int, page: int = 1) -> Inli
     return builder.as_markup()
 
 
-# клавиатура товаров с пагинацией
-async def create_products_keyboard(subcategory_id: int, page: int = 1) -> InlineKeyboardMarkup:
-    products = await fetch_products_by_subcategory(subcategory_id)
+# клавиатура товаров с пагинацией; None - подкатегории больше нет (кнопка из старого сообщения)
+async def create_products_keyboard(subcategory_id: int, page: int = 1,
+                                   cursor: str | None = None) -> InlineKeyboardMarkup | None:
+    return await keyboard_cache.get_or_build(("products", subcategory_id, page, cursor),
+                                             lambda: build_products_keyboard(subcategory_id, page, cursor))
+
+
+async def build_products_keyboard(subcategory_id: int, page: int, cursor: str | None) -> InlineKeyboardMarkup | None:
     subcategory = await fetch_subcategory(subcategory_id)
+    if subcategory is None:
+        return None
+    items_per_page = 3  # Количество товаров на одной странице
+    products, page, total_pages = await fetch_page("products", subcategory_id, page, cursor, items_per_page)
     if not products:
         keyboard = InlineKeyboardBuilder()
         keyboard.row(InlineKeyboardButton(text="Нет товаров", callback_data="ignore"))
@@ -92,18 +198,13 @@ async def create_products_keyboard(subcategory_id: int, page: int = 1) -> Inline
         keyboard.row(InlineKeyboardButton(text="Перейти в корзину", callback_data="view_cart"))
         return keyboard.as_markup()
 
-    items_per_page = 3  # Количество товаров на одной странице
-    start_index = (page - 1) * items_per_page
-    end_index = start_index + items_per_page
-    current_products = products[start_index:end_index]
-    total_pages = (len(products) + items_per_page - 1) // items_per_page
-
     builder = InlineKeyboardBuilder()
-    for product in current_products:
+    for product in products:
         builder.row(InlineKeyboardButton(text=product.name, callback_data=f"product:{product.id}"))
 
     if total_pages > 1:
-        builder.row(*create_pagination_buttons(page, total_pages, f"products:{subcategory_id}"))
+        builder.row(*create_pagination_buttons(page, total_pages, f"products:{subcategory_id}",
+                                               products[0].id, products[-1].id))
 
     builder.row(InlineKeyboardButton(text="Назад к подкатегориям", callback_data=f"category:{subcategory.category_id}"))
     builder.row(InlineKeyboardButton(text="Перейти в корзину", callback_data="view_cart"))
@@ -111,6 +212,30 @@ async def create_products_keyboard(subcategory_id: int, page: int = 1) -> Inline
     return builder.as_markup()
 
 
+# Клавиатура результатов поиска с пагинацией; запрос хранится в FSM, в callback_data - только страница
+async def create_search_keyboard(query: str, page: int = 1) -> tuple[InlineKeyboardMarkup, int]:
+    items_per_page = 5  # Количество результатов на одной странице
+    products, total = await search_products(query, (page - 1) * items_per_page, items_per_page)
+    total_pages = (total + items_per_page - 1) // items_per_page
+
+    builder = InlineKeyboardBuilder()
+    for product in products:
+        builder.row(InlineKeyboardButton(text=f"{product.name} - {product.price} руб.",
+                                         callback_data=f"product:{product.id}"))
+
+    if total_pages > 1:
+        buttons = []
+        if page > 1:
+            buttons.append(InlineKeyboardButton(text="⬅️", callback_data=f"search:page:{page - 1}"))
+        buttons.append(InlineKeyboardButton(text=f"{page}/{total_pages}", callback_data="ignore"))
+        if page < total_pages:
+            buttons.append(InlineKeyboardButton(text="➡️", callback_data=f"search:page:{page + 1}"))
+        builder.row(*buttons)
+
+    builder.row(InlineKeyboardButton(text="Назад к категориям", callback_data="back_to_categories"))
+    return builder.as_markup(), total
+
+
 # Обработчик кнопки FAQ
 async def create_faq_keyboard():
     keyboard = InlineKeyboardBuilder()
@@ -0,0 +1,468 @@
+import asyncio
+import json
+import logging
+import mimetypes
+import os
+import secrets
+import socket
+import time
+from dataclasses import dataclass, field
+from datetime import timedelta
+
+from aiogram import Bot, types
+from aiogram.exceptions import TelegramForbiddenError
+from sqlalchemy import extract, func, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+import metrics
+from models import Mailing, MailingAttachment, User
+from rate_limit import bulk_priority
+
+logger = logging.getLogger(__name__)
+
+# Канал Postgres LISTEN/NOTIFY: админка и планировщик сообщают о новых и измененных рассылках
+MAILING_CHANNEL = "mailing_changed"
+
+DELIVERED = "delivered"
+BLOCKED = "blocked"
+FAILED = "failed"
+
+CAPTION_LIMIT = 1024  # длиннее подписи к медиа Telegram не принимает - текст уходит отдельным сообщением
+
+# Тип медиа -> класс элемента альбома; анимации в альбомах Telegram не поддерживает - админка их в альбом
+# не пускает, а в рассылках, сохраненных до этой проверки, они уходят документом
+INPUT_MEDIA = {
+    "photo": types.InputMediaPhoto,
+    "video": types.InputMediaVideo,
+    "audio": types.InputMediaAudio,
+    "document": types.InputMediaDocument,
+    "animation": types.InputMediaDocument,
+}
+
+
+# Тип медиа по расширению файла, если он не указан в админке
+def guess_media_type(path: str) -> str:
+    mime, _ = mimetypes.guess_type(path)
+    if mime == "image/gif":
+        return "animation"
+    kind = mime.split("/")[0] if mime else None
+    return {"image": "photo", "video": "video", "audio": "audio"}.get(kind, "document")
+
+
+# Медиафайл рассылки: основной (attachment_id=None) или файл альбома
+@dataclass
+class MailingMedia:
+    path: str
+    media_type: str
+    file_id: str | None = None
+    attachment_id: int | None = None
+
+
+# Захваченная воркером рассылка: содержимое и контрольная точка на момент захвата
+@dataclass
+class MailingJob:
+    id: int
+    text: str | None
+    last_recipient_id: int
+    media: list[MailingMedia] = field(default_factory=list)
+
+
+# Воркер рассылок: берет рассылки из очереди (mailing_mailing.queued_at), отправляет пачками
+# активным пользователям в порядке users_user.id и после каждой пачки сохраняет контрольную точку.
+# Рассылка захватывается арендой (lease_owner, lease_until), которая продлевается с каждой пачкой:
+# если воркер упал, аренда истекает и рассылку продолжает любой воркер с контрольной точки.
+# При сбое посреди пачки ее получатели могут получить сообщение повторно, но не больше одной пачки.
+# Медиафайлы загружаются один раз в служебный чат upload_chat_id, получателям уходят их file_id.
+class MailingEngine:
+    def __init__(self, bot: Bot, session_maker: async_sessionmaker[AsyncSession],
+                 read_session_maker: async_sessionmaker[AsyncSession] | None = None, media_root: str = ".",
+                 upload_chat_id: int | str | None = None, concurrency: int = 20, batch_size: int = 200,
+                 lease: float = 120, idle_interval: float = 60):
+        self.bot = bot
+        self.upload_chat_id = upload_chat_id
+        self.session_maker = session_maker
+        self.read_session_maker = read_session_maker or session_maker  # выборка получателей может идти с реплики
+        self.media_root = media_root
+        self.batch_size = batch_size
+        # Аренда продлевается каждую треть срока, пока идет пачка (keep_lease), и после каждой пачки
+        self.lease = timedelta(seconds=lease)
+        self.idle_interval = idle_interval
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}"[-64:]
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._task: asyncio.Task | None = None
+        self.current: int | None = None
+        self.results = {DELIVERED: 0, BLOCKED: 0, FAILED: 0}
+        self.batches = 0
+        self.completed = 0
+        self.lost_leases = 0
+        self.errors = 0
+        self.uploads = 0
+        self.send_time = metrics.Histogram()
+
+    # Проверить очередь, не дожидаясь idle_interval (уведомление из админки, переподключение LISTEN)
+    def wakeup(self) -> None:
+        self._wakeup.set()
+
+    # Захват одной рассылки из очереди; SKIP LOCKED не дает двум воркерам взять одну и ту же
+    async def claim(self) -> MailingJob | None:
+        candidate = (
+            select(Mailing.id)
+            .where(Mailing.queued_at.is_not(None), Mailing.sent.is_(False),
+                   or_(Mailing.lease_until.is_(None), Mailing.lease_until < func.now()))
+            .order_by(Mailing.queued_at)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+            .scalar_subquery()
+        )
+        stmt = (
+            update(Mailing)
+            .where(Mailing.id == candidate)
+            .values(lease_owner=self.worker_id, lease_until=func.now() + self.lease)
+            .returning(Mailing.id, Mailing.text, Mailing.last_recipient_id,
+                       Mailing.media_file, Mailing.media_type, Mailing.media_file_id)
+            .execution_options(synchronize_session=False)
+        )
+        async with self.session_maker() as session:
+            row = (await session.execute(stmt)).first()
+            await session.commit()
+            if row is None:
+                return None
+            job = MailingJob(row.id, row.text, row.last_recipient_id)
+            if row.media_file:
+                job.media.append(MailingMedia(row.media_file, row.media_type or guess_media_type(row.media_file),
+                                              row.media_file_id))
+            attachments = await session.execute(
+                select(MailingAttachment.id, MailingAttachment.file, MailingAttachment.media_type,
+                       MailingAttachment.file_id)
+                .where(MailingAttachment.mailing_id == job.id)
+                .order_by(MailingAttachment.position, MailingAttachment.id)
+            )
+            for attachment_id, path, media_type, file_id in attachments:
+                job.media.append(MailingMedia(path, media_type or guess_media_type(path), file_id, attachment_id))
+        return job
+
+    # Следующая пачка получателей после контрольной точки: (id, Telegram ID)
+    async def next_recipients(self, after_id: int) -> list[tuple[int, int]]:
+        stmt = (select(User.id, User.user_id)
+                .where(User.is_active.is_(True), User.id > after_id)
+                .order_by(User.id)
+                .limit(self.batch_size))
+        async with self.read_session_maker() as session:
+            return [tuple(row) for row in await session.execute(stmt)]
+
+    # Сохранение контрольной точки и продление аренды; False - аренду перехватил другой воркер
+    async def checkpoint(self, job: MailingJob, last_recipient_id: int, delivered: int, failed: int) -> bool:
+        stmt = (update(Mailing)
+                .where(Mailing.id == job.id, Mailing.lease_owner == self.worker_id)
+                .values(last_recipient_id=last_recipient_id,
+                        sent_count=Mailing.sent_count + delivered,
+                        failed_count=Mailing.failed_count + failed,
+                        lease_until=func.now() + self.lease)
+                .execution_options(synchronize_session=False))
+        async with self.session_maker() as session:
+            result = await session.execute(stmt)
+            await session.commit()
+        if not result.rowcount:
+            return False
+        job.last_recipient_id = last_recipient_id
+        return True
+
+    # Продление аренды, пока отправляется пачка: при занятом общем лимите Telegram пачка может идти дольше
+    # аренды, и без продления ее перехватил бы другой воркер и отправил те же сообщения повторно
+    async def keep_lease(self, job: MailingJob) -> None:
+        stmt = (update(Mailing)
+                .where(Mailing.id == job.id, Mailing.lease_owner == self.worker_id)
+                .values(lease_until=func.now() + self.lease)
+                .execution_options(synchronize_session=False))
+        while True:
+            await asyncio.sleep(self.lease.total_seconds() / 3)
+            try:
+                async with self.session_maker() as session:
+                    await session.execute(stmt)
+                    await session.commit()
+            except Exception as e:
+                logger.warning(f"Рассылка {job.id}: не удалось продлить аренду: {e}")
+
+    # Рассылка отмечается отправленной только после обработки последнего получателя
+    async def finish(self, job: MailingJob) -> bool:
+        stmt = (update(Mailing)
+                .where(Mailing.id == job.id, Mailing.lease_owner == self.worker_id)
+                .values(sent=True, finished_at=func.now(), lease_owner=None, lease_until=None)
+                .execution_options(synchronize_session=False))
+        async with self.session_maker() as session:
+            result = await session.execute(stmt)
+            await session.commit()
+        return bool(result.rowcount)
+
+    # Штатная остановка: аренда снимается, чтобы рассылку сразу продолжил другой воркер
+    async def release(self, job: MailingJob) -> None:
+        stmt = (update(Mailing)
+                .where(Mailing.id == job.id, Mailing.lease_owner == self.worker_id)
+                .values(lease_owner=None, lease_until=None)
+                .execution_options(synchronize_session=False))
+        async with self.session_maker() as session:
+            await session.execute(stmt)
+            await session.commit()
+
+    # Загрузка медиафайлов без file_id в служебный чат; file_id сохраняется в БД,
+    # если файл не заменили в админке, - после перезапуска рассылка не загружает его снова
+    async def upload_media(self, job: MailingJob) -> None:
+        pending = [item for item in job.media if not item.file_id]
+        if not pending:
+            return
+        if self.upload_chat_id is None:
+            logger.warning(f"Рассылка {job.id}: не задан чат для загрузки медиа, файлы загружаются каждому получателю")
+            return
+        for item in pending:
+            source = types.FSInputFile(os.path.join(self.media_root, item.path))
+            message = await getattr(self.bot, f"send_{item.media_type}")(
+                self.upload_chat_id, **{item.media_type: source}, disable_notification=True)
+            uploaded = getattr(message, item.media_type)
+            item.file_id = uploaded[-1].file_id if item.media_type == "photo" else uploaded.file_id
+            self.uploads += 1
+            if item.attachment_id is None:
+                stmt = (update(Mailing)
+                        .where(Mailing.id == job.id, Mailing.media_file == item.path)
+                        .values(media_file_id=item.file_id))
+            else:
+                stmt = (update(MailingAttachment)
+                        .where(MailingAttachment.id == item.attachment_id, MailingAttachment.file == item.path)
+                        .values(file_id=item.file_id))
+            async with self.session_maker() as session:
+                await session.execute(stmt.execution_options(synchronize_session=False))
+                await session.commit()
+            logger.info(f"Рассылка {job.id}: файл {item.path} загружен, file_id {item.file_id}")
+
+    # file_id, если файл уже загружен, иначе сам файл
+    def media_source(self, item: MailingMedia) -> str | types.FSInputFile:
+        return item.file_id or types.FSInputFile(os.path.join(self.media_root, item.path))
+
+    async def send_content(self, job: MailingJob, chat_id: int) -> None:
+        text = job.text or None
+        caption = text if text and len(text) <= CAPTION_LIMIT else None
+        if len(job.media) > 1:
+            await self.bot.send_media_group(chat_id, [
+                INPUT_MEDIA[item.media_type](media=self.media_source(item), caption=caption if index == 0 else None)
+                for index, item in enumerate(job.media)
+            ])
+        elif job.media:
+            item = job.media[0]
+            await getattr(self.bot, f"send_{item.media_type}")(
+                chat_id, **{item.media_type: self.media_source(item)}, caption=caption)
+        if text and (not job.media or caption is None):
+            await self.bot.send_message(chat_id, text)
+
+    async def send(self, job: MailingJob, chat_id: int) -> str:
+        async with self._semaphore:
+            started = time.perf_counter()
+            try:
+                await self.send_content(job, chat_id)
+                return DELIVERED
+            except TelegramForbiddenError:
+                return BLOCKED  # пользователь заблокировал бота
+            except Exception as e:
+                logger.warning(f"Рассылка {job.id}: не удалось отправить пользователю {chat_id}: {e}")
+                return FAILED
+            finally:
+                self.send_time.observe(time.perf_counter() - started)
+
+    # Доставка рассылки с контрольной точки. Отправки идут с массовым приоритетом:
+    # ответы пользователям бота проходят через общий лимит Telegram раньше
+    async def deliver(self, job: MailingJob) -> None:
+        logger.info(f"Рассылка {job.id}: доставка с получателя после id {job.last_recipient_id}")
+        self.current = job.id
+        try:
+            if not job.text and not job.media:
+                logger.warning(f"Рассылка {job.id}: нет ни текста, ни медиафайлов, отмечена отправленной")
+                await self.finish(job)
+                return
+            with bulk_priority():
+                await self.upload_media(job)
+                while not self._stopping:
+                    recipients = await self.next_recipients(job.last_recipient_id)
+                    if not recipients:
+                        break
+                    lease = asyncio.create_task(self.keep_lease(job))
+                    try:
+                        results = await asyncio.gather(*(self.send(job, chat_id) for _, chat_id in recipients))
+                    finally:
+                        lease.cancel()
+                    for result in results:
+                        self.results[result] += 1
+                    self.batches += 1
+                    delivered = results.count(DELIVERED)
+                    if not await self.checkpoint(job, recipients[-1][0], delivered, len(results) - delivered):
+                        self.lost_leases += 1
+                        logger.warning(f"Рассылка {job.id}: аренда перехвачена другим воркером, доставка прервана")
+                        return
+            if self._stopping:
+                await self.release(job)
+                logger.info(f"Рассылка {job.id}: остановлена на получателе {job.last_recipient_id}")
+                return
+            if await self.finish(job):
+                self.completed += 1
+                logger.info(f"Рассылка {job.id} отправлена")
+        finally:
+            self.current = None
+
+    async def run(self) -> None:
+        while not self._stopping:
+            self._wakeup.clear()
+            try:
+                job = await self.claim()
+                if job is not None:
+                    await self.deliver(job)
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Аренда остается до истечения: рассылку повторят позже, без холостого цикла ошибок
+                self.errors += 1
+                logger.error(f"Ошибка воркера рассылок: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.idle_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    # Текущая пачка дописывается и сохраняется в контрольную точку, но не дольше timeout
+    async def close(self, timeout: float = 30) -> None:
+        if self._task is None:
+            return
+        self._stopping = True
+        self.wakeup()
+        try:
+            await asyncio.wait_for(self._task, timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Воркер рассылок не остановился за {timeout} с, последняя пачка будет отправлена повторно")
+        self._task = None
+
+    def stats(self) -> dict:
+        return {
+            'worker': self.worker_id,
+            'current': self.current,
+            'completed': self.completed,
+            'batches': self.batches,
+            'results': dict(self.results),
+            'lost_leases': self.lost_leases,
+            'errors': self.errors,
+            'uploads': self.uploads,
+            'send_time': self.send_time.snapshot(),
+        }
+
+
+# Планировщик рассылок: ставит в очередь рассылки, у которых наступило send_at, и спит до ближайшего
+# следующего send_at (не дольше max_sleep) или до уведомления об изменении рассылок.
+# Несколько реплик не ставят рассылку дважды: строки захватываются FOR UPDATE SKIP LOCKED,
+# а UPDATE меняет только еще не поставленные в очередь. Отправляет поставленные рассылки MailingEngine
+class MailingScheduler:
+    def __init__(self, session_maker: async_sessionmaker[AsyncSession], engine: MailingEngine | None = None,
+                 batch_size: int = 100, min_sleep: float = 1, max_sleep: float = 300):
+        self.session_maker = session_maker
+        self.engine = engine
+        self.batch_size = batch_size
+        self.min_sleep = min_sleep
+        self.max_sleep = max_sleep
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self.queued = 0
+        self.errors = 0
+        self.next_due_in: float | None = None
+
+    def wakeup(self) -> None:
+        self._wakeup.set()
+
+    # Постановка в очередь наступивших рассылок (индекс mailing_sent_send_at_idx);
+    # NOTIFY в той же транзакции будит воркеры всех процессов после коммита
+    async def queue_due(self) -> list[int]:
+        due = (select(Mailing.id)
+               .where(Mailing.sent.is_(False), Mailing.send_at <= func.now(), Mailing.queued_at.is_(None))
+               .order_by(Mailing.send_at)
+               .limit(self.batch_size)
+               .with_for_update(skip_locked=True))
+        stmt = (update(Mailing)
+                .where(Mailing.id.in_(due.scalar_subquery()))
+                .values(queued_at=func.now())
+                .returning(Mailing.id)
+                .execution_options(synchronize_session=False))
+        async with self.session_maker() as session:
+            ids = list((await session.execute(stmt)).scalars())
+            for mailing_id in ids:
+                await session.execute(select(func.pg_notify(MAILING_CHANNEL, json.dumps({"id": mailing_id}))))
+            await session.commit()
+        return ids
+
+    # Секунды до ближайшей еще не поставленной рассылки по часам базы; None - таких нет
+    async def seconds_until_next(self) -> float | None:
+        stmt = (select(extract("epoch", func.min(Mailing.send_at) - func.now()))
+                .where(Mailing.sent.is_(False), Mailing.queued_at.is_(None)))
+        async with self.session_maker() as session:
+            seconds = (await session.execute(stmt)).scalar()
+        return float(seconds) if seconds is not None else None
+
+    async def run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            delay = self.max_sleep
+            try:
+                ids = await self.queue_due()
+                if ids:
+                    self.queued += len(ids)
+                    logger.info(f"Рассылки поставлены в очередь по расписанию: {ids}")
+                    if self.engine is not None:
+                        self.engine.wakeup()
+                    if len(ids) == self.batch_size:
+                        continue
+                self.next_due_in = await self.seconds_until_next()
+                if self.next_due_in is not None:
+                    # Не меньше min_sleep: наступившие рассылки может держать другая реплика
+                    delay = min(max(self.next_due_in, self.min_sleep), self.max_sleep)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"Ошибка планировщика рассылок: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            'queued': self.queued,
+            'errors': self.errors,
+            'next_due_in': round(self.next_due_in, 3) if self.next_due_in is not None else None,
+        }
+
+
+# Отдельный процесс только с воркером и планировщиком рассылок: python mailing.py
+async def main():
+    from bot import bot, share_rate_limit, start_mailing_worker, stop_mailing_worker
+
+    share_rate_limit()
+    mailing = await start_mailing_worker()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await stop_mailing_worker(mailing)
+        await bot.session.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(filename='logs/mailing.log', level=logging.DEBUG)
+    asyncio.run(main())
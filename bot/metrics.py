@@ -0,0 +1,67 @@
+import logging
+import time
+from bisect import bisect_left
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм времени ожидания, секунды
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+# Гистограмма с фиксированными корзинами (без внешних зависимостей)
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # последняя корзина - больше верхней границы
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    # Приблизительный квантиль по верхней границе корзины
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bucket, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bucket
+        return self.max
+
+    def snapshot(self) -> dict:
+        buckets = {f"le_{bucket}": count for bucket, count in zip(self.buckets, self.counts)}
+        buckets["inf"] = self.counts[-1]
+        return {
+            'count': self.count,
+            'avg': round(self.sum / self.count, 6) if self.count else 0.0,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+            'max': round(self.max, 6),
+            'buckets': buckets,
+        }
+
+
+# Реестр источников метрик: имя -> функция, возвращающая словарь показателей
+_sources: dict[str, Callable[[], dict]] = {}
+
+
+def register(name: str, source: Callable[[], dict]) -> None:
+    _sources[name] = source
+
+
+def collect() -> dict:
+    result = {'timestamp': time.time()}
+    for name, source in _sources.items():
+        try:
+            result[name] = source()
+        except Exception as e:
+            logger.error(f"Ошибка сбора метрик {name}: {e}")
+    return result
@@ -0,0 +1,34 @@
+import logging
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+logger = logging.getLogger(__name__)
+
+
+# Одна сессия и транзакция БД на апдейт: передается в обработчики аргументом session.
+# Соединение берется из пула только при первом запросе, так что апдейты без обращения к БД его не занимают.
+# is_primary(tg_id) - нужно ли читать данные пользователя из основной базы, а не из реплики.
+class DbSessionMiddleware(BaseMiddleware):
+    def __init__(self, session_maker: async_sessionmaker, is_primary: Callable[[int], bool] | None = None):
+        self.session_maker = session_maker
+        self.is_primary = is_primary
+
+    async def __call__(self,
+                       handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject,
+                       data: dict[str, Any]) -> Any:
+        async with self.session_maker() as session:
+            data["session"] = session
+            user = data.get("event_from_user")
+            if self.is_primary is not None and user is not None and self.is_primary(user.id):
+                session.info["primary"] = True
+            try:
+                result = await handler(event, data)
+                await session.commit()
+                return result
+            except Exception:
+                await session.rollback()
+                raise
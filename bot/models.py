@@ -1,4 +1,6 @@
-from sqlalchemy import Integer, String, Boolean, ForeignKey, Numeric, Identity
+from sqlalchemy import BigInteger, Integer, String, Boolean, ForeignKey, Numeric, Identity, Index, DateTime, Double, \
+    func
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import relationship, Mapped, mapped_column
 
 from models_base import Base
@@ -45,13 +47,21 @@ class Category(Base):
 
 class Product(Base):
     __tablename__ = "products_product"
+    __table_args__ = (
+        Index("product_subcategory_id_idx", "subcategory_id", "id"),
+        Index("product_name_trgm_idx", "name", postgresql_using="gin", postgresql_ops={"name": "gin_trgm_ops"}),
+        Index("product_description_trgm_idx", "description", postgresql_using="gin",
+              postgresql_ops={"description": "gin_trgm_ops"}),
+    )
 
     id: Mapped[int] = mapped_column(Identity(), primary_key=True, index=True)
     category_id: Mapped[int] = mapped_column(ForeignKey("products_category.id"), nullable=False)
     subcategory_id: Mapped[int] = mapped_column(ForeignKey("products_subcategory.id"), nullable=True)
+    sku: Mapped[str] = mapped_column(String(64), unique=True, nullable=True)
     name: Mapped[str] = mapped_column(String(255), nullable=False)
     description: Mapped[str] = mapped_column(String, nullable=True)
     photo: Mapped[str] = mapped_column(String, nullable=True)
+    photo_file_id: Mapped[str] = mapped_column(String(255), nullable=True)
     price: Mapped[Numeric] = mapped_column(Numeric(10, 2), nullable=False)
 
     # Связи
@@ -69,6 +79,7 @@ class Product(Base):
 
 class SubCategory(Base):
     __tablename__ = "products_subcategory"
+    __table_args__ = (Index("subcategory_category_id_idx", "category_id", "id"),)
 
     id: Mapped[int] = mapped_column(Identity(), primary_key=True, index=True)
     category_id: Mapped[int] = mapped_column(ForeignKey("products_category.id"), nullable=False)
@@ -105,3 +116,105 @@ class User(Base):
     def __repr__(self):
         return (f"Пользователь (id={self.id}, user_id={self.user_id}, username={self.username},"
                 f" first_name={self.first_name}, last_name={self.last_name}, is_active={self.is_active})")
+
+
+class FSMState(Base):
+    __tablename__ = "users_fsmstate"
+
+    key: Mapped[str] = mapped_column(String(255), primary_key=True)
+    state: Mapped[str] = mapped_column(String(255), nullable=True)
+    data: Mapped[dict] = mapped_column(JSONB, nullable=False)
+    expires_at: Mapped[DateTime] = mapped_column(DateTime(timezone=True), nullable=False, index=True)
+    updated_at: Mapped[DateTime] = mapped_column(DateTime(timezone=True), nullable=False)
+
+    def __repr__(self):
+        return f"Состояние FSM (key={self.key}, state={self.state}, expires_at={self.expires_at})"
+
+
+class RateLimitBucket(Base):
+    __tablename__ = "users_ratelimitbucket"
+
+    name: Mapped[str] = mapped_column(String(64), primary_key=True)
+    tokens: Mapped[float] = mapped_column(Double, nullable=False)
+    updated_at: Mapped[DateTime] = mapped_column(DateTime(timezone=True), nullable=False)
+
+    def __repr__(self):
+        return f"Лимит отправки (name={self.name}, tokens={self.tokens}, updated_at={self.updated_at})"
+
+
+class Order(Base):
+    __tablename__ = "orders_order"
+
+    STATUS_PENDING = "pending"
+    STATUS_PAID = "paid"
+    STATUS_CANCELLED = "cancelled"
+
+    id: Mapped[int] = mapped_column(Identity(), primary_key=True, index=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey("users_user.id"), nullable=False)
+    invoice_payload: Mapped[str] = mapped_column(String(128), unique=True, nullable=False)
+    status: Mapped[str] = mapped_column(String(16), nullable=False, default=STATUS_PENDING)
+    total: Mapped[Numeric] = mapped_column(Numeric(12, 2), nullable=False)
+    currency: Mapped[str] = mapped_column(String(3), nullable=False, default="RUB")
+    name: Mapped[str] = mapped_column(String(255), nullable=False)
+    address: Mapped[str] = mapped_column(String, nullable=False)
+    phone: Mapped[str] = mapped_column(String(64), nullable=False)
+    telegram_payment_charge_id: Mapped[str] = mapped_column(String(255), unique=True, nullable=True)
+    provider_payment_charge_id: Mapped[str] = mapped_column(String(255), nullable=True)
+    created_at: Mapped[DateTime] = mapped_column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    paid_at: Mapped[DateTime] = mapped_column(DateTime(timezone=True), nullable=True)
+
+    def __repr__(self):
+        return (f"Заказ (id={self.id}, user_id={self.user_id}, status={self.status}, total={self.total},"
+                f" invoice_payload={self.invoice_payload})")
+
+
+class OrderLine(Base):
+    __tablename__ = "orders_orderline"
+
+    id: Mapped[int] = mapped_column(Identity(), primary_key=True, index=True)
+    order_id: Mapped[int] = mapped_column(ForeignKey("orders_order.id"), nullable=False)
+    product_id: Mapped[int] = mapped_column(ForeignKey("products_product.id"), nullable=True)
+    name: Mapped[str] = mapped_column(String(255), nullable=False)
+    price: Mapped[Numeric] = mapped_column(Numeric(10, 2), nullable=False)
+    quantity: Mapped[int] = mapped_column(Integer, nullable=False)
+
+    def __repr__(self):
+        return f"Позиция заказа (id={self.id}, order_id={self.order_id}, name={self.name}, quantity={self.quantity})"
+
+
+class Mailing(Base):
+    __tablename__ = "mailing_mailing"
+    __table_args__ = (Index("mailing_sent_send_at_idx", "sent", "send_at"),)
+
+    id: Mapped[int] = mapped_column(Identity(), primary_key=True, index=True)
+    text: Mapped[str] = mapped_column(String, nullable=True)
+    media_file: Mapped[str] = mapped_column(String(100), nullable=True)
+    send_at: Mapped[DateTime] = mapped_column(DateTime(timezone=True), nullable=False)
+    sent: Mapped[bool] = mapped_column(Boolean, nullable=False, default=False)
+    media_type: Mapped[str] = mapped_column(String(16), nullable=True)
+    media_file_id: Mapped[str] = mapped_column(String(255), nullable=True)
+    queued_at: Mapped[DateTime] = mapped_column(DateTime(timezone=True), nullable=True)
+    lease_owner: Mapped[str] = mapped_column(String(64), nullable=True)
+    lease_until: Mapped[DateTime] = mapped_column(DateTime(timezone=True), nullable=True)
+    last_recipient_id: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+    sent_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    failed_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    finished_at: Mapped[DateTime] = mapped_column(DateTime(timezone=True), nullable=True)
+
+    def __repr__(self):
+        return (f"Рассылка (id={self.id}, send_at={self.send_at}, sent={self.sent},"
+                f" last_recipient_id={self.last_recipient_id})")
+
+
+class MailingAttachment(Base):
+    __tablename__ = "mailing_mailingattachment"
+
+    id: Mapped[int] = mapped_column(Identity(), primary_key=True, index=True)
+    mailing_id: Mapped[int] = mapped_column(ForeignKey("mailing_mailing.id"), nullable=False)
+    file: Mapped[str] = mapped_column(String(100), nullable=False)
+    media_type: Mapped[str] = mapped_column(String(16), nullable=True)
+    file_id: Mapped[str] = mapped_column(String(255), nullable=True)
+    position: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"Файл альбома (id={self.id}, mailing_id={self.mailing_id}, file={self.file})"
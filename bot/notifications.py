@@ -0,0 +1,70 @@
+import asyncio
+import json
+import logging
+from typing import Awaitable, Callable
+
+import asyncpg
+from sqlalchemy.engine import make_url
+
+logger = logging.getLogger(__name__)
+
+NotificationHandler = Callable[[dict], Awaitable[None]]
+
+
+# DSN для asyncpg из URL SQLAlchemy (postgresql+asyncpg://... -> postgresql://...)
+def asyncpg_dsn(database_url: str) -> str:
+    return make_url(database_url).set(drivername="postgresql").render_as_string(hide_password=False)
+
+
+# Подписка на каналы Postgres LISTEN/NOTIFY с автоматическим переподключением
+class PgListener:
+    def __init__(self, database_url: str, reconnect_delay: float = 5):
+        self._dsn = asyncpg_dsn(database_url)
+        self._reconnect_delay = reconnect_delay
+        self._handlers: dict[str, NotificationHandler] = {}
+        # Вызывается после (пере)подключения: события за время разрыва могли быть потеряны
+        self._on_connect: list[Callable[[], None]] = []
+
+    def subscribe(self, channel: str, handler: NotificationHandler) -> None:
+        self._handlers[channel] = handler
+
+    def on_connect(self, callback: Callable[[], None]) -> None:
+        self._on_connect.append(callback)
+
+    def _dispatch(self, channel: str, payload: str) -> None:
+        try:
+            event = json.loads(payload)
+        except ValueError:
+            logger.error(f"Некорректное уведомление в канале {channel}: {payload}")
+            return
+        asyncio.create_task(self._handle(channel, event))
+
+    async def _handle(self, channel: str, event: dict) -> None:
+        try:
+            await self._handlers[channel](event)
+        except Exception as e:
+            logger.error(f"Ошибка обработки уведомления {channel} {event}: {e}")
+
+    async def run(self) -> None:
+        while True:
+            connection = None
+            try:
+                connection = await asyncpg.connect(self._dsn)
+                for channel in self._handlers:
+                    await connection.add_listener(channel, lambda conn, pid, ch, payload: self._dispatch(ch, payload))
+                for callback in self._on_connect:
+                    callback()
+                logger.info(f"Подписка на каналы {list(self._handlers)} установлена")
+
+                closed = asyncio.Event()
+                connection.add_termination_listener(lambda conn: closed.set())
+                await closed.wait()
+                logger.warning("Соединение LISTEN закрыто, переподключаемся")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка подписки на уведомления Postgres: {e}")
+            finally:
+                if connection is not None and not connection.is_closed():
+                    await connection.close()
+            await asyncio.sleep(self._reconnect_delay)
@@ -0,0 +1,91 @@
+"""Запросы каталога и корзины в виде выражений SQLAlchemy, без движка и сессий.
+
+Их выполняет database.py, а тесты админки (admin/products/tests.py) строят из них EXPLAIN
+и проверяют, что планы используют нужные индексы.
+"""
+from sqlalchemy import Select, and_, case, func, or_, select
+
+from catalog import CategoryItem, ProductItem, SubCategoryItem
+from models import Cart, Category, Product, SubCategory, User
+
+# Колонки, из которых собираются элементы снимка каталога
+CATEGORY_COLUMNS = (Category.id, Category.name, Category.description)
+SUBCATEGORY_COLUMNS = (SubCategory.id, SubCategory.category_id, SubCategory.name, SubCategory.description)
+PRODUCT_COLUMNS = (Product.id, Product.category_id, Product.subcategory_id, Product.name, Product.description,
+                   Product.photo, Product.price, Product.photo_file_id)
+
+# Источники страниц каталога: (таблица, колонки, класс элемента, колонка родителя)
+PAGE_SOURCES = {
+    'categories': (Category, CATEGORY_COLUMNS, CategoryItem, None),
+    'subcategories': (SubCategory, SUBCATEGORY_COLUMNS, SubCategoryItem, SubCategory.category_id),
+    'products': (Product, PRODUCT_COLUMNS, ProductItem, Product.subcategory_id),
+}
+
+
+# Внутренний id пользователя по Telegram ID (подзапрос)
+def user_internal_id(tg_id: int):
+    return select(User.id).where(User.user_id == tg_id).scalar_subquery()
+
+
+# Страница уровня каталога по ключу (id > after_id или id < before_id); с before_id строки идут по убыванию id
+def catalog_page_query(level: str, parent_id: int | None, after_id: int | None, before_id: int | None,
+                       limit: int) -> Select:
+    table, columns, _, parent_column = PAGE_SOURCES[level]
+    stmt = select(*columns)
+    if parent_column is not None:
+        stmt = stmt.where(parent_column == parent_id)
+    if before_id is not None:
+        stmt = stmt.where(table.id < before_id).order_by(table.id.desc())
+    else:
+        if after_id is not None:
+            stmt = stmt.where(table.id > after_id)
+        stmt = stmt.order_by(table.id)
+    return stmt.limit(limit)
+
+
+def catalog_count_query(level: str, parent_id: int | None) -> Select:
+    table, _, _, parent_column = PAGE_SOURCES[level]
+    stmt = select(func.count()).select_from(table)
+    if parent_column is not None:
+        stmt = stmt.where(parent_column == parent_id)
+    return stmt
+
+
+# Корзина пользователя одним запросом: строки с суммами и итог корзины (оконная сумма)
+def cart_query(tg_id: int) -> Select:
+    line_total = Product.price * Cart.quantity
+    return (
+        select(Cart.product_id, Product.name, Product.price, Cart.quantity, Product.photo,
+               line_total.label('line_total'), func.sum(line_total).over().label('total'))
+        .join(Product, Product.id == Cart.product_id)
+        .join(User, User.id == Cart.user_id)
+        .where(User.user_id == tg_id)
+        .order_by(Cart.id)
+    )
+
+
+# Условие поиска: каждое слово должно встретиться в названии или описании. ILIKE '%слово%' идет по
+# триграммным индексам product_name_trgm_idx и product_description_trgm_idx (расширение pg_trgm)
+def search_patterns(tokens: list[str]) -> list[str]:
+    return ["%" + token.replace("_", r"\_") + "%" for token in tokens]  # "_" в LIKE - спецсимвол
+
+
+def search_condition(tokens: list[str]):
+    return and_(*(or_(Product.name.ilike(pattern), Product.description.ilike(pattern))
+                  for pattern in search_patterns(tokens)))
+
+
+# Страница поиска: сначала товары с большим числом слов в названии; total - всего найдено (оконный счетчик)
+def search_query(tokens: list[str], offset: int, limit: int) -> Select:
+    name_matches = sum(case((Product.name.ilike(pattern), 1), else_=0) for pattern in search_patterns(tokens))
+    return (
+        select(*PRODUCT_COLUMNS, func.count().over().label('total'))
+        .where(search_condition(tokens))
+        .order_by(name_matches.desc(), Product.name, Product.id)
+        .offset(offset)
+        .limit(limit)
+    )
+
+
+def search_count_query(tokens: list[str]) -> Select:
+    return select(func.count()).select_from(Product).where(search_condition(tokens))
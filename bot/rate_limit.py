@@ -0,0 +1,222 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import Response, TelegramMethod
+from aiogram.methods.base import TelegramType
+from sqlalchemy import extract, func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+import metrics
+from models import RateLimitBucket
+
+logger = logging.getLogger(__name__)
+
+# Приоритет исходящих запросов: ответы пользователям идут раньше массовой рассылки
+INTERACTIVE = "interactive"
+BULK = "bulk"
+request_priority: ContextVar[str] = ContextVar("request_priority", default=INTERACTIVE)
+
+# Методы, на которые действуют лимиты Telegram на отправку сообщений
+LIMITED_PREFIXES = ("send", "copy", "forward", "editMessage")
+
+
+# Все запросы внутри блока считаются массовыми (рассылка)
+@contextmanager
+def bulk_priority():
+    token = request_priority.set(BULK)
+    try:
+        yield
+    finally:
+        request_priority.reset(token)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Сколько ждать до следующего токена; 0 - токен взят
+    def reserve(self) -> float:
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while (wait := self.reserve()) > 0:
+                await asyncio.sleep(wait)
+
+
+# Ведро токенов, общее для всех процессов и реплик бота: остаток хранится в строке users_ratelimitbucket.
+# Каждый запрос одной командой пополняет ведро за прошедшее время и берет токен, при нехватке - в долг:
+# отрицательный остаток - очередь запросов, взявших токен раньше, и время ожидания своей очереди.
+# Пока база недоступна, процесс отправляет через локальное ведро с fallback_rate
+class SharedTokenBucket:
+    def __init__(self, engine: AsyncEngine, name: str, rate: float, capacity: float | None = None,
+                 fallback_rate: float | None = None):
+        self.engine = engine
+        self.name = name
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.fallback = TokenBucket(fallback_rate or rate, fallback_rate or rate)
+        self.failures = 0
+        self._lock = asyncio.Lock()
+        excluded = pg_insert(RateLimitBucket).excluded
+        refilled = RateLimitBucket.tokens + extract("epoch", excluded.updated_at - RateLimitBucket.updated_at) * self.rate
+        self._take = (
+            pg_insert(RateLimitBucket)
+            .values(name=name, tokens=self.capacity - 1, updated_at=func.clock_timestamp())
+            .on_conflict_do_update(
+                index_elements=[RateLimitBucket.name],
+                set_={'tokens': func.least(self.capacity, refilled) - 1, 'updated_at': excluded.updated_at},
+            )
+            .returning(RateLimitBucket.tokens)
+        )
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            try:
+                async with self.engine.begin() as connection:
+                    tokens = (await connection.execute(self._take)).scalar_one()
+            except Exception as e:
+                self.failures += 1
+                if self.failures == 1 or self.failures % 100 == 0:
+                    logger.warning(f"Общий лимит {self.name} недоступен ({self.failures} раз),"
+                                   f" действует локальный: {e}")
+                await self.fallback.acquire()
+                return
+            self.failures = 0
+            if tokens < 0:
+                await asyncio.sleep(-tokens / self.rate)
+
+
+# Ограничитель исходящих запросов процесса: общий лимит бота и лимиты отдельных чатов.
+# Массовые запросы уступают общий лимит интерактивным; после 429 все отправки ждут retry_after
+class RateLimiter:
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1, chat_burst: float = 3,
+                 group_rate: float = 20 / 60, group_burst: float = 3, max_chats: int = 10_000):
+        self.global_bucket: TokenBucket | SharedTokenBucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.max_chats = max_chats
+        self._chats: OrderedDict[int | str, TokenBucket] = OrderedDict()
+        self._global_lock = asyncio.Lock()
+        self._interactive_waiting = 0
+        self._interactive_done = asyncio.Event()
+        self._interactive_done.set()
+        self._paused_until = 0.0
+        self.wait_time = {INTERACTIVE: metrics.Histogram(), BULK: metrics.Histogram()}
+        self.retries = 0
+
+    def set_global_rate(self, rate: float) -> None:
+        self.global_bucket = TokenBucket(rate, rate)
+
+    # Общий лимит, разделяемый с другими процессами (SharedTokenBucket)
+    def set_global_bucket(self, bucket: TokenBucket | SharedTokenBucket) -> None:
+        self.global_bucket = bucket
+
+    # Группы и каналы (отрицательный id или @username) ограничены строже личных чатов
+    def _chat_bucket(self, chat_id: int | str) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            bucket = TokenBucket(self.group_rate, self.group_burst) if is_group \
+                else TokenBucket(self.chat_rate, self.chat_burst)
+            self._chats[chat_id] = bucket
+            if len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    async def _wait_pause(self) -> None:
+        while (pause := self._paused_until - time.monotonic()) > 0:
+            await asyncio.sleep(pause)
+
+    async def acquire(self, chat_id: int | str | None, priority: str) -> None:
+        started = time.perf_counter()
+        if chat_id is not None:
+            await self._chat_bucket(chat_id).acquire()
+        if priority == INTERACTIVE:
+            self._interactive_waiting += 1
+            self._interactive_done.clear()
+            try:
+                async with self._global_lock:
+                    await self._wait_pause()
+                    await self.global_bucket.acquire()
+            finally:
+                self._interactive_waiting -= 1
+                if not self._interactive_waiting:
+                    self._interactive_done.set()
+        else:
+            while True:
+                await self._interactive_done.wait()
+                async with self._global_lock:
+                    if self._interactive_waiting:
+                        continue  # пропускаем вперед пришедшие интерактивные запросы
+                    await self._wait_pause()
+                    await self.global_bucket.acquire()
+                    break
+        self.wait_time[priority].observe(time.perf_counter() - started)
+
+    # Ответ 429: пауза для всех отправок процесса
+    def pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self.retries += 1
+
+    def stats(self) -> dict:
+        return {
+            'global_rate': self.global_bucket.rate,
+            'global_shared': isinstance(self.global_bucket, SharedTokenBucket),
+            'chats': len(self._chats),
+            'interactive_waiting': self._interactive_waiting,
+            'paused_for': round(max(self._paused_until - time.monotonic(), 0), 3),
+            'retries': self.retries,
+            'wait_time': {priority: histogram.snapshot() for priority, histogram in self.wait_time.items()},
+        }
+
+
+# Middleware сессии aiogram: все исходящие отправки проходят через RateLimiter,
+# ответ 429 повторяется после retry_after (не более max_retries раз)
+class RateLimitMiddleware(BaseRequestMiddleware):
+    def __init__(self, limiter: RateLimiter, max_retries: int = 3):
+        self.limiter = limiter
+        self.max_retries = max_retries
+
+    async def __call__(self, make_request: NextRequestMiddlewareType[TelegramType], bot: Bot,
+                       method: TelegramMethod[TelegramType]) -> Response[TelegramType]:
+        if not method.__api_method__.startswith(LIMITED_PREFIXES):
+            return await make_request(bot, method)
+
+        chat_id = getattr(method, "chat_id", None)
+        priority = request_priority.get()
+        for attempt in range(self.max_retries + 1):
+            await self.limiter.acquire(chat_id, priority)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(f"Telegram 429 на {method.__api_method__} (чат {chat_id}),"
+                               f" повтор через {e.retry_after} с")
+                self.limiter.pause(e.retry_after)
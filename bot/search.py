@@ -0,0 +1,127 @@
+import re
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+
+from catalog import CatalogSnapshot, ProductItem
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+NAME_WEIGHT = 3  # Совпадение в названии важнее совпадения в описании
+DESCRIPTION_WEIGHT = 1
+EXACT_BONUS = 2  # Полное совпадение слова выше совпадения по префиксу
+
+
+def tokenize(text: str | None) -> list[str]:
+    if not text:
+        return []
+    return TOKEN_RE.findall(text.lower().replace("ё", "е"))
+
+
+# Инвертированный индекс товаров снимка каталога по названию и описанию
+class SearchIndex:
+    def __init__(self, products: list[ProductItem] | tuple[ProductItem, ...]):
+        self._postings: dict[str, dict[int, int]] = {}
+        self._names: dict[int, str] = {}
+        for product in products:
+            self._names[product.id] = product.name.lower()
+            for weight, text in ((NAME_WEIGHT, product.name), (DESCRIPTION_WEIGHT, product.description)):
+                for token in tokenize(text):
+                    postings = self._postings.setdefault(token, {})
+                    postings[product.id] = postings.get(product.id, 0) + weight
+        self._tokens = sorted(self._postings)
+
+    # Товары, содержащие слово с префиксом token, с весами
+    def _match(self, token: str) -> dict[int, int]:
+        scores: dict[int, int] = {}
+        index = bisect_left(self._tokens, token)
+        while index < len(self._tokens) and self._tokens[index].startswith(token):
+            indexed = self._tokens[index]
+            bonus = EXACT_BONUS if indexed == token else 1
+            for product_id, weight in self._postings[indexed].items():
+                scores[product_id] = max(scores.get(product_id, 0), weight * bonus)
+            index += 1
+        return scores
+
+    # id товаров, содержащих все слова запроса, по убыванию релевантности
+    def search(self, query: str) -> tuple[int, ...]:
+        tokens = tokenize(query)
+        if not tokens:
+            return ()
+        scores: dict[int, int] | None = None
+        for token in dict.fromkeys(tokens):
+            matches = self._match(token)
+            if scores is None:
+                scores = matches
+            else:
+                scores = {product_id: score + matches[product_id]
+                          for product_id, score in scores.items() if product_id in matches}
+            if not scores:
+                return ()
+        return tuple(sorted(scores, key=lambda product_id: (-scores[product_id], self._names[product_id])))
+
+
+# Поиск по снимку каталога: индекс строится один раз на версию, результаты запросов кэшируются
+class ProductSearch:
+    def __init__(self, cache_size: int = 1000):
+        self.cache_size = cache_size
+        self._index: SearchIndex | None = None
+        self._version = -1
+        self._results: OrderedDict[str, tuple[int, ...]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def search(self, snapshot: CatalogSnapshot, query: str) -> tuple[int, ...]:
+        if self._version != snapshot.version:
+            self._index = SearchIndex(tuple(snapshot.products_by_id.values()))
+            self._version = snapshot.version
+            self._results.clear()
+
+        key = " ".join(tokenize(query))
+        cached = self._results.get(key)
+        if cached is not None:
+            self._results.move_to_end(key)
+            self.hits += 1
+            return cached
+
+        self.misses += 1
+        result = self._index.search(key)
+        self._results[key] = result
+        while len(self._results) > self.cache_size:
+            self._results.popitem(last=False)
+        return result
+
+    def stats(self) -> dict:
+        return {'version': self._version, 'cached_queries': len(self._results), 'hits': self.hits,
+                'misses': self.misses}
+
+
+# Страницы результатов поиска в БД (каталог не поместился в снимок): LRU с TTL.
+# Запись действительна, пока не сменилась версия каталога и не истек ttl
+class SearchPageCache:
+    def __init__(self, ttl: float = 60, max_items: int = 1000):
+        self.ttl = ttl
+        self.max_items = max_items
+        self._pages: OrderedDict[tuple[str, int, int], tuple[int, float, tuple[ProductItem, ...], int]] = \
+            OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple[str, int, int], version: int) -> tuple[tuple[ProductItem, ...], int] | None:
+        cached = self._pages.get(key)
+        if cached is not None and cached[0] == version and time.monotonic() - cached[1] < self.ttl:
+            self._pages.move_to_end(key)
+            self.hits += 1
+            return cached[2], cached[3]
+        if cached is not None:
+            del self._pages[key]
+        self.misses += 1
+        return None
+
+    def put(self, key: tuple[str, int, int], version: int, products: tuple[ProductItem, ...], total: int) -> None:
+        self._pages[key] = (version, time.monotonic(), products, total)
+        self._pages.move_to_end(key)
+        while len(self._pages) > self.max_items:
+            self._pages.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {'pages': len(self._pages), 'hits': self.hits, 'misses': self.misses}
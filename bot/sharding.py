@@ -0,0 +1,234 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import queue
+import time
+from typing import Iterable
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+# Ключ шардирования: пользователь, иначе чат, иначе сам апдейт
+def shard_key(update: Update) -> int:
+    try:
+        event = update.event
+    except Exception:
+        return update.update_id
+    user = getattr(event, "from_user", None)
+    if user is not None:
+        return user.id
+    chat = getattr(event, "chat", None) or getattr(getattr(event, "message", None), "chat", None)
+    if chat is not None:
+        return chat.id
+    return update.update_id
+
+
+# Шарды на задачах одного event loop: апдейты одного пользователя обрабатываются строго по очереди,
+# разные пользователи - параллельно. stride согласует номера шардов при вложенном шардировании
+class TaskShards:
+    def __init__(self, dp: Dispatcher, bot: Bot, count: int = 16, queue_size: int = 100, stride: int = 1):
+        self.dp = dp
+        self.bot = bot
+        self.count = count
+        self.stride = stride
+        self._queues: list[asyncio.Queue[tuple[Update, float]]] = [
+            asyncio.Queue(maxsize=queue_size) for _ in range(count)
+        ]
+        self._tasks: list[asyncio.Task] = []
+        self.processed = [0] * count
+        self.errors = [0] * count
+        self.max_depth = [0] * count
+        self.queue_time = metrics.Histogram()
+        self.processing_time = metrics.Histogram()
+
+    def shard(self, update: Update) -> int:
+        return shard_key(update) // self.stride % self.count
+
+    def _enqueued(self, index: int) -> None:
+        self.max_depth[index] = max(self.max_depth[index], self._queues[index].qsize())
+
+    # Без ожидания: False, если очередь шарда заполнена
+    def try_submit(self, update: Update) -> bool:
+        index = self.shard(update)
+        try:
+            self._queues[index].put_nowait((update, time.perf_counter()))
+        except asyncio.QueueFull:
+            return False
+        self._enqueued(index)
+        return True
+
+    # С ожиданием места в очереди шарда - обратное давление на источник апдейтов
+    async def submit(self, update: Update) -> None:
+        index = self.shard(update)
+        await self._queues[index].put((update, time.perf_counter()))
+        self._enqueued(index)
+
+    async def _worker(self, index: int) -> None:
+        updates = self._queues[index]
+        while True:
+            update, received_at = await updates.get()
+            started = time.perf_counter()
+            self.queue_time.observe(started - received_at)
+            try:
+                await self.dp.feed_update(self.bot, update)
+                self.processed[index] += 1
+            except Exception as e:
+                self.errors[index] += 1
+                logger.error(f"Ошибка обработки апдейта {update.update_id} в шарде {index}: {e}")
+            finally:
+                self.processing_time.observe(time.perf_counter() - started)
+                updates.task_done()
+
+    async def start(self) -> None:
+        self._tasks = [asyncio.create_task(self._worker(index)) for index in range(self.count)]
+
+    def alive(self) -> bool:
+        return bool(self._tasks) and all(not task.done() for task in self._tasks)
+
+    # Принятые апдейты дообрабатываются, но не дольше drain_timeout
+    async def close(self, drain_timeout: float = 10) -> None:
+        try:
+            await asyncio.wait_for(asyncio.gather(*(updates.join() for updates in self._queues)), drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Остановка шардов: не обработано апдейтов: {sum(q.qsize() for q in self._queues)}")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            'mode': 'tasks',
+            'depth': [updates.qsize() for updates in self._queues],
+            'max_depth': list(self.max_depth),
+            'processed': list(self.processed),
+            'errors': list(self.errors),
+            'queue_time': self.queue_time.snapshot(),
+            'processing_time': self.processing_time.snapshot(),
+        }
+
+
+# Шарды на отдельных процессах: у каждого свой event loop, диспетчер, пулы БД и кэши.
+# Внутри процесса апдейты еще раз раскладываются по TaskShards (worker_tasks задач)
+class ProcessShards:
+    def __init__(self, count: int, queue_size: int = 100, worker_tasks: int = 8):
+        self.count = count
+        self.worker_tasks = worker_tasks
+        context = multiprocessing.get_context("spawn")
+        self._queues = [context.Queue(maxsize=queue_size) for _ in range(count)]
+        self._processes = [
+            context.Process(target=run_shard_process, args=(index, count, self._queues[index], worker_tasks),
+                            name=f"bot-shard-{index}", daemon=True)
+            for index in range(count)
+        ]
+        self.submitted = [0] * count
+        self.overflows = 0
+
+    def shard(self, update: Update) -> int:
+        return shard_key(update) % self.count
+
+    def try_submit(self, update: Update) -> bool:
+        index = self.shard(update)
+        try:
+            self._queues[index].put_nowait(update.model_dump_json(exclude_unset=True))
+        except queue.Full:
+            self.overflows += 1
+            return False
+        self.submitted[index] += 1
+        return True
+
+    async def submit(self, update: Update) -> None:
+        index = self.shard(update)
+        raw = update.model_dump_json(exclude_unset=True)
+        await asyncio.get_running_loop().run_in_executor(None, self._queues[index].put, raw)
+        self.submitted[index] += 1
+
+    async def start(self) -> None:
+        for process in self._processes:
+            process.start()
+
+    def alive(self) -> bool:
+        return all(process.is_alive() for process in self._processes)
+
+    # None в очереди - сигнал процессу дообработать принятое и завершиться
+    async def close(self, drain_timeout: float = 10) -> None:
+        loop = asyncio.get_running_loop()
+        for updates in self._queues:
+            await loop.run_in_executor(None, updates.put, None)
+        for process in self._processes:
+            await loop.run_in_executor(None, process.join, drain_timeout)
+            if process.is_alive():
+                logger.warning(f"Процесс {process.name} не завершился за {drain_timeout} с, остановлен")
+                process.terminate()
+
+    def stats(self) -> dict:
+        return {
+            'mode': 'processes',
+            'depth': [updates.qsize() for updates in self._queues],
+            'submitted': list(self.submitted),
+            'overflows': self.overflows,
+            'alive': [process.is_alive() for process in self._processes],
+        }
+
+
+# Точка входа процесса-шарда
+def run_shard_process(index: int, count: int, updates, worker_tasks: int) -> None:
+    logging.basicConfig(filename=f'logs/bot-shard-{index}.log', level=logging.DEBUG)
+    asyncio.run(_shard_process(index, count, updates, worker_tasks))
+
+
+async def _shard_process(index: int, count: int, updates, worker_tasks: int) -> None:
+    from bot import bot, dispatcher_runtime, share_rate_limit
+
+    # Общий лимит Telegram делят шарды и процесс-приемник с рассылками. Лимиты чатов у каждого процесса
+    # свои: чат закреплен за шардом, но рассылка приемника идет в те же чаты - редкое превышение
+    # лимита чата Telegram отклонит с 429, и запрос повторится после retry_after
+    share_rate_limit(count + 1)
+    loop = asyncio.get_running_loop()
+    async with dispatcher_runtime() as dp:
+        shards = TaskShards(dp, bot, worker_tasks, stride=count)
+        metrics.register("shards", shards.stats)
+        await shards.start()
+        logger.info(f"Шард {index} из {count} запущен")
+        while True:
+            raw = await loop.run_in_executor(None, updates.get)
+            if raw is None:
+                break
+            await shards.submit(Update.model_validate_json(raw, context={"bot": bot}))
+        await shards.close()
+
+
+# Long polling с раздачей апдейтов по шардам; при заполненном шарде чтение из Telegram приостанавливается
+async def poll_updates(bot: Bot, shards: TaskShards | ProcessShards, allowed_updates: list[str],
+                       timeout: int = 30) -> None:
+    offset = None
+    backoff = 1
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=timeout, allowed_updates=allowed_updates,
+                                            request_timeout=timeout + 10)
+        except Exception as e:
+            logger.error(f"Ошибка получения апдейтов: {e}, повтор через {backoff} с")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 60)
+            continue
+        backoff = 1
+        for update in updates:
+            await shards.submit(update)
+            offset = update.update_id + 1
+
+
+# Локальная подача апдейтов (JSON Lines) без Telegram - для тестов и нагрузочных прогонов
+async def feed_updates(bot: Bot, shards: TaskShards | ProcessShards, lines: Iterable[str]) -> int:
+    fed = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        await shards.submit(Update.model_validate(json.loads(line), context={"bot": bot}))
+        fed += 1
+    return fed
@@ -0,0 +1,148 @@
+"""Тесты хранилища FSM на заменителе постоянного хранилища (без Postgres):
+    python -m unittest test_fsm_storage
+"""
+import asyncio
+import unittest
+from decimal import Decimal
+from unittest import mock
+
+from aiogram.fsm.storage.base import StorageKey
+
+from fsm_storage import MemoryStateBackend, TieredStorage, dump_data, load_data, storage_key
+
+
+def key(user_id: int) -> StorageKey:
+    return StorageKey(bot_id=1, chat_id=user_id, user_id=user_id)
+
+
+# Считает вызовы save; по флагу останавливает запись, пока тест не отпустит ее
+class RecordingBackend(MemoryStateBackend):
+    def __init__(self):
+        super().__init__()
+        self.saves: list[set[str]] = []
+        self.paused: asyncio.Event | None = None
+        self.saving = asyncio.Event()
+
+    async def save(self, records, updated_at):
+        self.saves.append(set(records))
+        if self.paused is not None:
+            self.saving.set()
+            await self.paused.wait()
+        return await super().save(records, updated_at)
+
+
+class DataEncodingTests(unittest.TestCase):
+    def test_decimal_round_trip(self):
+        data = {'total_amount': Decimal('1234.50'), 'items': [{'price': Decimal('0.10')}], 'name': 'Иван'}
+        self.assertEqual(load_data(dump_data(data)), data)
+        self.assertIsInstance(load_data(dump_data(data))['total_amount'], Decimal)
+
+
+class TieredStorageTests(unittest.IsolatedAsyncioTestCase):
+    async def test_state_and_data_survive_eviction(self):
+        backend = MemoryStateBackend()
+        storage = TieredStorage(backend, max_entries=1)
+        await storage.set_state(key(1), "DeliveryForm:name")
+        await storage.set_data(key(1), {'total_amount': Decimal('99.90')})
+        await storage.flush()
+        await storage.set_data(key(2), {'other': 1})  # вытесняет сохраненный ключ 1
+
+        self.assertNotIn(storage_key(key(1)), storage._entries)
+        self.assertEqual(await storage.get_state(key(1)), "DeliveryForm:name")
+        self.assertEqual(await storage.get_data(key(1)), {'total_amount': Decimal('99.90')})
+
+    async def test_ttl_expiry(self):
+        storage = TieredStorage(MemoryStateBackend(), ttl=60)
+        with mock.patch("fsm_storage.time.time", return_value=1_000_000):
+            await storage.set_state(key(1), "QuantityForm:quantity")
+            await storage.flush()
+        with mock.patch("fsm_storage.time.time", return_value=1_000_059):
+            self.assertEqual(await storage.get_state(key(1)), "QuantityForm:quantity")
+        with mock.patch("fsm_storage.time.time", return_value=1_000_061):
+            self.assertIsNone(await storage.get_state(key(1)))
+            self.assertEqual(await storage.get_data(key(1)), {})
+            # Запись поверх истекшей строки проходит условную проверку версии
+            await storage.set_state(key(1), "QuantityForm:quantity")
+            await storage.flush()
+        self.assertEqual(storage.conflicts, 0)
+
+    async def test_eviction_skips_dirty_keys(self):
+        storage = TieredStorage(MemoryStateBackend(), max_entries=2)
+        for user_id in (1, 2, 3):
+            await storage.set_state(key(user_id), "s")
+        # Несохраненные записи не вытесняются, даже если памяти больше лимита
+        self.assertEqual(len(storage._entries), 3)
+        self.assertEqual(storage.evictions, 0)
+
+        await storage.flush()
+        await storage.set_state(key(4), "s")
+        self.assertEqual(len(storage._entries), 2)
+        self.assertEqual(list(storage._entries), [storage_key(key(3)), storage_key(key(4))])
+
+    async def test_flush_writes_dirty_keys_in_one_batch(self):
+        backend = RecordingBackend()
+        storage = TieredStorage(backend)
+        for user_id in range(10):
+            await storage.set_state(key(user_id), "s")
+        await storage.set_data(key(0), {'a': 1})
+
+        self.assertEqual(await storage.flush(), 10)
+        self.assertEqual(len(backend.saves), 1)
+        self.assertEqual(await storage.flush(), 0)
+        self.assertEqual(len(backend.saves), 1)
+
+    async def test_change_during_flush_stays_dirty(self):
+        backend = RecordingBackend()
+        storage = TieredStorage(backend)
+        await storage.set_data(key(1), {'step': 1})
+        backend.paused = asyncio.Event()
+        flush = asyncio.create_task(storage.flush())
+        await backend.saving.wait()
+        await storage.set_data(key(1), {'step': 2})  # изменение во время записи
+        backend.paused.set()
+        await flush
+
+        self.assertIn(storage_key(key(1)), storage._dirty)
+        backend.paused = None
+        await storage.flush()
+        self.assertEqual(storage.conflicts, 0)
+        self.assertEqual((await backend.load(storage_key(key(1))))[1], {'step': 2})
+
+    async def test_empty_record_is_deleted(self):
+        backend = MemoryStateBackend()
+        storage = TieredStorage(backend)
+        await storage.set_state(key(1), "s")
+        await storage.flush()
+        await storage.set_state(key(1), None)
+        await storage.flush()
+        self.assertIsNone(await backend.load(storage_key(key(1))))
+
+    async def test_conflicting_write_does_not_overwrite(self):
+        backend = MemoryStateBackend()
+        first, second = TieredStorage(backend), TieredStorage(backend)
+        await first.set_state(key(1), "a")
+        await first.flush()
+        self.assertEqual(await second.get_state(key(1)), "a")
+
+        await first.set_state(key(1), "b")
+        await first.flush()
+        await second.set_state(key(1), "c")  # по устаревшей версии
+        await second.flush()
+
+        self.assertEqual(second.conflicts, 1)
+        self.assertEqual((await backend.load(storage_key(key(1))))[0], "b")
+        self.assertEqual(await second.get_state(key(1)), "b")
+
+    async def test_shared_storages_see_each_other(self):
+        backend = MemoryStateBackend()
+        first, second = TieredStorage(backend, shared=True), TieredStorage(backend, shared=True)
+        await first.set_state(key(1), "a")
+        self.assertEqual(await second.get_state(key(1)), "a")
+        await second.set_data(key(1), {'x': Decimal('1.5')})
+        self.assertEqual(await first.get_data(key(1)), {'x': Decimal('1.5')})
+        self.assertEqual(first.revalidations, 1)
+        self.assertEqual(first.conflicts + second.conflicts, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
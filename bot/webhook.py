@@ -0,0 +1,84 @@
+import asyncio
+import hmac
+import logging
+
+from aiogram import Bot
+from aiogram.types import Update
+from aiohttp import web
+
+import metrics
+from sharding import ProcessShards, TaskShards
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+# Прием апдейтов по вебхуку: запрос сразу получает 200, апдейт обрабатывается шардами (sharding.py).
+# Переполненный шард отвечает 503 - Telegram повторит доставку позже.
+class WebhookServer:
+    def __init__(self, bot: Bot, shards: TaskShards | ProcessShards, path: str = "/webhook",
+                 secret_token: str | None = None):
+        self.bot = bot
+        self.shards = shards
+        self.path = path
+        self.secret_token = secret_token
+        self.received = 0
+        self.rejected = 0
+        self.overflows = 0
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_update)
+        app.router.add_get("/healthz", self.handle_health)
+        app.router.add_get("/metrics", self.handle_metrics)
+        return app
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        if self.secret_token and not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), self.secret_token):
+            self.rejected += 1
+            return web.Response(status=401)
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": self.bot})
+        except Exception as e:
+            logger.warning(f"Некорректный апдейт вебхука: {e}")
+            return web.Response(status=400)
+        if not self.shards.try_submit(update):
+            self.overflows += 1
+            return web.Response(status=503)
+        self.received += 1
+        return web.Response()
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        alive = self.shards.alive()
+        return web.json_response({'status': 'ok' if alive else 'degraded', 'queues': self.shards.stats()['depth']},
+                                 status=200 if alive else 503)
+
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        return web.json_response(metrics.collect())
+
+    def stats(self) -> dict:
+        return {
+            'received': self.received,
+            'rejected': self.rejected,
+            'overflows': self.overflows,
+        }
+
+
+# Запуск HTTP-сервера и регистрация вебхука в Telegram; работает до отмены задачи
+async def run_webhook(server: WebhookServer, base_url: str, host: str, port: int, allowed_updates: list[str],
+                      drop_pending_updates: bool = False) -> None:
+    runner = web.AppRunner(server.app())
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    await server.bot.set_webhook(
+        url=base_url.rstrip("/") + server.path,
+        secret_token=server.secret_token,
+        allowed_updates=allowed_updates,
+        drop_pending_updates=drop_pending_updates,
+    )
+    logger.info(f"Вебхук запущен на {host}:{port}{server.path}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()